@@ -0,0 +1,324 @@
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from qtxds.files import CopyCancelled, reflink
+
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+READ_SIZE = 8 * 1024 * 1024
+COMPRESSION_LEVEL = 1
+KEEP_VERSIONS = 10
+
+# Content-defined boundaries: every byte is mapped to one bit, and a chunk ends right after a fixed 16-bit pattern
+# shows up in that bit stream, i.e. about every 64 KiB of random data. Both searches run in C (translate and find).
+_random = random.Random(0x3D5)
+_bits = [0] * 128 + [1] * 128
+_random.shuffle(_bits)
+ANCHOR_TABLE = bytes(_bits)
+ANCHOR = bytes(_random.choice((0, 1)) for _ in range(15)) + b'\1'
+if len(set(ANCHOR)) == 1:
+    ANCHOR = b'\0' + ANCHOR[1:]
+
+
+def user_data_dir():
+    if sys.platform == 'win32':
+        base = Path(os.environ.get('APPDATA', Path.home()))
+    else:
+        base = Path(os.environ.get('XDG_DATA_HOME', Path.home() / '.local' / 'share'))
+    return base / 'qtxds'
+
+
+def chunks(f, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, read_size=READ_SIZE):
+    """Split a binary stream into content-defined chunks."""
+    buffer = b''
+    bits = b''
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            data = f.read(read_size)
+            if data:
+                buffer = buffer[start:] + data
+                bits = bits[start:] + data.translate(ANCHOR_TABLE)
+                start = 0
+            else:
+                eof = True
+            continue
+        if start >= len(buffer):
+            return
+
+        anchor = bits.find(ANCHOR, start + max(0, min_size - len(ANCHOR)), start + max_size)
+        if anchor != -1:
+            end = anchor + len(ANCHOR)
+        else:
+            end = min(start + max_size, len(buffer))
+        yield buffer[start:end]
+        start = end
+
+
+class BackupStore:
+    """Versioned backups of ROMs, made of compressed content-defined chunks that are stored only once.
+
+    Only the last keep versions of each ROM are kept, the chunks no version needs anymore are removed after
+    every backup.
+    """
+
+    def __init__(self, root=None, workers=None, keep=KEEP_VERSIONS):
+        self.root = Path(root) if root else user_data_dir() / 'backups'
+        self.workers = workers or os.cpu_count() or 1
+        self.keep = keep
+        self._executor = None
+        self._pending = {}
+        self._counter = itertools.count()
+        self._cleaned = False
+        self._lock = threading.Lock()
+        # Held while chunks are written and collected, so that no chunk is collected before its manifest exists
+        self._write_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # A single worker, so that the versions of a ROM are stored in the order they were taken
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qtxds-backup')
+            return self._executor
+
+    @property
+    def chunks_dir(self):
+        return self.root / 'chunks'
+
+    @property
+    def snapshots_dir(self):
+        return self.root / 'snapshots'
+
+    def _clean_snapshots(self):
+        """Remove the snapshots left behind by processes that died before storing them."""
+        if not self.snapshots_dir.exists():
+            return
+        for snapshot in self.snapshots_dir.iterdir():
+            pid = snapshot.name.split('-', 1)[0]
+            if not pid.isdigit() or int(pid) == os.getpid():
+                continue
+            try:
+                os.kill(int(pid), 0)
+            except ProcessLookupError:
+                snapshot.unlink()
+            except OSError:
+                # Alive, but someone else's
+                pass
+
+    def _chunk_path(self, digest):
+        return self.chunks_dir / digest[:2] / digest
+
+    def _manifests_dir(self, path):
+        key = hashlib.sha1(str(Path(path).resolve()).encode()).hexdigest()
+        return self.root / 'manifests' / key
+
+    def versions(self, path):
+        directory = self._manifests_dir(path)
+        if not directory.exists():
+            return []
+        manifests = []
+        for manifest in sorted(directory.glob('*.json'), key=lambda manifest: int(manifest.stem)):
+            manifests.append(json.loads(manifest.read_text()))
+        return manifests
+
+    def _store_chunk(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        chunk_path = self._chunk_path(digest)
+        if not chunk_path.exists():
+            chunk_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = chunk_path.with_name(f'.{digest}.{os.getpid()}.{id(chunk)}')
+            tmp.write_bytes(zlib.compress(chunk, COMPRESSION_LEVEL))
+            os.replace(tmp, chunk_path)
+        return digest, len(chunk)
+
+    def backup(self, path, progress=None, cancelled=None):
+        """Store the current content of path as a new version and return it.
+
+        Nothing is stored if the file is unchanged since the latest version.
+        """
+        path = Path(path)
+        self.wait(path)
+        stat = path.stat()
+        return self._store(path, path, [stat.st_size, stat.st_mtime_ns, stat.st_ino], progress, cancelled)
+
+    def snapshot(self, path, progress=None, cancelled=None):
+        """Store path as a new version, in the background when it can be cloned into the store.
+
+        The clone is a reflink, so path can be changed as soon as this returns, long before its chunks are hashed
+        and compressed. Where reflinks aren't supported, a clone would be a full copy, so path is chunked right
+        away instead. Return a future of the version.
+        """
+        path = Path(path)
+        stat = path.stat()
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self._lock:
+            pending = self._pending.get(str(path.resolve()))
+        if pending is not None and pending[1] == key:
+            return pending[0]
+        versions = self.versions(path)
+        if pending is None and versions and versions[-1]['stat'] == key:
+            future = concurrent.futures.Future()
+            future.set_result(versions[-1])
+            return future
+
+        with self._lock:
+            clean, self._cleaned = not self._cleaned, True
+        if clean:
+            self._clean_snapshots()
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+        snapshot = self.snapshots_dir / f'{os.getpid()}-{next(self._counter)}'
+        try:
+            reflink(path, snapshot)
+        except OSError:
+            future = concurrent.futures.Future()
+            future.set_result(self.backup(path, progress, cancelled))
+            return future
+        if progress:
+            progress(stat.st_size, stat.st_size)
+
+        future = self.executor.submit(self._store_snapshot, path, snapshot, key)
+        resolved = str(path.resolve())
+        with self._lock:
+            self._pending[resolved] = (future, key)
+
+        def done(future):
+            with self._lock:
+                if self._pending.get(resolved, (None,))[0] is future:
+                    del self._pending[resolved]
+
+        future.add_done_callback(done)
+        return future
+
+    def _store_snapshot(self, path, snapshot, key):
+        try:
+            return self._store(path, snapshot, key)
+        finally:
+            snapshot.unlink()
+
+    def is_pending(self, path):
+        with self._lock:
+            return str(Path(path).resolve()) in self._pending
+
+    def wait(self, path):
+        """Wait for the version of path being stored in the background, if any."""
+        with self._lock:
+            pending = self._pending.get(str(Path(path).resolve()))
+        if pending is not None:
+            concurrent.futures.wait([pending[0]])
+
+    def _store(self, path, source, key, progress=None, cancelled=None):
+        versions = self.versions(path)
+        latest = versions[-1] if versions else None
+        if latest and latest['stat'] == key:
+            return latest
+
+        entries = []
+        done = 0
+        size = key[0]
+        with self._write_lock, open(source, 'rb') as f, ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = []
+            for chunk in chunks(f):
+                if cancelled is not None and cancelled.is_set():
+                    raise CopyCancelled(str(path))
+                pending.append(executor.submit(self._store_chunk, chunk))
+                # Bound the memory held by chunks waiting to be compressed
+                if len(pending) >= self.workers * 4:
+                    entries.append(pending.pop(0).result())
+                    done += entries[-1][1]
+                    if progress:
+                        progress(done, size)
+            for future in pending:
+                entries.append(future.result())
+                done += entries[-1][1]
+                if progress:
+                    progress(done, size)
+
+            if latest and latest['chunks'] == [list(entry) for entry in entries]:
+                return latest
+
+            version = {
+                'version': latest['version'] + 1 if latest else 1,
+                'path': str(path.resolve()),
+                'created': time.time(),
+                'size': size,
+                'stat': key,
+                'chunks': [list(entry) for entry in entries],
+            }
+            directory = self._manifests_dir(path)
+            directory.mkdir(parents=True, exist_ok=True)
+            tmp = directory / f'.{version["version"]}.json'
+            tmp.write_text(json.dumps(version))
+            os.replace(tmp, directory / f'{version["version"]}.json')
+
+        if self.keep and self.prune(path, self.keep):
+            self.collect_garbage()
+        return version
+
+    def restore(self, path, version=None, dst=None, progress=None, cancelled=None):
+        """Write a stored version (the latest by default) back to dst, or over path."""
+        path = Path(path)
+        dst = Path(dst) if dst else path
+        self.wait(path)
+        versions = self.versions(path)
+        if not versions:
+            raise FileNotFoundError(f'No backup of {path}')
+        if version is None:
+            manifest = versions[-1]
+        else:
+            manifest = {manifest['version']: manifest for manifest in versions}.get(version)
+            if manifest is None:
+                raise FileNotFoundError(f'No version {version} of {path}')
+
+        tmp = dst.with_name(f'.{dst.name}.qtxds')
+        done = 0
+        try:
+            with open(tmp, 'wb') as f:
+                for digest, size in manifest['chunks']:
+                    if cancelled is not None and cancelled.is_set():
+                        raise CopyCancelled(str(path))
+                    f.write(zlib.decompress(self._chunk_path(digest).read_bytes()))
+                    done += size
+                    if progress:
+                        progress(done, manifest['size'])
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+        os.replace(tmp, dst)
+        return manifest
+
+    def prune(self, path, keep):
+        """Drop all but the last keep versions of path, return the number dropped."""
+        directory = self._manifests_dir(path)
+        pruned = self.versions(path)[:-keep or None]
+        for manifest in pruned:
+            (directory / f'{manifest["version"]}.json').unlink()
+        return len(pruned)
+
+    def collect_garbage(self):
+        """Remove the chunks no manifest refers to, return the number of bytes freed."""
+        with self._write_lock:
+            referenced = set()
+            for manifest in (self.root / 'manifests').glob('*/*.json'):
+                referenced.update(digest for digest, _ in json.loads(manifest.read_text())['chunks'])
+            freed = 0
+            for chunk_path in self.chunks_dir.glob('*/*'):
+                if chunk_path.name not in referenced:
+                    freed += chunk_path.stat().st_size
+                    chunk_path.unlink()
+        return freed
+
+    def usage(self):
+        return sum(chunk_path.stat().st_size for chunk_path in self.chunks_dir.glob('*/*'))
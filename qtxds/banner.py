@@ -0,0 +1,280 @@
+import functools
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+from qtxds.cache import cache_dir
+
+ICON_SIZE = 32
+TILE_SIZE = 8
+BITMAP_OFFSET = 0x20
+BITMAP_SIZE = 0x200
+PALETTE_OFFSET = 0x220
+PALETTE_SIZE = 0x20
+TITLES_OFFSET = 0x240
+TITLE_SIZE = 0x100
+LANGUAGES = ('japanese', 'english', 'french', 'german', 'italian', 'spanish', 'chinese', 'korean')
+ANIMATED_VERSION = 0x0103
+ANIMATED_BITMAPS_OFFSET = 0x1240
+ANIMATED_PALETTES_OFFSET = 0x2240
+ANIMATION_SEQUENCE_OFFSET = 0x2340
+ANIMATION_SEQUENCE_LENGTH = 64
+FRAME_RATE = 60
+SMDH_SIZE = 0x36C0
+SMDH_TITLES_OFFSET = 0x8
+SMDH_TITLE_SIZE = 0x200
+SMDH_LANGUAGES = LANGUAGES[:6] + ('simplified_chinese', 'korean', 'dutch', 'portuguese', 'russian',
+                                  'traditional_chinese')
+SMALL_ICON_OFFSET = 0x2040
+SMALL_ICON_SIZE = 24
+LARGE_ICON_OFFSET = 0x24C0
+LARGE_ICON_SIZE = 48
+
+
+@functools.lru_cache(maxsize=None)
+def _numpy():
+    # Imported on first use, NumPy alone would take most of the startup budget
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    return numpy
+
+
+def _rgb(color):
+    r, g, b = color & 0x1F, (color >> 5) & 0x1F, (color >> 10) & 0x1F
+    return (r << 3) | (r >> 2), (g << 3) | (g >> 2), (b << 3) | (b >> 2)
+
+
+def decode_icon(bitmap, palette, flip_horizontal=False, flip_vertical=False):
+    """Decode a 32x32 4bpp tiled bitmap and its BGR555 palette to RGBA bytes, color 0 being transparent."""
+    numpy = _numpy()
+    if numpy is None:
+        return _decode_icon(bitmap, palette, flip_horizontal, flip_vertical)
+
+    packed = numpy.frombuffer(bitmap, numpy.uint8, BITMAP_SIZE)
+    indices = numpy.empty(BITMAP_SIZE * 2, numpy.uint8)
+    indices[0::2] = packed & 0x0F
+    indices[1::2] = packed >> 4
+    # 4x4 tiles of 8x8 pixels, row by row: (tile row, tile column, y, x) -> (tile row, y, tile column, x)
+    tiles = ICON_SIZE // TILE_SIZE
+    indices = indices.reshape(tiles, tiles, TILE_SIZE, TILE_SIZE).transpose(0, 2, 1, 3)
+    indices = indices.reshape(ICON_SIZE, ICON_SIZE)
+    if flip_horizontal:
+        indices = indices[:, ::-1]
+    if flip_vertical:
+        indices = indices[::-1, :]
+
+    colors = numpy.frombuffer(palette, '<u2', PALETTE_SIZE // 2).astype(numpy.uint16)
+    channels = numpy.stack([colors & 0x1F, (colors >> 5) & 0x1F, (colors >> 10) & 0x1F]).astype(numpy.uint8)
+    rgba = numpy.empty((16, 4), numpy.uint8)
+    rgba[:, :3] = ((channels << 3) | (channels >> 2)).T
+    rgba[:, 3] = 0xFF
+    rgba[0, 3] = 0
+    return rgba[indices].tobytes()
+
+
+def _decode_icon(bitmap, palette, flip_horizontal, flip_vertical):
+    colors = [_rgb(color) + (0xFF,) for color in struct.unpack_from('<16H', palette)]
+    colors[0] = colors[0][:3] + (0,)
+    tiles = ICON_SIZE // TILE_SIZE
+    rows = []
+    for y in range(ICON_SIZE):
+        row = []
+        for x in range(ICON_SIZE):
+            tile = y // TILE_SIZE * tiles + x // TILE_SIZE
+            position = (tile * TILE_SIZE + y % TILE_SIZE) * TILE_SIZE + x % TILE_SIZE
+            byte = bitmap[position // 2]
+            row.append(colors[byte >> 4 if position & 1 else byte & 0x0F])
+        rows.append(row[::-1] if flip_horizontal else row)
+    if flip_vertical:
+        rows.reverse()
+    return bytes(channel for row in rows for pixel in row for channel in pixel)
+
+
+@functools.lru_cache(maxsize=None)
+def _tiled_order(size):
+    # Source pixel of every destination pixel, 8x8 tiles row by row, pixels in Z-order inside a tile
+    order = []
+    for y in range(size):
+        for x in range(size):
+            tile = y // TILE_SIZE * (size // TILE_SIZE) + x // TILE_SIZE
+            tx, ty = x % TILE_SIZE, y % TILE_SIZE
+            morton = (tx & 1) | (ty & 1) << 1 | (tx & 2) << 1 | (ty & 2) << 2 | (tx & 4) << 2 | (ty & 4) << 3
+            order.append(tile * TILE_SIZE * TILE_SIZE + morton)
+    return order
+
+
+@functools.lru_cache(maxsize=None)
+def _tiled_index(size):
+    numpy = _numpy()
+    return numpy.array(_tiled_order(size), numpy.intp)
+
+
+def decode_rgb565(data, size):
+    """Decode a size x size RGB565 bitmap in Z-ordered 8x8 tiles, as found in 3DS SMDH icons, to RGBA bytes."""
+    numpy = _numpy()
+    if numpy is None:
+        colors = struct.unpack_from(f'<{size * size}H', data)
+        rgba = bytearray()
+        for index in _tiled_order(size):
+            color = colors[index]
+            r, g, b = color >> 11, (color >> 5) & 0x3F, color & 0x1F
+            rgba += bytes(((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2), 0xFF))
+        return bytes(rgba)
+
+    colors = numpy.frombuffer(data, '<u2', size * size)[_tiled_index(size)]
+    r, g, b = colors >> 11, (colors >> 5) & 0x3F, colors & 0x1F
+    rgba = numpy.empty((size * size, 4), numpy.uint8)
+    rgba[:, 0] = (r << 3) | (r >> 2)
+    rgba[:, 1] = (g << 2) | (g >> 4)
+    rgba[:, 2] = (b << 3) | (b >> 2)
+    rgba[:, 3] = 0xFF
+    return rgba.tobytes()
+
+
+def png(rgba, width=ICON_SIZE, height=ICON_SIZE):
+    """Encode RGBA bytes as a PNG image."""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    stride = width * 4
+    scanlines = b''.join(b'\0' + rgba[row * stride:(row + 1) * stride] for row in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(scanlines, 9)) +
+            chunk(b'IEND', b''))
+
+
+class Banner:
+    icon_size = ICON_SIZE
+
+    def __init__(self, data):
+        if len(data) < TITLES_OFFSET:
+            raise ValueError('Truncated NDS banner')
+        self.raw = bytes(data)
+        self.version, = struct.unpack_from('<H', self.raw, 0)
+
+    @property
+    def titles(self):
+        titles = {}
+        for index, language in enumerate(LANGUAGES):
+            offset = TITLES_OFFSET + index * TITLE_SIZE
+            if offset + TITLE_SIZE > len(self.raw):
+                break
+            title = self.raw[offset:offset + TITLE_SIZE].decode('utf-16-le', 'replace').split('\0', 1)[0]
+            if title:
+                titles[language] = title
+        return titles
+
+    @property
+    def title(self):
+        titles = self.titles
+        return titles.get('english') or next(iter(titles.values()), '')
+
+    @property
+    def icon_data(self):
+        return self.raw[BITMAP_OFFSET:PALETTE_OFFSET + PALETTE_SIZE]
+
+    @property
+    def digest(self):
+        """Content address of the icon, the same artwork gets the same thumbnail whichever ROM it comes from."""
+        return hashlib.sha1(self.icon_data).hexdigest()
+
+    def icon(self):
+        return decode_icon(self.raw[BITMAP_OFFSET:BITMAP_OFFSET + BITMAP_SIZE],
+                           self.raw[PALETTE_OFFSET:PALETTE_OFFSET + PALETTE_SIZE])
+
+    @property
+    def is_animated(self):
+        return self.version >= ANIMATED_VERSION and len(self.raw) >= ANIMATION_SEQUENCE_OFFSET + 2 and \
+            struct.unpack_from('<H', self.raw, ANIMATION_SEQUENCE_OFFSET)[0] != 0
+
+    def frames(self):
+        """Return the (RGBA bytes, seconds) of every step of a DSi animated icon, or the static icon alone."""
+        if not self.is_animated:
+            return [(self.icon(), 0)]
+
+        frames = []
+        decoded = {}
+        for token in struct.unpack_from(f'<{ANIMATION_SEQUENCE_LENGTH}H', self.raw, ANIMATION_SEQUENCE_OFFSET):
+            if not token:
+                break
+            duration = token & 0xFF
+            key = ((token >> 8) & 0x07, (token >> 11) & 0x07, bool(token & 0x4000), bool(token & 0x8000))
+            if key not in decoded:
+                bitmap, palette, flip_horizontal, flip_vertical = key
+                bitmap_offset = ANIMATED_BITMAPS_OFFSET + bitmap * BITMAP_SIZE
+                palette_offset = ANIMATED_PALETTES_OFFSET + palette * PALETTE_SIZE
+                decoded[key] = decode_icon(self.raw[bitmap_offset:bitmap_offset + BITMAP_SIZE],
+                                           self.raw[palette_offset:palette_offset + PALETTE_SIZE],
+                                           flip_horizontal, flip_vertical)
+            frames.append((decoded[key], duration / FRAME_RATE))
+        return frames
+
+
+class Smdh:
+    """The icon and titles of a 3DS title, stored as the 'icon' file of its ExeFS."""
+
+    icon_size = LARGE_ICON_SIZE
+
+    def __init__(self, data):
+        if len(data) < SMDH_SIZE or data[:4] != b'SMDH':
+            raise ValueError('Not an SMDH')
+        self.raw = bytes(data[:SMDH_SIZE])
+
+    def _string(self, offset, length):
+        return self.raw[offset:offset + length].decode('utf-16-le', 'replace').split('\0', 1)[0]
+
+    @property
+    def titles(self):
+        """Map every language to its short title and publisher, one per line like an NDS banner title."""
+        titles = {}
+        for index, language in enumerate(SMDH_LANGUAGES):
+            offset = SMDH_TITLES_OFFSET + index * SMDH_TITLE_SIZE
+            short_title, publisher = self._string(offset, 0x80), self._string(offset + 0x180, 0x80)
+            if short_title:
+                titles[language] = '\n'.join(filter(None, (short_title, publisher)))
+        return titles
+
+    @property
+    def title(self):
+        titles = self.titles
+        return titles.get('english') or next(iter(titles.values()), '')
+
+    @property
+    def icon_data(self):
+        return self.raw[LARGE_ICON_OFFSET:LARGE_ICON_OFFSET + LARGE_ICON_SIZE * LARGE_ICON_SIZE * 2]
+
+    @property
+    def digest(self):
+        return hashlib.sha1(self.icon_data).hexdigest()
+
+    def icon(self):
+        return decode_rgb565(self.icon_data, LARGE_ICON_SIZE)
+
+    def small_icon(self):
+        return decode_rgb565(self.raw[SMALL_ICON_OFFSET:LARGE_ICON_OFFSET], SMALL_ICON_SIZE)
+
+
+class ThumbnailCache:
+    """PNG thumbnails of banner and SMDH icons, stored under the digest of the icon they were decoded from."""
+
+    def __init__(self, root=None):
+        self.root = Path(root) if root else cache_dir() / 'thumbnails'
+
+    def path(self, digest):
+        return self.root / digest[:2] / f'{digest}.png'
+
+    def get(self, banner):
+        """Return the thumbnail of a banner, decoding its icon only the first time it is seen."""
+        path = self.path(banner.digest)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+            tmp.write_bytes(png(banner.icon(), banner.icon_size, banner.icon_size))
+            os.replace(tmp, path)
+        return path
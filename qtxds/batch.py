@@ -0,0 +1,180 @@
+import argparse
+import asyncio
+import os
+import sys
+from pathlib import Path
+from xml.etree.ElementTree import ParseError
+
+from qtxds.dedup import HashIndex, deduplicate
+from qtxds.files import path_filter
+from qtxds.hashing import GOOD, DatIndex, verify_files
+from qtxds.nds import NdsImage
+from qtxds.process import BACKGROUND, INTERACTIVE, prioritized
+from qtxds.roms import NdsRom, open_rom
+from qtxds.telemetry import telemetry
+
+STATES = {
+    None: 'unchecked',
+    True: 'ok',
+    False: 'INVALID',
+}
+
+
+class StatusPrinter:
+    """Stand in for the main window's status bar, printing every new message on its own line."""
+
+    def __init__(self, name, stream=None):
+        self.name = name
+        self.stream = stream or sys.stderr
+        self.message = None
+
+    def showMessage(self, message):
+        if message != self.message:
+            self.message = message
+            print(f'{self.name}: {message}', file=self.stream)
+
+
+async def run_all(paths, operation, jobs):
+    """Run operation(rom, status_bar) on every ROM, at most jobs at a time, return the number of failures."""
+    semaphore = asyncio.Semaphore(jobs)
+
+    async def run(path):
+        async with semaphore:
+            status_bar = StatusPrinter(Path(path).name)
+            try:
+                await operation(open_rom(path), status_bar)
+            except (OSError, ValueError) as e:
+                status_bar.showMessage(f'Error: {e}')
+                return 1
+            status_bar.showMessage('Done')
+            return 0
+
+    return sum(await asyncio.gather(*(run(path) for path in paths)))
+
+
+def extract(args):
+    lists = []
+    for file_list in args.files:
+        lists += Path(file_list).read_text().splitlines()
+    select = path_filter(args.include, args.exclude, lists)
+    if not (args.include or args.exclude or lists):
+        select = None
+
+    async def operation(rom, status_bar):
+        if select is None:
+            await rom.extract_all(status_bar)
+        else:
+            await rom.extract_selected(status_bar, select)
+
+    return asyncio.run(run_all(args.roms, operation, args.jobs))
+
+
+def check(args):
+    async def operation(rom, status_bar):
+        if not isinstance(rom, NdsRom):
+            raise ValueError('Only NDS ROMs have CRCs to check')
+
+        def check_crcs():
+            with NdsImage(rom.path) as image:
+                return image.check_crcs()
+
+        loop = asyncio.get_event_loop()
+        crcs = await loop.run_in_executor(None, check_crcs)
+        if args.fix and not crcs['header']:
+            await rom.fix_header_crc(status_bar)
+            crcs['header'] = True
+        status_bar.showMessage(', '.join(f'{name.replace("_", " ")} {STATES[ok]}' for name, ok in crcs.items()))
+        if False in crcs.values():
+            raise ValueError('Invalid CRC')
+
+    return asyncio.run(run_all(args.roms, operation, args.jobs))
+
+
+def verify(args):
+    try:
+        dat = DatIndex.load(args.dat)
+    except (OSError, ParseError) as e:
+        StatusPrinter(Path(args.dat).name).showMessage(f'Error: {e}')
+        return 1
+
+    failures = 0
+    paths = []
+    for path in args.roms:
+        if os.path.isfile(path):
+            paths.append(path)
+        else:
+            StatusPrinter(Path(path).name).showMessage('Error: not a file')
+            failures += 1
+    for path, status, entry in verify_files(paths, dat, workers=args.jobs):
+        StatusPrinter(Path(path).name).showMessage(status if entry is None else f'{status} ({entry["game"]})')
+        failures += status != GOOD
+    return failures
+
+
+def dedup(args):
+    index = HashIndex()
+    try:
+        report = deduplicate(args.roots, hardlink=args.hardlink, dry_run=args.dry_run, index=index,
+                             workers=args.jobs)
+    finally:
+        index.close()
+
+    for path, keeper in report.linked:
+        StatusPrinter(path.name).showMessage(f'{"would be linked" if args.dry_run else "linked"} to {keeper}')
+    for path, error in report.errors:
+        StatusPrinter(path.name).showMessage(f'Error: {error}')
+    print(f'{"Would reclaim" if args.dry_run else "Reclaimed"} {report.reclaimed} bytes in {len(report.groups)} '
+          f'duplicate groups, {report.hashed} files fully hashed')
+    return len(report.errors)
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='qtxds-batch', description='Process ROMs without the GUI.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='ROMs processed at the same time')
+    parser.add_argument('--priority', choices=('background', 'interactive'), default='background',
+                        help='CPU and I/O priority of the external tools')
+    parser.add_argument('--prometheus', metavar='PATH',
+                        help='write the operation totals to PATH for the Prometheus textfile collector')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    extract_parser = commands.add_parser('extract', help='extract everything, or only the selected data/RomFS files')
+    extract_parser.add_argument('-i', '--include', action='append', default=[], metavar='GLOB',
+                                help='extract the data/RomFS files matching GLOB')
+    extract_parser.add_argument('-x', '--exclude', action='append', default=[], metavar='GLOB',
+                                help='skip the files matching GLOB')
+    extract_parser.add_argument('-f', '--files', action='append', default=[], metavar='LIST',
+                                help='extract the paths listed in LIST, one per line')
+    extract_parser.add_argument('roms', nargs='+', metavar='ROM')
+    extract_parser.set_defaults(function=extract)
+
+    check_parser = commands.add_parser('check', help='check the header, logo, secure area and banner CRCs')
+    check_parser.add_argument('--fix', action='store_true', help='fix invalid header CRCs in place')
+    check_parser.add_argument('roms', nargs='+', metavar='ROM')
+    check_parser.set_defaults(function=check)
+
+    verify_parser = commands.add_parser('verify', help='check the hashes of whole collections against a DAT')
+    verify_parser.add_argument('--dat', required=True, help='No-Intro or Redump style DAT file')
+    verify_parser.add_argument('roms', nargs='+', metavar='ROM')
+    verify_parser.set_defaults(function=verify)
+
+    dedup_parser = commands.add_parser('dedup', help='replace identical ROMs and backups with links to one copy')
+    dedup_parser.add_argument('--hardlink', action='store_true',
+                              help='use hardlinks on filesystems without reflinks, edits then affect every copy')
+    dedup_parser.add_argument('--dry-run', action='store_true', help='only report what would be linked')
+    dedup_parser.add_argument('roots', nargs='+', metavar='ROOT')
+    dedup_parser.set_defaults(function=dedup)
+
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.prometheus:
+        telemetry.prometheus_path = args.prometheus
+    with prioritized(BACKGROUND if args.priority == 'background' else INTERACTIVE):
+        failures = args.function(args)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
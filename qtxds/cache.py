@@ -0,0 +1,133 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+
+SCHEMA_VERSION = 2
+# Copied out of the JSON data into their own indexed columns, so that the library can sort and filter on them
+INDEXED_FIELDS = ('title', 'product_code', 'maker_code')
+
+
+def cache_dir():
+    if sys.platform == 'win32':
+        base = Path(os.environ.get('LOCALAPPDATA', Path.home()))
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'))
+    return base / 'qtxds'
+
+
+class MetadataCache:
+    def __init__(self, path=None, max_entries=200000):
+        self.path = Path(path) if path else cache_dir() / 'metadata.sqlite'
+        self.max_entries = max_entries
+        # An upper bound of the number of entries, counted again only once it passes max_entries
+        self._count = None
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            if connection.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                connection.execute('DROP TABLE IF EXISTS metadata')
+                connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            connection.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                               'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, '
+                               'kind TEXT, data TEXT, accessed REAL, '
+                               'title TEXT, product_code TEXT, maker_code TEXT)')
+            connection.execute('CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)')
+            connection.execute('CREATE INDEX IF NOT EXISTS metadata_size ON metadata (size)')
+            for field in INDEXED_FIELDS:
+                connection.execute(f'CREATE INDEX IF NOT EXISTS metadata_{field} ON metadata ({field} COLLATE NOCASE)')
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def key(path):
+        path = Path(path).resolve()
+        stat = path.stat()
+        return str(path), stat.st_size, stat.st_mtime_ns, stat.st_ino
+
+    def load(self, rom):
+        try:
+            path, size, mtime, inode = self.key(rom.path)
+        except OSError:
+            return False
+
+        with self._lock:
+            row = self.connection.execute('SELECT size, mtime, inode, kind, data FROM metadata WHERE path = ?',
+                                          (path,)).fetchone()
+            if row is None:
+                return False
+            if row[:4] != (size, mtime, inode, type(rom).__name__):
+                self.connection.execute('DELETE FROM metadata WHERE path = ?', (path,))
+                self.connection.commit()
+                return False
+            self.connection.execute('UPDATE metadata SET accessed = ? WHERE path = ?', (time.time(), path))
+            self.connection.commit()
+
+        data = json.loads(row[4])
+        if set(data) != set(rom.metadata_fields):
+            return False
+        for field, value in data.items():
+            setattr(rom, field, value)
+        return True
+
+    def store(self, rom):
+        try:
+            path, size, mtime, inode = self.key(rom.path)
+        except OSError:
+            return
+
+        data = json.dumps({field: getattr(rom, field) for field in rom.metadata_fields})
+        indexed = tuple(getattr(rom, field, '') for field in INDEXED_FIELDS)
+        with self._lock:
+            self.connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (path, size, mtime, inode, type(rom).__name__, data, time.time()) + indexed)
+            if self._count is not None:
+                self._count += 1
+            if self._count is None or self._count > self.max_entries:
+                self.evict()
+            self.connection.commit()
+
+    def invalidate(self, path):
+        with self._lock:
+            self.connection.execute('DELETE FROM metadata WHERE path = ?', (str(Path(path).resolve()),))
+            self.connection.commit()
+
+    def query(self, sql, parameters=()):
+        """Run a read-only query on the metadata table, for views built on top of the cache."""
+        with self._lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def evict(self):
+        """Drop the least recently accessed entries once past the bound, called with the lock held.
+
+        A tenth of the bound is freed at once, so that a scan storing thousands of ROMs walks the accessed index
+        once in a while instead of on every insert.
+        """
+        count = self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
+        if count > self.max_entries:
+            keep = self.max_entries - self.max_entries // 10
+            self.connection.execute('DELETE FROM metadata WHERE path IN '
+                                    '(SELECT path FROM metadata ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                                    (keep,))
+            count = keep
+        self._count = count
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute('SELECT COUNT(*) FROM metadata').fetchone()[0]
@@ -0,0 +1,177 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from qtxds.cache import cache_dir
+from qtxds.files import replace_with_link
+from qtxds.hashing import hash_file
+
+EXTENSIONS = ('.nds', '.3ds', '.old')
+BLOCK_SIZE = 64 * 1024
+
+
+def scan(roots, extensions=EXTENSIONS):
+    stack = [str(root) for root in roots]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(extensions):
+                    yield Path(entry.path), entry.stat(follow_symlinks=False)
+
+
+def partial_hash(path, size, block_size=BLOCK_SIZE):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(block_size, size - block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def full_hash(path):
+    return hash_file(path, ('sha1',))['sha1']
+
+
+class HashIndex:
+    """Remember partial and full hashes by path, size, mtime and inode between scans."""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else cache_dir() / 'dedup.sqlite'
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hashes ('
+                                'path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, inode INTEGER, '
+                                'partial TEXT, full TEXT, link TEXT)')
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, path, stat, kind):
+        with self._lock:
+            row = self.connection.execute(f'SELECT size, mtime, inode, {kind} FROM hashes WHERE path = ?',
+                                          (str(path),)).fetchone()
+        if row and row[:3] == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            return row[3]
+        return None
+
+    def put(self, path, stat, kind, value):
+        key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        with self._lock:
+            row = self.connection.execute('SELECT size, mtime, inode FROM hashes WHERE path = ?',
+                                          (str(path),)).fetchone()
+            if row is None or row != key:
+                self.connection.execute('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, NULL, NULL, NULL)',
+                                        (str(path),) + key)
+            self.connection.execute(f'UPDATE hashes SET {kind} = ? WHERE path = ?', (value, str(path)))
+            self.connection.commit()
+
+    def cached(self, kind, function, path, stat):
+        value = self.get(path, stat, kind)
+        if value is None:
+            value = function(path, stat)
+            self.put(path, stat, kind, value)
+        return value
+
+
+class DedupReport:
+    def __init__(self):
+        self.groups = []
+        self.linked = []
+        self.errors = []
+        self.reclaimed = 0
+        self.hashed = 0
+
+
+def _refine(files, key, workers):
+    groups = defaultdict(list)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (path, stat), value in zip(files, executor.map(lambda item: key(*item), files)):
+            groups[value].append((path, stat))
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _keeper(group):
+    # Keep a live ROM over a backup, then the oldest file
+    return min(group, key=lambda item: (item[0].suffix == '.old', item[1].st_mtime_ns, str(item[0])))
+
+
+def find_duplicates(roots, index=None, workers=None, report=None):
+    """Group byte-identical files by size, then first/last block hash, then full hash."""
+    report = report if report is not None else DedupReport()
+    workers = workers or os.cpu_count() or 1
+
+    by_size = defaultdict(list)
+    seen = set()
+    for path, stat in scan(roots):
+        # Files that are already hardlinked together only need to be read once
+        if (stat.st_dev, stat.st_ino) in seen:
+            continue
+        seen.add((stat.st_dev, stat.st_ino))
+        by_size[stat.st_size].append((path, stat))
+
+    candidates = [group for size, group in by_size.items() if size and len(group) > 1]
+
+    lock = threading.Lock()
+
+    def partial(path, stat):
+        return partial_hash(path, stat.st_size)
+
+    def full(path, stat):
+        # Called from the pool threads
+        with lock:
+            report.hashed += 1
+        return full_hash(path)
+
+    if index:
+        partial = functools.partial(index.cached, 'partial', partial)
+        full = functools.partial(index.cached, 'full', full)
+
+    for group in candidates:
+        for partial_group in _refine(group, partial, workers):
+            if partial_group[0][1].st_size <= 2 * BLOCK_SIZE:
+                # The partial hash already covered every byte
+                report.groups.append(partial_group)
+                continue
+            report.groups.extend(_refine(partial_group, full, workers))
+
+    return report
+
+
+def deduplicate(roots, hardlink=False, dry_run=False, index=None, workers=None):
+    """Replace confirmed duplicates with reflinks (or hardlinks) to a single copy."""
+    report = find_duplicates(roots, index=index, workers=workers)
+
+    for group in report.groups:
+        keeper, keeper_stat = _keeper(group)
+        for path, stat in group:
+            if path == keeper or stat.st_dev != keeper_stat.st_dev:
+                continue
+            if index and index.get(path, stat, 'link') == str(keeper):
+                # Already linked by an earlier pass and untouched since
+                continue
+            if not dry_run:
+                try:
+                    replace_with_link(keeper, path, hardlink=hardlink)
+                except OSError as e:
+                    report.errors.append((path, e))
+                    continue
+                if index:
+                    new_stat = path.stat()
+                    for kind in ('partial', 'full'):
+                        value = index.get(keeper, keeper_stat, kind)
+                        if value is not None:
+                            index.put(path, new_stat, kind, value)
+                    index.put(path, new_stat, 'link', str(keeper))
+            report.linked.append((path, keeper))
+            report.reclaimed += stat.st_size
+
+    return report
@@ -0,0 +1,353 @@
+import errno
+import os
+from fnmatch import fnmatchcase
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int), see linux/fs.h
+FICLONE = 0x40049409
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+class CopyCancelled(Exception):
+    pass
+
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src, raise OSError if the filesystem can't."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported on this platform', str(dst))
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+
+def copy_file(src, dst, progress=None, cancelled=None, chunk_size=COPY_CHUNK_SIZE):
+    """Copy src to dst through a temporary file, cloning it when the filesystem allows.
+
+    Otherwise the data is copied chunk by chunk with copy_file_range (or plain reads and writes), calling
+    progress(done, total) after each chunk and giving up when the cancelled event is set.
+    """
+    src, dst = Path(src), Path(dst)
+    tmp = dst.with_name(f'.{dst.name}.qtxds')
+    total = src.stat().st_size
+
+    try:
+        reflink(src, tmp)
+    except OSError:
+        try:
+            _copy_chunks(src, tmp, total, progress, cancelled, chunk_size)
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+    else:
+        if progress:
+            progress(total, total)
+    os.replace(tmp, dst)
+
+
+def _copy_chunks(src, dst, total, progress, cancelled, chunk_size):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        buffer = None
+        done = 0
+        while done < total:
+            if cancelled is not None and cancelled.is_set():
+                raise CopyCancelled(str(src))
+            count = 0
+            if use_copy_file_range:
+                try:
+                    count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), chunk_size)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                if buffer is None:
+                    buffer = memoryview(bytearray(chunk_size))
+                count = fsrc.readinto(buffer)
+                fdst.write(buffer[:count])
+            if not count:
+                break
+            done += count
+            if progress:
+                progress(done, total)
+
+
+def copy_range(src_fd, offset, size, dst):
+    """Write size bytes of src_fd from offset to a new dst file, in the kernel whenever it allows."""
+    methods = [method for method in ('copy_file_range', 'sendfile') if hasattr(os, method)] + ['pread']
+    with open(dst, 'wb') as fdst:
+        dst_fd = fdst.fileno()
+        done = 0
+        while done < size:
+            count = size - done
+            try:
+                if methods[0] == 'copy_file_range':
+                    count = os.copy_file_range(src_fd, dst_fd, count, offset + done)
+                elif methods[0] == 'sendfile':
+                    count = os.sendfile(dst_fd, src_fd, offset + done, count)
+                else:
+                    count = os.write(dst_fd, os.pread(src_fd, min(count, COPY_CHUNK_SIZE), offset + done))
+            except OSError as e:
+                if len(methods) == 1 or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                # Fall back to the next method for the rest of this file
+                methods.pop(0)
+                continue
+            if not count:
+                raise OSError(errno.EIO, f'Unexpected end of file at {offset + done:#x}', str(dst))
+            done += count
+    return size
+
+
+def copy_ranges(src, groups, progress=None, cancelled=None, workers=None):
+    """Copy ranges of src out to many files, groups maps each output directory to its (target, offset, size).
+
+    Every group is written by one worker of a thread pool, return the number of bytes copied.
+    """
+    total = sum(size for group in groups.values() for _, _, size in group)
+    done = 0
+    lock = threading.Lock()
+    failed = threading.Event()
+
+    with open(src, 'rb') as f:
+        fd = f.fileno()
+
+        def copy_group(directory, group):
+            nonlocal done
+            os.makedirs(directory, exist_ok=True)
+            for target, offset, size in group:
+                if failed.is_set():
+                    return
+                if cancelled is not None and cancelled.is_set():
+                    raise CopyCancelled(str(src))
+                copy_range(fd, offset, size, target)
+                with lock:
+                    done += size
+                    if progress:
+                        progress(done, total)
+
+        with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4),
+                                thread_name_prefix='qtxds-extract') as executor:
+            futures = [executor.submit(copy_group, directory, group) for directory, group in groups.items()]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                # Stop the other workers instead of finishing a copy that is going to be reported as failed
+                failed.set()
+                raise
+    return total
+
+
+def copy_into(src, dst_fd, dst_offset, size):
+    """Copy the first size bytes of the src file into dst_fd at dst_offset, in the kernel whenever it allows."""
+    with open(src, 'rb') as fsrc:
+        src_fd = fsrc.fileno()
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        done = 0
+        while done < size:
+            count = size - done
+            if use_copy_file_range:
+                try:
+                    count = os.copy_file_range(src_fd, dst_fd, count, done, dst_offset + done)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                count = os.pwrite(dst_fd, os.pread(src_fd, min(count, COPY_CHUNK_SIZE), done), dst_offset + done)
+            if not count:
+                raise OSError(errno.EIO, f'Unexpected end of file at {done:#x}', str(src))
+            done += count
+    return size
+
+
+def assemble(dst, size, regions, writes=(), progress=None, cancelled=None, workers=None):
+    """Build a size bytes dst file out of (src, offset, size) regions, copied concurrently by a thread pool.
+
+    writes are (bytes, offset) pairs written as they are. dst is preallocated and written through a temporary
+    file, whatever neither covers is left as zeros. Return the number of bytes copied.
+    """
+    dst = Path(dst)
+    tmp = dst.with_name(f'.{dst.name}.qtxds')
+    total = sum(region_size for _, _, region_size in regions)
+    done = 0
+    lock = threading.Lock()
+    failed = threading.Event()
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    # A few consecutive regions per task, many small files would spend more time in the pool than copying
+    batch = max(1, len(regions) // (workers * 4))
+    batches = [regions[index:index + batch] for index in range(0, len(regions), batch)]
+
+    try:
+        with open(tmp, 'wb') as f:
+            fd = f.fileno()
+            os.truncate(fd, size)
+            if hasattr(os, 'posix_fallocate'):
+                try:
+                    # Reserve the space in one go, so the filesystem can lay the ROM out contiguously
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    pass
+            for data, offset in writes:
+                written = 0
+                while written < len(data):
+                    written += os.pwrite(fd, data[written:], offset + written)
+
+            def copy_batch(regions):
+                nonlocal done
+                for src, offset, region_size in regions:
+                    if failed.is_set():
+                        return
+                    if cancelled is not None and cancelled.is_set():
+                        raise CopyCancelled(str(dst))
+                    copy_into(src, fd, offset, region_size)
+                    with lock:
+                        done += region_size
+                        if progress:
+                            progress(done, total)
+
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='qtxds-build') as executor:
+                futures = [executor.submit(copy_batch, regions) for regions in batches]
+                try:
+                    for future in futures:
+                        future.result()
+                except BaseException:
+                    failed.set()
+                    raise
+        os.replace(tmp, dst)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    return total
+
+
+def safe_join(directory, path):
+    """Join a /-separated path read from a ROM to directory, refusing anything that would escape it."""
+    parts = path.split('/')
+    if any(part in ('', '.', '..') or '\\' in part for part in parts):
+        raise ValueError(f'Invalid file name: {path!r}')
+    return os.path.join(str(directory), *parts)
+
+
+def path_filter(include=(), exclude=(), paths=()):
+    """Build a predicate selecting /-separated relative paths.
+
+    A path is selected when it is listed in paths or matches one of the include globs, or when there are
+    neither, and when it matches none of the exclude globs. As with fnmatch, * also matches across /.
+    """
+    include, exclude = tuple(include), tuple(exclude)
+    paths = {path.strip().strip('/') for path in paths if path.strip()}
+
+    def select(path):
+        if (paths or include) and path not in paths and not any(fnmatchcase(path, pattern) for pattern in include):
+            return False
+        return not any(fnmatchcase(path, pattern) for pattern in exclude)
+
+    return select
+
+
+def replace_with_link(src, dst, hardlink=False):
+    """Atomically replace dst with a reflink (or hardlink) to src."""
+    tmp = dst.with_name(f'.{dst.name}.qtxds')
+    if tmp.exists():
+        tmp.unlink()
+    if hardlink:
+        os.link(src, tmp)
+    else:
+        reflink(src, tmp)
+        os.chmod(tmp, dst.stat().st_mode)
+    os.replace(tmp, dst)
+
+
+class DirectorySizer:
+    """Size directory trees with os.scandir, remembering the listing of each directory by its mtime.
+
+    A directory whose mtime is unchanged is not listed again, only its files are stat'ed, so files rewritten in
+    place between an extract and a rebuild are sized right without paying for a new listing.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self._executor = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='qtxds-size')
+            return self._executor
+
+    def _directory(self, path):
+        """Return the size of the files directly in path and the paths of its subdirectories."""
+        mtime = os.stat(path).st_mtime_ns
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == mtime:
+            try:
+                return sum(os.stat(name, follow_symlinks=False).st_size for name in entry[1]), entry[2]
+            except FileNotFoundError:
+                # Removed within the mtime granularity, list it again
+                pass
+
+        size = 0
+        files = []
+        subdirectories = []
+        with os.scandir(path) as entries:
+            for dir_entry in entries:
+                if dir_entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(dir_entry.path)
+                elif dir_entry.is_file(follow_symlinks=False):
+                    files.append(dir_entry.path)
+                    size += dir_entry.stat(follow_symlinks=False).st_size
+        with self._lock:
+            self._entries[path] = (mtime, files, subdirectories)
+        return size, subdirectories
+
+    def _tree_size(self, path):
+        total = 0
+        stack = [path]
+        while stack:
+            size, subdirectories = self._directory(stack.pop())
+            total += size
+            stack.extend(subdirectories)
+        return total
+
+    def size(self, path):
+        path = str(path)
+        try:
+            size, subdirectories = self._directory(path)
+        except FileNotFoundError:
+            return 0
+        # Fan the subdirectories out, each worker walks its own subtree
+        return size + sum(self.executor.map(self._tree_size, subdirectories))
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                prefix = os.path.join(str(path), '')
+                for key in [key for key in self._entries if key == str(path) or key.startswith(prefix)]:
+                    del self._entries[key]
+
+
+directory_sizer = DirectorySizer()
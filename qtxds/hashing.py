@@ -0,0 +1,148 @@
+import hashlib
+import os
+import xml.etree.ElementTree as ElementTree
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+ALGORITHMS = ('crc32', 'md5', 'sha1')
+# Logiqx and No-Intro DATs name the CRC32 crc
+DAT_ATTRIBUTES = {'crc32': ('crc', 'crc32'), 'md5': ('md5',), 'sha1': ('sha1',)}
+BUFFER_SIZE = 8 * 1024 * 1024
+
+GOOD = 'good'
+BAD = 'bad'
+UNKNOWN = 'unknown'
+
+
+class Crc32:
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f'{self.value:08x}'
+
+
+def new_digest(algorithm):
+    if algorithm == 'crc32':
+        return Crc32()
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithms=ALGORITHMS, executor=None, buffer_size=BUFFER_SIZE):
+    """Stream a file once through every digest.
+
+    With an executor, the digests of one chunk are updated concurrently (hashlib and zlib release the GIL) while
+    the next chunk is read into a second buffer.
+    """
+    digests = {algorithm: new_digest(algorithm) for algorithm in algorithms}
+    buffers = (bytearray(buffer_size), bytearray(buffer_size))
+    pending = []
+    size = 0
+
+    with open(path, 'rb', buffering=0) as f:
+        index = 0
+        while True:
+            view = memoryview(buffers[index])
+            count = f.readinto(view)
+            for future in pending:
+                future.result()
+            if not count:
+                break
+            size += count
+            chunk = view[:count]
+            if executor is None:
+                for digest in digests.values():
+                    digest.update(chunk)
+            else:
+                pending = [executor.submit(digest.update, chunk) for digest in digests.values()]
+            index ^= 1
+
+    hashes = {algorithm: digest.hexdigest() for algorithm, digest in digests.items()}
+    hashes['size'] = size
+    return hashes
+
+
+def hash_files(paths, algorithms=ALGORITHMS, workers=None):
+    """Yield (path, hashes) for every file, hashing files concurrently."""
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(path, executor.submit(hash_file, path, algorithms)) for path in paths]
+        for path, future in futures:
+            yield path, future.result()
+
+
+class DatIndex:
+    def __init__(self):
+        self.name = ''
+        self.entries = []
+        self.by_sha1 = {}
+        self.by_md5 = {}
+        self.by_crc32 = {}
+        self.by_name = {}
+
+    @classmethod
+    def load(cls, path):
+        index = cls()
+        for _, element in ElementTree.iterparse(str(path)):
+            if element.tag == 'name' and not index.name:
+                index.name = (element.text or '').strip()
+            elif element.tag == 'game' or element.tag == 'machine':
+                for rom in element.iter('rom'):
+                    index.add(element.get('name', ''), rom.attrib)
+                element.clear()
+        return index
+
+    def add(self, game, attributes):
+        entry = {
+            'game': game,
+            'name': attributes.get('name', ''),
+            'size': int(attributes['size']) if attributes.get('size') else None,
+        }
+        for algorithm in ALGORITHMS:
+            for name in DAT_ATTRIBUTES[algorithm]:
+                if attributes.get(name):
+                    entry[algorithm] = attributes[name].lower()
+                    break
+        self.entries.append(entry)
+
+        if 'sha1' in entry:
+            self.by_sha1[entry['sha1']] = entry
+        if 'md5' in entry:
+            self.by_md5[entry['md5']] = entry
+        if 'crc32' in entry:
+            self.by_crc32[(entry['crc32'], entry['size'])] = entry
+        self.by_name[entry['name']] = entry
+
+    def find(self, hashes):
+        if 'sha1' in hashes and hashes['sha1'] in self.by_sha1:
+            return self.by_sha1[hashes['sha1']]
+        if 'md5' in hashes and hashes['md5'] in self.by_md5:
+            return self.by_md5[hashes['md5']]
+        if 'crc32' in hashes:
+            # Entries without a size only have their CRC to go by
+            return (self.by_crc32.get((hashes['crc32'], hashes.get('size'))) or
+                    self.by_crc32.get((hashes['crc32'], None)))
+        return None
+
+    def verify(self, name, hashes):
+        """Return (status, entry) for a file name and its hashes."""
+        entry = self.find(hashes)
+        if entry is not None:
+            if all(entry[key] == hashes[key] for key in ALGORITHMS + ('size',)
+                   if entry.get(key) is not None and key in hashes):
+                return GOOD, entry
+            return BAD, entry
+        entry = self.by_name.get(name)
+        if entry is not None:
+            return BAD, entry
+        return UNKNOWN, None
+
+
+def verify_files(paths, dat, workers=None):
+    """Yield (path, status, entry) for every file checked against a DAT index."""
+    for path, hashes in hash_files(paths, workers=workers):
+        status, entry = dat.verify(os.path.basename(path), hashes)
+        yield path, status, entry
@@ -0,0 +1,115 @@
+import asyncio
+import itertools
+from collections import deque
+from pathlib import Path
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+ACTIVE = (PENDING, RUNNING)
+
+
+def _overlaps(paths, other_paths):
+    for path in paths:
+        for other in other_paths:
+            if path == other or path in other.parents or other in path.parents:
+                return True
+    return False
+
+
+class Job:
+    _ids = itertools.count(1)
+
+    def __init__(self, name, function, reads=(), writes=(), callback=None):
+        self.id = next(Job._ids)
+        self.name = name
+        self.function = function
+        self.reads = {Path(path) for path in reads}
+        self.writes = {Path(path) for path in writes}
+        self.callback = callback
+        self.dependencies = set()
+        self.state = PENDING
+        self.task = None
+
+    def conflicts(self, other):
+        # Two jobs can't overlap if either one writes what the other reads or writes
+        return (_overlaps(self.writes, other.reads | other.writes) or
+                _overlaps(self.reads, other.writes))
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} {self.state}>'
+
+
+class JobQueue:
+    """Run jobs as soon as every earlier job they conflict with is done, and the others concurrently."""
+
+    def __init__(self, history=50):
+        self.jobs = []
+        self.finished = deque(maxlen=history)
+        self.listeners = []
+
+    def submit(self, name, function, reads=(), writes=(), callback=None):
+        """Queue function() to run as job, calling callback(task) once it has run or was cancelled while running."""
+        job = Job(name, function, reads, writes, callback)
+        job.dependencies = {other for other in self.jobs if other.state in ACTIVE and job.conflicts(other)}
+        self.jobs.append(job)
+        self._notify()
+        self._start_ready()
+        return job
+
+    def cancel(self, job):
+        if job.state == PENDING:
+            self._finish(job, CANCELLED)
+            self._start_ready()
+        elif job.state == RUNNING:
+            job.task.cancel()
+
+    def cancel_all(self):
+        for job in reversed(list(self.jobs)):
+            self.cancel(job)
+
+    @property
+    def active(self):
+        return [job for job in self.jobs if job.state in ACTIVE]
+
+    def _start_ready(self):
+        for job in list(self.jobs):
+            if job.state != PENDING:
+                continue
+            if any(dependency.state in (FAILED, CANCELLED) for dependency in job.dependencies):
+                self._finish(job, CANCELLED)
+                continue
+            if all(dependency.state == DONE for dependency in job.dependencies):
+                job.state = RUNNING
+                job.task = asyncio.ensure_future(job.function())
+                job.task.add_done_callback(lambda task, job=job: self._done(job, task))
+                self._notify()
+
+    def _done(self, job, task):
+        if task.cancelled():
+            self._finish(job, CANCELLED)
+        else:
+            self._finish(job, FAILED if task.exception() else DONE)
+        # Cancelled while running too, so that whatever the job showed or disabled is put back
+        if job.callback:
+            job.callback(task)
+        self._start_ready()
+
+    def _finish(self, job, state):
+        job.state = state
+        if job in self.jobs:
+            self.jobs.remove(job)
+        self.finished.append(job)
+        # Cancel whatever was waiting on a job that did not complete
+        if state != DONE:
+            for other in list(self.jobs):
+                if job in other.dependencies and other.state == PENDING:
+                    self._finish(other, CANCELLED)
+        self._notify()
+
+    def _notify(self):
+        for listener in self.listeners:
+            listener(self)
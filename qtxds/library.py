@@ -0,0 +1,261 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from qtxds.files import CopyCancelled
+from qtxds.process import BACKGROUND, prioritized
+from qtxds.roms import ROMS, Rom, open_rom
+
+PAGE_SIZE = 256
+MAX_PAGES = 64
+SORT_COLUMNS = ('title', 'product_code', 'maker_code', 'size', 'path')
+
+Entry = namedtuple('Entry', 'path kind size title product_code maker_code banner_title icon_digest')
+
+
+def config_dir():
+    if sys.platform == 'win32':
+        base = Path(os.environ.get('APPDATA', Path.home()))
+    else:
+        base = Path(os.environ.get('XDG_CONFIG_HOME', Path.home() / '.config'))
+    return base / 'qtxds'
+
+
+def find_roms(root, cancelled=None):
+    """Yield the path of every NDS and 3DS ROM under root, without following symlinks."""
+    stack = [str(root)]
+    while stack:
+        if cancelled is not None and cancelled.is_set():
+            raise CopyCancelled(str(root))
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif os.path.splitext(entry.name)[1].lower() in ROMS and entry.is_file(follow_symlinks=False):
+                        yield Path(entry.path)
+        except OSError:
+            continue
+
+
+class _Quiet:
+    def showMessage(self, message):
+        pass
+
+
+def analyze(path):
+    """Analyze a ROM into the metadata cache from a worker thread, return False if it can't be read."""
+    try:
+        rom = open_rom(path)
+        with prioritized(BACKGROUND):
+            asyncio.run(rom.info(_Quiet()))
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+class Library:
+    """The ROMs under the library roots, sorted and filtered in the metadata cache and read a page at a time.
+
+    Only the pages being looked at are kept, so a view over 100,000 ROMs costs a count and a few small
+    queries on indexed columns instead of loading every entry.
+    """
+
+    def __init__(self, roots=(), cache=None, roots_path=None, page_size=PAGE_SIZE, max_pages=MAX_PAGES):
+        self.cache = cache or Rom.cache
+        self.roots_path = Path(roots_path) if roots_path else config_dir() / 'library.json'
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.roots = [Path(root).resolve() for root in roots]
+        self.sort_column = 'title'
+        self.descending = False
+        self.filter_text = ''
+        self.size_range = (None, None)
+        self._count = None
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load_roots(self):
+        try:
+            self.roots = [Path(root) for root in json.loads(self.roots_path.read_text())]
+        except (OSError, ValueError):
+            self.roots = []
+        self.invalidate()
+
+    def save_roots(self):
+        self.roots_path.parent.mkdir(parents=True, exist_ok=True)
+        self.roots_path.write_text(json.dumps([str(root) for root in self.roots]))
+
+    def add_root(self, root):
+        root = Path(root).resolve()
+        if root not in self.roots:
+            self.roots.append(root)
+            self.save_roots()
+            self.invalidate()
+
+    def remove_root(self, root):
+        self.roots.remove(Path(root).resolve())
+        self.save_roots()
+        self.invalidate()
+
+    def sort(self, column, descending=False):
+        if column not in SORT_COLUMNS:
+            raise ValueError(f'Invalid sort column: {column}')
+        self.sort_column, self.descending = column, descending
+        self.invalidate()
+
+    def filter(self, text='', min_size=None, max_size=None):
+        """Keep the ROMs whose title, product code or maker code contain text, and whose size is in range."""
+        self.filter_text = text.strip()
+        self.size_range = (min_size, max_size)
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the count and the pages read, after the roots, order, filter or cache changed."""
+        with self._lock:
+            self._count = None
+            self._pages.clear()
+
+    def _roots_where(self):
+        if not self.roots:
+            return '0', []
+        # Range scans on the primary key, from the root's separator to the character right after it
+        parameters = []
+        for root in self.roots:
+            parameters += [os.path.join(str(root), ''), str(root) + chr(ord(os.sep) + 1)]
+        return '(' + ' OR '.join(['(path > ? AND path < ?)'] * len(self.roots)) + ')', parameters
+
+    def _where(self):
+        where, parameters = self._roots_where()
+        if self.filter_text:
+            pattern = '%' + self.filter_text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            where += ' AND (' + ' OR '.join(f"{column} LIKE ? ESCAPE '\\'" for column in SORT_COLUMNS[:3]) + ')'
+            parameters += [pattern] * 3
+        min_size, max_size = self.size_range
+        if min_size is not None:
+            where += ' AND size >= ?'
+            parameters.append(min_size)
+        if max_size is not None:
+            where += ' AND size <= ?'
+            parameters.append(max_size)
+        return where, parameters
+
+    def __len__(self):
+        with self._lock:
+            count = self._count
+        if count is None:
+            where, parameters = self._where()
+            count, = self.cache.query(f'SELECT COUNT(*) FROM metadata WHERE {where}', parameters)[0]
+            with self._lock:
+                self._count = count
+        return count
+
+    def _page(self, number):
+        with self._lock:
+            page = self._pages.get(number)
+            if page is not None:
+                self._pages.move_to_end(number)
+                return page
+
+        where, parameters = self._where()
+        order = self.sort_column + ('' if self.sort_column in ('size', 'path') else ' COLLATE NOCASE')
+        direction = 'DESC' if self.descending else 'ASC'
+        rows = self.cache.query(f'SELECT path, kind, size, title, product_code, maker_code, data FROM metadata '
+                                f'WHERE {where} ORDER BY {order} {direction}, path {direction} LIMIT ? OFFSET ?',
+                                parameters + [self.page_size, number * self.page_size])
+        page = []
+        for path, kind, size, title, product_code, maker_code, data in rows:
+            data = json.loads(data)
+            page.append(Entry(Path(path), kind, size, title or '', product_code or '', maker_code or '',
+                              data.get('banner_title', ''), data.get('icon_digest')))
+
+        with self._lock:
+            self._pages[number] = page
+            while len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+        return page
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        page = self._page(index // self.page_size)
+        if index % self.page_size >= len(page):
+            # The cache changed under the view, which is refreshed after the next invalidate()
+            raise IndexError(index)
+        return page[index % self.page_size]
+
+    def populate(self, progress=None, cancelled=None, workers=None):
+        """Analyze every ROM under the roots that isn't cached yet, return the number that couldn't be read.
+
+        The analysis runs on a thread pool, each ROM on its own event loop, so it never blocks the caller's.
+        """
+        paths = [path for root in self.roots for path in find_roms(root, cancelled)]
+        # Forget the ROMs that were deleted or moved away since the last scan
+        where, parameters = self._roots_where()
+        found = {str(path.resolve()) for path in paths}
+        for path, in self.cache.query(f'SELECT path FROM metadata WHERE {where}', parameters):
+            if path not in found:
+                self.cache.invalidate(path)
+        return self.update(paths, progress, cancelled, workers)
+
+    def forget(self, paths):
+        """Drop deleted ROMs, or every ROM under deleted directories, from the cache."""
+        for path in paths:
+            path = os.path.abspath(str(path))
+            prefix = os.path.join(path, '')
+            for cached, in self.cache.query('SELECT path FROM metadata WHERE path = ? OR (path > ? AND path < ?)',
+                                            (path, prefix, path + chr(ord(os.sep) + 1))):
+                self.cache.invalidate(cached)
+        self.invalidate()
+
+    def apply(self, changed, deleted, progress=None, cancelled=None, workers=None):
+        """Bring the library up to date with the ROMs a watcher saw change, return the number that failed."""
+        self.forget(deleted)
+        return self.update([path for path in changed if os.path.isfile(path)], progress, cancelled, workers)
+
+    def directory_changes(self, directory):
+        """List the ROMs directly in a directory, and the cached ones that are gone from it.
+
+        Watchers that only know that something changed in a directory use it instead of rescanning a root.
+        """
+        directory = os.path.abspath(str(directory))
+        try:
+            with os.scandir(directory) as entries:
+                present = [Path(entry.path) for entry in entries
+                           if os.path.splitext(entry.name)[1].lower() in ROMS and entry.is_file()]
+        except FileNotFoundError:
+            return [], [Path(directory)]
+        names = {path.name for path in present}
+        prefix = os.path.join(directory, '')
+        vanished = []
+        for cached, in self.cache.query('SELECT path FROM metadata WHERE path > ? AND path < ?',
+                                        (prefix, directory + chr(ord(os.sep) + 1))):
+            relative = cached[len(prefix):]
+            if os.sep not in relative and relative not in names:
+                vanished.append(Path(cached))
+        return present, vanished
+
+    def update(self, paths, progress=None, cancelled=None, workers=None):
+        """Analyze the given ROMs, skipping the ones whose cache entry is still valid."""
+        total = len(paths)
+        failures = 0
+        with ThreadPoolExecutor(max_workers=workers or min(8, os.cpu_count() or 1),
+                                thread_name_prefix='qtxds-library') as executor:
+            futures = [executor.submit(analyze, path) for path in paths]
+            try:
+                for done, future in enumerate(futures, 1):
+                    if cancelled is not None and cancelled.is_set():
+                        raise CopyCancelled('library')
+                    failures += not future.result()
+                    if progress:
+                        progress(done, total)
+            finally:
+                for future in futures:
+                    future.cancel()
+                self.invalidate()
+        return failures
@@ -1,15 +1,44 @@
 import asyncio
+import errno
+import functools
 import sys
+from collections import OrderedDict
 from pathlib import Path
 
 import humanize
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import QAbstractTableModel, QFileSystemWatcher, QModelIndex, QSize, QSocketNotifier, Qt, QTimer
+from PyQt5.QtGui import QFontDatabase, QImage, QPixmap
 from PyQt5.QtWidgets import (QAction, QApplication, QDialog, QFileDialog, QHBoxLayout, QLabel, QMainWindow,
-                             QVBoxLayout, QDesktopWidget, QGridLayout, QGroupBox, QLineEdit)
-from quamash import QEventLoop
+                             QVBoxLayout, QDesktopWidget, QGridLayout, QGroupBox, QLineEdit, QDockWidget,
+                             QTableWidget, QTableWidgetItem, QListWidget, QListWidgetItem, QPushButton, QWidget,
+                             QTreeWidget, QTreeWidgetItem, QPlainTextEdit, QDialogButtonBox, QTableView,
+                             QHeaderView, QAbstractItemView, QSpinBox, QInputDialog)
 
-from qtxds.roms import NdsRom, ThreedsRom
-from tools import NdsTool, ThreedsTool, CtrTool
+from qtxds.files import path_filter
+from qtxds.hashing import DatIndex
+from qtxds.jobs import JobQueue, PENDING
+from qtxds.library import Library
+from qtxds.roms import NdsRom, Rom, ThreedsRom, open_rom
+from qtxds.telemetry import telemetry, threadsafe_listener
+from qtxds.watcher import Changes, LibraryWatcher, directories
+
+PREVIEW_SIZE = 4096
+LIBRARY_ICON_SIZE = 32
+
+
+def failed(future):
+    """Whether a job or background task failed, or was cancelled while it ran."""
+    return future.cancelled() or future.exception() is not None
+
+
+def hexdump(data, offset=0):
+    """Format bytes as lines of 16 hexadecimal bytes followed by their ASCII."""
+    lines = []
+    for position in range(0, len(data), 16):
+        row = data[position:position + 16]
+        text = ''.join(chr(byte) if 0x20 <= byte < 0x7F else '.' for byte in row)
+        lines.append(f'{offset + position:08X}  {row.hex(" ").upper():<47}  {text}')
+    return '\n'.join(lines)
 
 
 class MainWindow(QMainWindow):
@@ -36,12 +65,14 @@ class MainWindow(QMainWindow):
         self.encryption_menu()
         self.padding_menu()
         self.misc_menu()
+        self.telemetry_dock()
+        self.jobs_dock()
+        self.files_dock()
+        self.view_menu()
         self.help_menu()
 
         self.rom = None
-        self.ndstool = NdsTool()
-        self.ctrtool = CtrTool()
-        self.threedstool = ThreedsTool()
+        self.library_window = None
 
         filters = ['Nintendo DS/3DS ROMs (*.nds *.3ds)', 'Nintendo DS ROMs (*.nds)', 'Nintendo 3DS ROMs (*.3ds)']
         self.filters = ';;'.join(filters)
@@ -65,8 +96,17 @@ class MainWindow(QMainWindow):
         self.rom_secure_area_crc = QLabel()
         self.rom_decrypted = QLabel()
         self.rom_header_crc = QLabel()
+        self.rom_logo_crc = QLabel()
+        self.rom_banner_crc = QLabel()
         self.rom_size = QLabel()
         self.rom_content_size = QLabel()
+        self.rom_dat_status = QLabel()
+        self.rom_icon = QLabel()
+        self.rom_banner_title = QLabel()
+        self.icon_timer = QTimer(self)
+        self.icon_timer.setSingleShot(True)
+        self.icon_timer.timeout.connect(self.next_icon_frame)
+        self.icon_frames = []
 
         # NDS Content
         self.rom_arm9_size = QLabel()
@@ -95,10 +135,20 @@ class MainWindow(QMainWindow):
         info_grid_layout.addWidget(self.rom_secure_area_crc, 3, 1)
         info_grid_layout.addWidget(QLabel('Header CRC'), 4, 0)
         info_grid_layout.addWidget(self.rom_header_crc, 4, 1)
-        info_grid_layout.addWidget(QLabel('Size'), 5, 0)
-        info_grid_layout.addWidget(self.rom_size, 5, 1)
-        info_grid_layout.addWidget(QLabel('Content Size'), 6, 0)
-        info_grid_layout.addWidget(self.rom_content_size, 6, 1)
+        info_grid_layout.addWidget(QLabel('Logo CRC'), 5, 0)
+        info_grid_layout.addWidget(self.rom_logo_crc, 5, 1)
+        info_grid_layout.addWidget(QLabel('Banner CRC'), 6, 0)
+        info_grid_layout.addWidget(self.rom_banner_crc, 6, 1)
+        info_grid_layout.addWidget(QLabel('Size'), 7, 0)
+        info_grid_layout.addWidget(self.rom_size, 7, 1)
+        info_grid_layout.addWidget(QLabel('Content Size'), 8, 0)
+        info_grid_layout.addWidget(self.rom_content_size, 8, 1)
+        info_grid_layout.addWidget(QLabel('DAT Status'), 9, 0)
+        info_grid_layout.addWidget(self.rom_dat_status, 9, 1)
+        info_grid_layout.addWidget(QLabel('Icon'), 10, 0)
+        info_grid_layout.addWidget(self.rom_icon, 10, 1)
+        info_grid_layout.addWidget(QLabel('Banner Title'), 11, 0)
+        info_grid_layout.addWidget(self.rom_banner_title, 11, 1)
 
         nds_content_grid_layout.addWidget(QLabel('ARM 9'), 0, 0)
         nds_content_grid_layout.addWidget(self.rom_arm9_size, 0, 1)
@@ -146,14 +196,27 @@ class MainWindow(QMainWindow):
         self.open_action.setShortcut('CTRL+O')
         self.open_action.triggered.connect(self.open_file)
 
+        self.library_action = QAction('Library', self)
+        self.library_action.setStatusTip('Browse and process every ROM of the library folders.')
+        self.library_action.setShortcut('CTRL+L')
+        self.library_action.triggered.connect(self.show_library)
+
         self.exit_action = QAction('Exit Application', self)
         self.exit_action.setStatusTip('Exit the application.')
         self.exit_action.setShortcut('CTRL+Q')
         self.exit_action.triggered.connect(lambda: QApplication.quit())
 
         self.file_sub_menu.addAction(self.open_action)
+        self.file_sub_menu.addAction(self.library_action)
         self.file_sub_menu.addAction(self.exit_action)
 
+    def show_library(self):
+        """Show the library window, creating it the first time."""
+        if self.library_window is None:
+            self.library_window = LibraryWindow(self)
+        self.library_window.show()
+        self.library_window.raise_()
+
     def extract_menu(self):
         """Create an extract submenu with various extract actions."""
         self.extract_sub_menu = self.menu_bar.addMenu('Extract')
@@ -164,6 +227,11 @@ class MainWindow(QMainWindow):
         self.extract_all_action.triggered.connect(self.extract_all)
         self.extract_all_action.setEnabled(False)
 
+        self.extract_selected_action = QAction('Extract Selected...', self)
+        self.extract_selected_action.setStatusTip('Extract the data or RomFS files matching patterns or a list.')
+        self.extract_selected_action.triggered.connect(self.extract_selected)
+        self.extract_selected_action.setEnabled(False)
+
         self.extract_cci_action = QAction('Extract CCI', self)
         self.extract_cci_action.setStatusTip('Extract the NCSD contents of the open ROM.')
         self.extract_cci_action.triggered.connect(self.extract_cci)
@@ -185,6 +253,7 @@ class MainWindow(QMainWindow):
         self.extract_romfs_action.setEnabled(False)
 
         self.extract_sub_menu.addAction(self.extract_all_action)
+        self.extract_sub_menu.addAction(self.extract_selected_action)
         self.extract_sub_menu.addAction(self.extract_cci_action)
         self.extract_sub_menu.addAction(self.extract_cxi_action)
         self.extract_sub_menu.addAction(self.extract_exefs_action)
@@ -282,7 +351,222 @@ class MainWindow(QMainWindow):
         self.fix_header_crc_action.triggered.connect(self.fix_header_crc)
         self.fix_header_crc_action.setEnabled(False)
 
+        self.verify_action = QAction('Verify against DAT', self)
+        self.verify_action.setStatusTip('Check the open ROM\'s hashes against a DAT file.')
+        self.verify_action.triggered.connect(self.verify)
+        self.verify_action.setEnabled(False)
+
+        self.restore_action = QAction('Restore Backup', self)
+        self.restore_action.setStatusTip('Restore the open ROM to the state before the last change.')
+        self.restore_action.triggered.connect(self.restore)
+        self.restore_action.setEnabled(False)
+
         self.misc_sub_menu.addAction(self.fix_header_crc_action)
+        self.misc_sub_menu.addAction(self.verify_action)
+        self.misc_sub_menu.addAction(self.restore_action)
+
+    def telemetry_dock(self):
+        """Create a dock listing the duration and I/O of the latest operations."""
+        self.telemetry_table = QTableWidget(0, 7)
+        self.telemetry_table.setHorizontalHeaderLabels(
+            ['Operation', 'ROM', 'Status', 'Wall Time', 'Subprocess CPU', 'Read / Written', 'Throughput'])
+        self.telemetry_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.telemetry_table.verticalHeader().setVisible(False)
+
+        self.telemetry_dock_widget = QDockWidget('Telemetry', self)
+        self.telemetry_dock_widget.setWidget(self.telemetry_table)
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.telemetry_dock_widget)
+        self.telemetry_dock_widget.hide()
+
+        telemetry.listeners.append(threadsafe_listener(self.add_telemetry_record))
+
+    def jobs_dock(self):
+        """Create a dock listing the queued, running and latest finished jobs."""
+        self.job_queue = JobQueue()
+        self.job_queue.listeners.append(self.refresh_jobs)
+
+        self.jobs_list = QListWidget()
+
+        cancel_button = QPushButton('Cancel')
+        cancel_button.clicked.connect(self.cancel_job)
+        cancel_all_button = QPushButton('Cancel All')
+        cancel_all_button.clicked.connect(lambda: self.job_queue.cancel_all())
+
+        buttons_layout = QHBoxLayout()
+        buttons_layout.addWidget(cancel_button)
+        buttons_layout.addWidget(cancel_all_button)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.jobs_list)
+        layout.addLayout(buttons_layout)
+
+        widget = QWidget()
+        widget.setLayout(layout)
+
+        self.jobs_dock_widget = QDockWidget('Jobs', self)
+        self.jobs_dock_widget.setWidget(widget)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.jobs_dock_widget)
+        self.jobs_dock_widget.hide()
+
+    def refresh_jobs(self, job_queue):
+        """Show the active jobs first, then the latest finished ones."""
+        self.jobs_list.clear()
+        for job in job_queue.active + list(reversed(job_queue.finished)):
+            text = f'#{job.id} {job.name}: {job.state}'
+            if job.state == PENDING and job.dependencies:
+                text += ' (after ' + ', '.join(f'#{dependency.id}' for dependency in job.dependencies) + ')'
+            item = QListWidgetItem(text)
+            item.setData(Qt.UserRole, job.id)
+            self.jobs_list.addItem(item)
+
+    def cancel_job(self):
+        """Cancel the selected job and whatever depends on it."""
+        for item in self.jobs_list.selectedItems():
+            for job in self.job_queue.active:
+                if job.id == item.data(Qt.UserRole):
+                    self.job_queue.cancel(job)
+
+    def run_job(self, operation, function, callback, rom=None):
+        """Queue an operation on the open ROM, or another one, behind the jobs it conflicts with."""
+        rom = rom or self.rom
+        reads, writes = rom.resources(operation)
+        name = f'{operation.replace("_", " ").title()} {rom.path.name}'
+        return self.job_queue.submit(name, function, reads, writes, callback)
+
+    def files_dock(self):
+        """Create a dock browsing the open ROM's file system or RomFS, read straight from the ROM."""
+        self.files_tree = QTreeWidget()
+        self.files_tree.setHeaderLabels(['Name', 'Size', 'Offset'])
+        self.files_tree.itemExpanded.connect(self.expand_files_item)
+        self.files_tree.itemSelectionChanged.connect(self.preview_file)
+
+        self.file_preview = QPlainTextEdit()
+        self.file_preview.setReadOnly(True)
+        self.file_preview.setFont(QFontDatabase.systemFont(QFontDatabase.FixedFont))
+
+        self.export_file_button = QPushButton('Export...')
+        self.export_file_button.clicked.connect(self.export_file)
+        self.export_file_button.setEnabled(False)
+
+        layout = QVBoxLayout()
+        layout.addWidget(self.files_tree)
+        layout.addWidget(self.file_preview)
+        layout.addWidget(self.export_file_button)
+
+        widget = QWidget()
+        widget.setLayout(layout)
+
+        self.files_dock_widget = QDockWidget('Files', self)
+        self.files_dock_widget.setWidget(widget)
+        self.addDockWidget(Qt.LeftDockWidgetArea, self.files_dock_widget)
+        self.files_dock_widget.hide()
+
+    def load_files(self):
+        """List the root of the open ROM's file system, subdirectories are only read once expanded."""
+        self.files_tree.clear()
+        self.file_preview.clear()
+        self.export_file_button.setEnabled(False)
+        self.add_files_items(self.files_tree.invisibleRootItem(), self.rom.root_directory)
+
+    def add_files_items(self, parent, directory_id):
+        """Add the entries of a directory under a tree item."""
+        try:
+            entries = self.rom.listdir(directory_id)
+        except ValueError as e:
+            self.status_bar.showMessage(str(e))
+            return
+        for name, is_directory, entry_id, offset, size in entries:
+            if is_directory:
+                item = QTreeWidgetItem([name, '', ''])
+                item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+            else:
+                item = QTreeWidgetItem([name, humanize.naturalsize(size, gnu=True), f'0x{offset:08X}'])
+            item.setData(0, Qt.UserRole, (is_directory, entry_id))
+            parent.addChild(item)
+
+    def expand_files_item(self, item):
+        """Read a directory the first time it is expanded."""
+        is_directory, entry_id = item.data(0, Qt.UserRole)
+        if is_directory and not item.childCount():
+            self.add_files_items(item, entry_id)
+            if not item.childCount():
+                item.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicator)
+
+    def selected_file(self):
+        """Return the selected tree item and its FAT id, if it is a file."""
+        for item in self.files_tree.selectedItems():
+            is_directory, entry_id = item.data(0, Qt.UserRole)
+            if not is_directory:
+                return item, entry_id
+        return None, None
+
+    def preview_file(self):
+        """Show the beginning of the selected file, only these bytes are read from the ROM."""
+        item, file_id = self.selected_file()
+        self.export_file_button.setEnabled(item is not None)
+        if item is None:
+            self.file_preview.clear()
+            return
+        try:
+            data = self.rom.read_file(file_id, PREVIEW_SIZE)
+        except (OSError, ValueError) as e:
+            self.status_bar.showMessage(str(e))
+            return
+        self.file_preview.setPlainText(hexdump(data))
+
+    def export_file(self):
+        """Save the selected file out of the ROM."""
+        item, file_id = self.selected_file()
+        if item is None:
+            return
+        filename, accepted = QFileDialog().getSaveFileName(self, 'Export File',
+                                                           str(self.rom.working_dir / item.text(0)))
+
+        if accepted:
+            self.run_job('export_file', functools.partial(self.rom.export_file, self.status_bar, file_id,
+                                                          Path(filename)), self.export_file_callback)
+
+    def export_file_callback(self, future):
+        """Callback for the Export action of the files dock."""
+        if failed(future):
+            self.status_bar.showMessage('Error')
+        else:
+            self.status_bar.showMessage('Ready')
+
+    def view_menu(self):
+        """Create a view submenu to toggle the docks."""
+        self.view_sub_menu = self.menu_bar.addMenu('View')
+
+        self.telemetry_action = self.telemetry_dock_widget.toggleViewAction()
+        self.telemetry_action.setStatusTip('Show the duration and I/O of the latest operations.')
+
+        self.jobs_action = self.jobs_dock_widget.toggleViewAction()
+        self.jobs_action.setStatusTip('Show the queued and running operations.')
+
+        self.files_action = self.files_dock_widget.toggleViewAction()
+        self.files_action.setStatusTip('Browse the open ROM\'s files without extracting it.')
+
+        self.view_sub_menu.addAction(self.telemetry_action)
+        self.view_sub_menu.addAction(self.jobs_action)
+        self.view_sub_menu.addAction(self.files_action)
+
+    def add_telemetry_record(self, record):
+        """Prepend an operation record to the telemetry dock."""
+        io_bytes = record['bytes_read'] + record['bytes_written']
+        throughput = io_bytes / record['wall_seconds'] if record['wall_seconds'] else 0
+        self.telemetry_table.insertRow(0)
+        for column, text in enumerate((
+                record['operation'],
+                Path(record['rom']).name if record['rom'] else '',
+                record['status'],
+                f'{record["wall_seconds"]:.3f} s',
+                f'{record["subprocess_cpu_seconds"]:.3f} s',
+                ' / '.join(humanize.naturalsize(record[key], gnu=True) for key in ('bytes_read', 'bytes_written')),
+                humanize.naturalsize(throughput, gnu=True) + '/s',
+        )):
+            self.telemetry_table.setItem(0, column, QTableWidgetItem(text))
+        if self.telemetry_table.rowCount() > 200:
+            self.telemetry_table.removeRow(200)
 
     def help_menu(self):
         """Create a help submenu with an About item tha opens an about dialog."""
@@ -297,21 +581,31 @@ class MainWindow(QMainWindow):
 
     def open_file_callback(self, future):
         """Callback for opening a ROM."""
-        if not future.exception():
+        if not failed(future):
             self.rom_title.setText(self.rom.title)
             self.rom_product_code.setText(self.rom.product_code)
             self.rom_maker_code.setText(self.rom.maker_code)
             self.rom_size.setText(humanize.naturalsize(self.rom.size, gnu=True))
             self.rom_content_size.setText(humanize.naturalsize(self.rom.content_size, gnu=True))
+            self.rom_dat_status.setText(self.rom.dat_status.upper())
             self.extract_all_action.setEnabled(True)
+            self.extract_selected_action.setEnabled(True)
+            self.verify_action.setEnabled(True)
+            self.restore_action.setEnabled(len(self.rom.backup_store.versions(self.rom.path)) > 0
+                                           or self.rom.backup_store.is_pending(self.rom.path))
             self.extract_cci_action.setEnabled(isinstance(self.rom, ThreedsRom))
             self.convert_cia_action.setEnabled(isinstance(self.rom, ThreedsRom))
             self.trim_action.setEnabled(True)
             self.pad_action.setEnabled(isinstance(self.rom, ThreedsRom))
+            self.rom_banner_title.setText(self.rom.banner_title)
+            self.show_icon()
+            self.load_files()
             if isinstance(self.rom, NdsRom):
                 self.rom_secure_area_crc.setText(', '.join(('VALID' if self.rom.is_secure_area_crc_ok else 'INVALID',
                                                             'DECRYPTED' if self.rom.is_decrypted else 'ENCRYPTED')))
                 self.rom_header_crc.setText('VALID' if self.rom.is_header_crc_ok else 'INVALID')
+                self.rom_logo_crc.setText('VALID' if self.rom.is_logo_crc_ok else 'INVALID')
+                self.rom_banner_crc.setText({None: 'NONE', True: 'VALID', False: 'INVALID'}[self.rom.is_banner_crc_ok])
                 self.rom_extended_header_size.setText('')
                 self.rom_plain_size.setText('')
                 self.rom_logo_size.setText('')
@@ -321,6 +615,8 @@ class MainWindow(QMainWindow):
             elif isinstance(self.rom, ThreedsRom):
                 self.rom_secure_area_crc.setText('')
                 self.rom_header_crc.setText('')
+                self.rom_logo_crc.setText('')
+                self.rom_banner_crc.setText('')
                 self.rom_arm9_size.setText('')
                 self.rom_arm7_size.setText('')
                 self.rom_overlay9_size.setText('')
@@ -339,17 +635,46 @@ class MainWindow(QMainWindow):
 
         self.status_bar.showMessage('Ready')
 
+    def show_icon(self):
+        """Show the cached thumbnail of the open ROM's icon, and play it if it is animated."""
+        self.icon_timer.stop()
+        self.icon_frames = []
+        thumbnail = self.rom.thumbnail
+        if thumbnail is None or not thumbnail.exists():
+            self.rom_icon.clear()
+            return
+        self.rom_icon.setPixmap(QPixmap(str(thumbnail)).scaled(64, 64))
+
+        try:
+            frames = self.rom.icon_frames()
+        except (OSError, ValueError):
+            return
+        if len(frames) > 1:
+            self.icon_frames = [(QPixmap.fromImage(QImage(rgba, 32, 32, QImage.Format_RGBA8888).copy()).scaled(64, 64),
+                                 seconds) for rgba, seconds in frames]
+            self.icon_frame = -1
+            self.next_icon_frame()
+
+    def next_icon_frame(self):
+        """Show the next step of an animated icon."""
+        self.icon_frame = (self.icon_frame + 1) % len(self.icon_frames)
+        pixmap, seconds = self.icon_frames[self.icon_frame]
+        self.rom_icon.setPixmap(pixmap)
+        self.icon_timer.start(max(1, int(seconds * 1000)))
+
     def enable_rebuild_all_callback(self, future):
         """Enables the rebuild QAction."""
-        if not future.exception():
+        if not failed(future):
             self.rebuild_all_action.setEnabled(True)
             if isinstance(self.rom, NdsRom):
                 self.rom_arm9_size.setText(humanize.naturalsize(self.rom.arm9_bin.stat().st_size, gnu=True))
                 self.rom_arm7_size.setText(humanize.naturalsize(self.rom.arm7_bin.stat().st_size, gnu=True))
                 self.rom_overlay9_size.setText(humanize.naturalsize(self.rom.overlay9_bin.stat().st_size, gnu=True))
                 self.rom_overlay7_size.setText(humanize.naturalsize(self.rom.overlay7_bin.stat().st_size, gnu=True))
-                self.rom_data_size.setText(humanize.naturalsize(self.rom.data_size, gnu=True))
-                self.rom_overlay_size.setText(humanize.naturalsize(self.rom.overlay_size, gnu=True))
+                self.rom_data_size.setText('...')
+                self.rom_overlay_size.setText('...')
+                future = asyncio.ensure_future(self.rom.directory_sizes())
+                future.add_done_callback(self.directory_sizes_callback)
                 self.rom_header_size.setText(humanize.naturalsize(self.rom.header_bin.stat().st_size, gnu=True))
                 self.rom_banner_size.setText(humanize.naturalsize(self.rom.banner_bin.stat().st_size, gnu=True))
             elif isinstance(self.rom, ThreedsRom):
@@ -365,12 +690,21 @@ class MainWindow(QMainWindow):
 
         self.status_bar.showMessage('Ready')
 
+    def directory_sizes_callback(self, future):
+        """Fill the data and overlay sizes once they have been computed in the background."""
+        if not failed(future):
+            data_size, overlay_size = future.result()
+            self.rom_data_size.setText(humanize.naturalsize(data_size, gnu=True))
+            self.rom_overlay_size.setText(humanize.naturalsize(overlay_size, gnu=True))
+        else:
+            self.rom_data_size.setText('')
+            self.rom_overlay_size.setText('')
+
     def info_callback(self, future):
         """Refresh ROM information."""
-        if not future.exception():
-            coro = self.rom.info(self.status_bar)
-            future = asyncio.ensure_future(coro)
-            future.add_done_callback(self.open_file_callback)
+        # A cancelled operation may have changed the ROM before it stopped
+        if future.cancelled() or not future.exception():
+            self.run_job('info', functools.partial(self.rom.info, self.status_bar), self.open_file_callback)
         else:
             self.status_bar.showMessage('Error')
 
@@ -378,7 +712,7 @@ class MainWindow(QMainWindow):
 
     def extract_cci_callback(self, future):
         """Callback for the Extract CCI action."""
-        if not future.exception():
+        if not failed(future):
             self.rebuild_cci_action.setEnabled(True)
             self.extract_cxi_action.setEnabled(True)
         else:
@@ -388,7 +722,7 @@ class MainWindow(QMainWindow):
 
     def extract_cxi_callback(self, future):
         """Callback for the Extract CXI action."""
-        if not future.exception():
+        if not failed(future):
             self.rebuild_cxi_action.setEnabled(True)
             self.extract_exefs_action.setEnabled(True)
             self.extract_romfs_action.setEnabled(True)
@@ -399,7 +733,7 @@ class MainWindow(QMainWindow):
 
     def extract_exefs_callback(self, future):
         """Callback for the Extract ExeFS action."""
-        if not future.exception():
+        if not failed(future):
             self.rebuild_exefs_action.setEnabled(True)
         else:
             self.status_bar.showMessage('Error')
@@ -408,68 +742,74 @@ class MainWindow(QMainWindow):
 
     def extract_romfs_callback(self, future):
         """Callback for the Extract RomFS action."""
-        if not future.exception():
+        if not failed(future):
             self.rebuild_romfs_action.setEnabled(True)
         else:
             self.status_bar.showMessage('Error')
 
         self.status_bar.showMessage('Ready')
 
+    def verify_callback(self, future):
+        """Callback for the Verify against DAT action."""
+        if not failed(future):
+            self.rom_dat_status.setText(self.rom.dat_status.upper())
+            if self.rom.dat_entry:
+                self.rom_dat_status.setToolTip(self.rom.dat_entry['game'])
+        else:
+            self.status_bar.showMessage('Error')
+
+        self.status_bar.showMessage('Ready')
+
     def open_file(self):
         """Open a QFileDialog to allow the user to open a file into the application."""
         filename, accepted = QFileDialog().getOpenFileName(self, 'Open File', str(Path.home()), self.filters)
 
         if accepted:
-            path = Path(filename)
-            for action in (
-                    'extract_cci',
-                    'extract_cxi',
-                    'extract_exefs',
-                    'extract_romfs',
-                    'rebuild_all',
-                    'rebuild_cci',
-                    'rebuild_cxi',
-                    'rebuild_exefs',
-                    'rebuild_romfs',
-                    'decrypt',
-                    'encrypt',
-                    'trim',
-                    'pad',
-                    'fix_header_crc'
-            ):
-                getattr(self, f'{action}_action').setEnabled(False)
-            if path.suffix == '.nds':
-                self.rom = NdsRom(path)
-            elif path.suffix == '.3ds':
-                self.rom = ThreedsRom(path)
-            if self.rom:
-                coro = self.rom.info(self.status_bar)
-                future = asyncio.ensure_future(coro)
-                future.add_done_callback(self.open_file_callback)
+            self.open_path(Path(filename))
+
+    def open_path(self, path):
+        """Open a ROM into the application."""
+        for action in (
+                'extract_cci',
+                'extract_cxi',
+                'extract_exefs',
+                'extract_romfs',
+                'rebuild_all',
+                'rebuild_cci',
+                'rebuild_cxi',
+                'rebuild_exefs',
+                'rebuild_romfs',
+                'decrypt',
+                'encrypt',
+                'trim',
+                'pad',
+                'fix_header_crc',
+                'verify',
+                'restore'
+        ):
+            getattr(self, f'{action}_action').setEnabled(False)
+        if path.suffix == '.nds':
+            self.rom = NdsRom(path)
+        elif path.suffix == '.3ds':
+            self.rom = ThreedsRom(path)
+        if self.rom:
+            self.run_job('info', functools.partial(self.rom.info, self.status_bar), self.open_file_callback)
 
     def decrypt(self):
         """Decrypt the open ROM."""
-        coro = self.rom.decrypt(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('decrypt', functools.partial(self.rom.decrypt, self.status_bar), self.info_callback)
 
     def encrypt(self):
         """Encrypt the open ROM."""
-        coro = self.rom.encrypt(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('encrypt', functools.partial(self.rom.encrypt, self.status_bar), self.info_callback)
 
     def trim(self):
         """Trim the open ROM."""
-        coro = self.rom.trim(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('trim', functools.partial(self.rom.trim, self.status_bar), self.info_callback)
 
     def pad(self):
         """Pad the open ROM."""
-        coro = self.rom.pad(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('pad', functools.partial(self.rom.pad, self.status_bar), self.info_callback)
 
     def extract_all(self):
         """Extract the open ROM."""
@@ -477,63 +817,66 @@ class MainWindow(QMainWindow):
 
         if dirname:
             self.rom.working_dir = Path(dirname)
-            coro = self.rom.extract_all(self.status_bar)
-            future = asyncio.ensure_future(coro)
-            future.add_done_callback(self.enable_rebuild_all_callback)
+            self.run_job('extract_all', functools.partial(self.rom.extract_all, self.status_bar),
+                         self.enable_rebuild_all_callback)
+
+    def extract_selected(self):
+        """Extract only the data or RomFS files picked in an ExtractSelectedDialog."""
+        dialog = ExtractSelectedDialog(self)
+
+        if dialog.exec_():
+            try:
+                select = dialog.path_filter()
+            except OSError as e:
+                self.status_bar.showMessage(str(e))
+                return
+            self.run_job('extract_selected', functools.partial(self.rom.extract_selected, self.status_bar, select),
+                         self.extract_selected_callback)
+
+    def extract_selected_callback(self, future):
+        """Callback for the Extract Selected action."""
+        if failed(future):
+            self.status_bar.showMessage('Error')
+        else:
+            self.status_bar.showMessage('Ready')
 
     def extract_cci(self):
         """Extract the NCSD contents of the open ROM."""
-        coro = self.rom.extract_cci(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.extract_cci_callback)
+        self.run_job('extract_cci', functools.partial(self.rom.extract_cci, self.status_bar), self.extract_cci_callback)
 
     def extract_cxi(self):
         """Extract the NCCH contents of the open ROM."""
-        coro = self.rom.extract_cxi(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.extract_cxi_callback)
+        self.run_job('extract_cxi', functools.partial(self.rom.extract_cxi, self.status_bar), self.extract_cxi_callback)
 
     def extract_exefs(self):
         """Extract the ExeFS contents of the open ROM."""
-        coro = self.rom.extract_exefs(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.extract_exefs_callback)
+        self.run_job('extract_exefs', functools.partial(self.rom.extract_exefs, self.status_bar),
+                     self.extract_exefs_callback)
 
     def extract_romfs(self):
         """Extract the RomFS contents of the open ROM."""
-        coro = self.rom.extract_romfs(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.extract_romfs_callback)
+        self.run_job('extract_romfs', functools.partial(self.rom.extract_romfs, self.status_bar),
+                     self.extract_romfs_callback)
 
     def rebuild_all(self):
         """Rebuild the open ROM."""
-        coro = self.rom.rebuild(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('rebuild_all', functools.partial(self.rom.rebuild_all, self.status_bar), self.info_callback)
 
     def rebuild_cci(self):
         """Rebuild the NCSD contents of the open ROM."""
-        coro = self.rom.rebuild_cci(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('rebuild_cci', functools.partial(self.rom.rebuild_cci, self.status_bar), self.info_callback)
 
     def rebuild_cxi(self):
         """Rebuild the NCCH contents of the open ROM."""
-        coro = self.rom.rebuild_cxi(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('rebuild_cxi', functools.partial(self.rom.rebuild_cxi, self.status_bar), self.info_callback)
 
     def rebuild_exefs(self):
         """Rebuild the ExeFS contents of the open ROM."""
-        coro = self.rom.rebuild_exefs(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('rebuild_exefs', functools.partial(self.rom.rebuild_exefs, self.status_bar), self.info_callback)
 
     def rebuild_romfs(self):
         """Rebuild the RomFS contents of the open ROM."""
-        coro = self.rom.rebuild_romfs(self.status_bar)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('rebuild_romfs', functools.partial(self.rom.rebuild_romfs, self.status_bar), self.info_callback)
 
     def convert_cia(self):
         """Convert the open ROM to the CIA format."""
@@ -542,15 +885,459 @@ class MainWindow(QMainWindow):
         if dirname:
             print(dirname)
             self.rom.working_dir = Path(dirname)
-            coro = self.rom.convert_cia(self.status_bar)
-            future = asyncio.ensure_future(coro)
-            future.add_done_callback(self.info_callback)
+            self.run_job('convert_cia', functools.partial(self.rom.convert_cia, self.status_bar), self.info_callback)
 
     def fix_header_crc(self):
         """Fix the open ROM's header CRC."""
-        coro = self.ndstool.fix_header_crc(self.rom)
-        future = asyncio.ensure_future(coro)
-        future.add_done_callback(self.info_callback)
+        self.run_job('fix_header_crc', functools.partial(self.rom.fix_header_crc, self.status_bar), self.info_callback)
+
+    def restore(self):
+        """Restore the open ROM to the state before the last change."""
+        self.run_job('restore', functools.partial(self.rom.restore, self.status_bar), self.info_callback)
+
+    def verify(self):
+        """Check the open ROM's hashes against a DAT file."""
+        filename, accepted = QFileDialog().getOpenFileName(self, 'Open DAT', str(self.rom.working_dir),
+                                                           'DAT files (*.dat *.xml)')
+
+        if accepted:
+            self.run_job('verify', functools.partial(self.verify_dat, Path(filename)), self.verify_callback)
+
+    async def verify_dat(self, path):
+        """Load a DAT file and verify the open ROM against it."""
+        self.status_bar.showMessage('Loading DAT...')
+        loop = asyncio.get_event_loop()
+        dat = await loop.run_in_executor(None, DatIndex.load, path)
+        await self.rom.verify(dat, self.status_bar)
+
+
+class LibraryModel(QAbstractTableModel):
+    """Table of the library, each row is read from the metadata cache only once the view shows it."""
+
+    COLUMNS = (
+        ('Title', 'title'),
+        ('Product Code', 'product_code'),
+        ('Maker Code', 'maker_code'),
+        ('Size', 'size'),
+        ('Path', 'path'),
+    )
+
+    def __init__(self, library, parent=None, icon_cache_size=512):
+        """Wrap a Library, keeping the icons of the latest rows shown."""
+        super(LibraryModel, self).__init__(parent)
+        self.library = library
+        self.icons = OrderedDict()
+        self.icon_cache_size = icon_cache_size
+
+    def rowCount(self, parent=QModelIndex()):
+        """Count the ROMs matching the filter, without reading any of them."""
+        return 0 if parent.isValid() else len(self.library)
+
+    def columnCount(self, parent=QModelIndex()):
+        """Return the number of columns."""
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def entry(self, row):
+        """Return the library entry of a row, None if the cache changed since the last refresh."""
+        try:
+            return self.library[row]
+        except IndexError:
+            return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        """Return the text, icon, tooltip or alignment of a cell."""
+        entry = self.entry(index.row()) if index.isValid() else None
+        if entry is None:
+            return None
+        field = self.COLUMNS[index.column()][1]
+        if role == Qt.DisplayRole:
+            if field == 'size':
+                return humanize.naturalsize(entry.size, gnu=True)
+            return str(getattr(entry, field))
+        if role == Qt.DecorationRole and field == 'title':
+            return self.icon(entry.icon_digest)
+        if role == Qt.ToolTipRole and field == 'title':
+            return entry.banner_title or None
+        if role == Qt.TextAlignmentRole and field == 'size':
+            return Qt.AlignRight | Qt.AlignVCenter
+        return None
+
+    def icon(self, digest):
+        """Load the thumbnail of an icon digest, if it has been cached."""
+        if digest is None:
+            return None
+        if digest in self.icons:
+            self.icons.move_to_end(digest)
+            return self.icons[digest]
+        path = Rom.thumbnails.path(digest)
+        icon = QPixmap(str(path)).scaled(LIBRARY_ICON_SIZE, LIBRARY_ICON_SIZE) if path.exists() else None
+        self.icons[digest] = icon
+        if len(self.icons) > self.icon_cache_size:
+            self.icons.popitem(last=False)
+        return icon
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        """Return the column titles."""
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.COLUMNS[section][0]
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sort the library in the metadata cache, the view then reads the rows it shows again."""
+        self.beginResetModel()
+        self.library.sort(self.COLUMNS[column][1], order == Qt.DescendingOrder)
+        self.endResetModel()
+
+    def set_filter(self, text, min_size=None, max_size=None):
+        """Filter the library on its title, product code, maker code and size."""
+        self.beginResetModel()
+        self.library.filter(text, min_size, max_size)
+        self.endResetModel()
+
+    def refresh(self):
+        """Read the rows again after the metadata cache changed."""
+        self.beginResetModel()
+        self.library.invalidate()
+        self.endResetModel()
+
+
+class LibraryWindow(QMainWindow):
+    """Browse, sort and filter every ROM of the library folders, and process the selected ones."""
+
+    def __init__(self, main_window):
+        """Create the filter fields, the ROM table and the library menus."""
+        super(LibraryWindow, self).__init__(main_window)
+        self.setWindowTitle('Library')
+        self.main_window = main_window
+
+        self.library = Library()
+        self.library.load_roots()
+        self.model = LibraryModel(self.library, self)
+
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText('Title, product code or maker code')
+        self.min_size = QSpinBox()
+        self.max_size = QSpinBox()
+        for spin_box in (self.min_size, self.max_size):
+            spin_box.setRange(0, 1 << 16)
+            spin_box.setSuffix(' MiB')
+            spin_box.setSpecialValueText('Any')
+
+        # Wait for a pause in typing instead of querying the cache on every key
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(250)
+        self.filter_timer.timeout.connect(self.apply_filter)
+        self.filter_edit.textChanged.connect(self.filter_timer.start)
+        self.min_size.valueChanged.connect(self.filter_timer.start)
+        self.max_size.valueChanged.connect(self.filter_timer.start)
+
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setWordWrap(False)
+        self.table.setIconSize(QSize(LIBRARY_ICON_SIZE, LIBRARY_ICON_SIZE))
+        # Fixed row heights, so the view never measures the rows it doesn't show
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(LIBRARY_ICON_SIZE + 4)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(0, Qt.AscendingOrder)
+        self.table.doubleClicked.connect(self.open_rom)
+
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(QLabel('Filter'))
+        filter_layout.addWidget(self.filter_edit)
+        filter_layout.addWidget(QLabel('Size'))
+        filter_layout.addWidget(self.min_size)
+        filter_layout.addWidget(QLabel('to'))
+        filter_layout.addWidget(self.max_size)
+
+        layout = QVBoxLayout()
+        layout.addLayout(filter_layout)
+        layout.addWidget(self.table)
+
+        widget = QWidget()
+        widget.setLayout(layout)
+        self.setCentralWidget(widget)
+
+        self.status_bar = self.statusBar()
+        self.status_bar.showMessage('Ready')
+
+        # New rows are shown every few seconds while the library is scanned
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.setInterval(2000)
+        self.refresh_timer.timeout.connect(self.refresh_rows)
+
+        # Changed ROMs are analyzed once they have been left alone for a while
+        self.changes = Changes()
+        self.changes_timer = QTimer(self)
+        self.changes_timer.setSingleShot(True)
+        self.changes_timer.timeout.connect(self.update_changes)
+        self.watcher = None
+        self.watcher_notifier = None
+        self.directory_watcher = None
+
+        self.library_menu()
+        self.selection_menu()
+        self.resize(900, 600)
+        self.watch()
+
+    def library_menu(self):
+        """Create a library submenu to manage the library folders and scan them."""
+        self.library_sub_menu = self.menuBar().addMenu('Library')
+
+        self.add_folder_action = QAction('Add Folder...', self)
+        self.add_folder_action.setStatusTip('Add a folder, and every ROM under it, to the library.')
+        self.add_folder_action.triggered.connect(self.add_folder)
+
+        self.remove_folder_action = QAction('Remove Folder...', self)
+        self.remove_folder_action.setStatusTip('Remove a folder from the library.')
+        self.remove_folder_action.triggered.connect(self.remove_folder)
+
+        self.scan_action = QAction('Scan', self)
+        self.scan_action.setStatusTip('Analyze the ROMs of the library folders that are not known yet.')
+        self.scan_action.setShortcut('F5')
+        self.scan_action.triggered.connect(self.scan)
+
+        self.library_sub_menu.addAction(self.add_folder_action)
+        self.library_sub_menu.addAction(self.remove_folder_action)
+        self.library_sub_menu.addAction(self.scan_action)
+
+    def selection_menu(self):
+        """Create a selection submenu with the actions run on every selected ROM."""
+        self.selection_sub_menu = self.menuBar().addMenu('Selection')
+
+        self.open_rom_action = QAction('Open', self)
+        self.open_rom_action.setStatusTip('Open the current ROM in the main window.')
+        self.open_rom_action.triggered.connect(self.open_rom)
+        self.selection_sub_menu.addAction(self.open_rom_action)
+
+        for operation, text, tip in (
+                ('extract_all', 'Extract All', 'Extract every selected ROM next to it.'),
+                ('trim', 'Trim', 'Trim every selected ROM.'),
+                ('fix_header_crc', 'Fix Header CRC', 'Fix the header CRC of every selected NDS ROM.'),
+                ('backup', 'Backup', 'Back up every selected ROM.'),
+        ):
+            action = QAction(text, self)
+            action.setStatusTip(tip)
+            action.triggered.connect(functools.partial(self.run_batch, operation))
+            self.selection_sub_menu.addAction(action)
+
+    def add_folder(self):
+        """Add a folder to the library and scan it."""
+        dirname = QFileDialog().getExistingDirectory(self, 'Add Folder', str(Path.home()))
+
+        if dirname:
+            self.library.add_root(dirname)
+            self.model.refresh()
+            self.scan()
+            self.watch()
+
+    def remove_folder(self):
+        """Remove one of the library folders."""
+        roots = [str(root) for root in self.library.roots]
+        root, accepted = QInputDialog.getItem(self, 'Remove Folder', 'Folder', roots, 0, False)
+
+        if accepted and root:
+            self.library.remove_root(root)
+            self.model.refresh()
+            self.watch()
+
+    def apply_filter(self):
+        """Filter the table with the entered text and sizes."""
+        min_size, max_size = (spin_box.value() << 20 or None for spin_box in (self.min_size, self.max_size))
+        self.model.set_filter(self.filter_edit.text(), min_size, max_size)
+
+    def scan(self):
+        """Analyze the ROMs of the library folders in the background, showing them as they come."""
+        function = functools.partial(Rom.run_with_progress, self.status_bar, 'Scanning...', self.library.populate)
+        self.main_window.job_queue.submit('Scan Library', function, self.library.roots, (), self.scan_callback)
+        self.refresh_timer.start()
+
+    def scan_callback(self, future):
+        """Show every ROM once the scan is over."""
+        self.refresh_timer.stop()
+        self.model.refresh()
+        if failed(future):
+            self.status_bar.showMessage('Error')
+        elif future.result():
+            self.status_bar.showMessage(f'{future.result()} ROMs could not be read')
+        else:
+            self.status_bar.showMessage('Ready')
+
+    def watch(self):
+        """Watch the library folders in the background, so that only the ROMs that change are analyzed again."""
+        self.stop_watching()
+        if self.library.roots:
+            function = functools.partial(self.start_watcher, list(self.library.roots))
+            self.main_window.job_queue.submit('Watch Library', function, self.library.roots, (), self.watch_callback)
+
+    async def start_watcher(self, roots):
+        """Watch every directory under the roots with inotify, or list them for a QFileSystemWatcher."""
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, LibraryWatcher, roots, self.changes)
+        except OSError as e:
+            if e.errno != errno.ENOSYS:
+                raise
+            return await loop.run_in_executor(None, directories, roots)
+
+    def watch_callback(self, future):
+        """Start listening to the watcher that was set up."""
+        if failed(future):
+            reason = 'cancelled' if future.cancelled() else future.exception()
+            self.status_bar.showMessage(f'Not watching the library: {reason}')
+            return
+        self.stop_watching()
+        watcher = future.result()
+        if isinstance(watcher, LibraryWatcher):
+            self.watcher = watcher
+            self.watcher_notifier = QSocketNotifier(watcher.fileno(), QSocketNotifier.Read, self)
+            self.watcher_notifier.activated.connect(self.watcher_ready)
+        else:
+            self.directory_watcher = QFileSystemWatcher(watcher, self)
+            self.directory_watcher.directoryChanged.connect(self.directory_changed)
+
+    def stop_watching(self):
+        """Stop watching the library folders."""
+        if self.watcher_notifier is not None:
+            self.watcher_notifier.setEnabled(False)
+            self.watcher_notifier = None
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.directory_watcher is not None:
+            self.directory_watcher.deleteLater()
+            self.directory_watcher = None
+
+    def watcher_ready(self):
+        """Queue the ROMs inotify reported, scanning everything only if the kernel dropped events."""
+        if self.watcher.process():
+            self.scan()
+        self.schedule_changes()
+
+    def directory_changed(self, directory):
+        """Queue the ROMs of a directory QFileSystemWatcher reported, and watch its new subdirectories."""
+        present, vanished = self.library.directory_changes(directory)
+        for path in present:
+            self.changes.add(path)
+        for path in vanished:
+            self.changes.add(path, deleted=True)
+
+        watched = set(self.directory_watcher.directories())
+        new = [path for path in directories([directory]) if path not in watched]
+        if new:
+            self.directory_watcher.addPaths(new)
+            for path in new:
+                self.directory_changed(path)
+        self.schedule_changes()
+
+    def schedule_changes(self):
+        """Wake up once the oldest queued change has been left alone long enough."""
+        deadline = self.changes.next_deadline()
+        if deadline is not None and not self.changes_timer.isActive():
+            self.changes_timer.start(int(deadline * 1000))
+
+    def update_changes(self):
+        """Analyze the changed ROMs and forget the deleted ones in the background."""
+        changed, deleted = self.changes.ready()
+        if changed or deleted:
+            function = functools.partial(Rom.run_with_progress, self.status_bar, 'Updating...', self.library.apply,
+                                         changed, deleted)
+            self.main_window.job_queue.submit('Update Library', function, changed + deleted, (), self.scan_callback)
+        self.schedule_changes()
+
+    def refresh_rows(self):
+        """Show the ROMs analyzed since the last refresh, if there are any."""
+        count = len(self.library)
+        self.library.invalidate()
+        if len(self.library) != count:
+            self.model.refresh()
+
+    def selected_entries(self):
+        """Return the library entries of the selected rows."""
+        rows = sorted({index.row() for index in self.table.selectionModel().selectedRows()})
+        return [entry for entry in map(self.model.entry, rows) if entry is not None]
+
+    def open_rom(self):
+        """Open the current ROM in the main window."""
+        entry = self.model.entry(self.table.currentIndex().row())
+        if entry is not None:
+            self.main_window.open_path(entry.path)
+            self.main_window.raise_()
+
+    def run_batch(self, operation):
+        """Queue an operation on every selected ROM that supports it, analyzing each one again afterwards."""
+        for entry in self.selected_entries():
+            rom = open_rom(entry.path)
+            if not hasattr(rom, operation):
+                continue
+
+            async def run(rom=rom):
+                await getattr(rom, operation)(self.status_bar)
+                await rom.info(self.status_bar)
+
+            self.main_window.run_job(operation, run, self.batch_callback, rom)
+
+    def batch_callback(self, future):
+        """Show the new state of a processed ROM."""
+        self.model.refresh()
+        self.status_bar.showMessage('Error' if failed(future) else 'Ready')
+
+
+class ExtractSelectedDialog(QDialog):
+    """Ask for the include and exclude patterns, or the list of files, to extract."""
+
+    def __init__(self, parent=None):
+        """Display the pattern fields and a file list picker."""
+        super(ExtractSelectedDialog, self).__init__(parent)
+
+        self.setWindowTitle('Extract Selected')
+
+        self.include = QLineEdit()
+        self.include.setPlaceholderText('*.msg text/*')
+        self.exclude = QLineEdit()
+        self.exclude.setPlaceholderText('*.bcstm')
+        self.file_list = QLineEdit()
+        self.file_list.setPlaceholderText('One path per line')
+
+        browse_button = QPushButton('Browse...')
+        browse_button.clicked.connect(self.browse)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        grid_layout = QGridLayout()
+        grid_layout.addWidget(QLabel('Include'), 0, 0)
+        grid_layout.addWidget(self.include, 0, 1, 1, 2)
+        grid_layout.addWidget(QLabel('Exclude'), 1, 0)
+        grid_layout.addWidget(self.exclude, 1, 1, 1, 2)
+        grid_layout.addWidget(QLabel('File List'), 2, 0)
+        grid_layout.addWidget(self.file_list, 2, 1)
+        grid_layout.addWidget(browse_button, 2, 2)
+
+        self.layout = QVBoxLayout()
+        self.layout.addLayout(grid_layout)
+        self.layout.addWidget(buttons)
+
+        self.setLayout(self.layout)
+
+    def browse(self):
+        """Pick a text file listing the paths to extract."""
+        filename, accepted = QFileDialog().getOpenFileName(self, 'Open File List', str(Path.home()),
+                                                           'Text files (*.txt);;All files (*)')
+
+        if accepted:
+            self.file_list.setText(filename)
+
+    def path_filter(self):
+        """Build the predicate matching the entered patterns and listed paths."""
+        paths = Path(self.file_list.text()).read_text().splitlines() if self.file_list.text() else ()
+        return path_filter(self.include.text().split(), self.exclude.text().split(), paths)
 
 
 class AboutDialog(QDialog):
@@ -581,16 +1368,18 @@ class AboutDialog(QDialog):
         self.setLayout(self.layout)
 
 
-if __name__ == '__main__':
-    sys._excepthook = sys.excepthook
+def main():
+    """Start the application and its asyncio event loop."""
+    # Only the GUI needs quamash, keep it out of the import of this module
+    from quamash import QEventLoop
 
+    sys._excepthook = sys.excepthook
 
     def excepthook(error, value, traceback):
         print(error, value, traceback)
         sys._excepthook(error, value, traceback)
         sys.exit(1)
 
-
     sys.excepthook = excepthook
 
     application = QApplication(sys.argv)
@@ -607,3 +1396,7 @@ if __name__ == '__main__':
 
     with loop:
         loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import json
+import os
+from pathlib import Path
+
+
+def fingerprint(paths, base):
+    """Map every file under paths, relative to base, to its (size, mtime) pair."""
+    files = {}
+    stack = []
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            stack.append(str(path))
+        elif path.is_file():
+            stat = path.stat()
+            files[os.path.relpath(path, base)] = [stat.st_size, stat.st_mtime_ns]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    stat = entry.stat()
+                    files[os.path.relpath(entry.path, base)] = [stat.st_size, stat.st_mtime_ns]
+    return files
+
+
+class BuildManifest:
+    """Record the inputs of each build layer so that unchanged layers can be skipped on rebuild."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            self.layers = json.loads(self.path.read_text())
+        except (OSError, ValueError):
+            self.layers = {}
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        tmp.write_text(json.dumps(self.layers, indent=1, sort_keys=True))
+        os.replace(tmp, self.path)
+
+    def is_dirty(self, layer, paths):
+        if layer not in self.layers:
+            return True
+        return fingerprint(paths, self.path.parent) != self.layers[layer]
+
+    def record(self, layer, paths):
+        self.layers[layer] = fingerprint(paths, self.path.parent)
+        self.save()
@@ -0,0 +1,522 @@
+import mmap
+import os
+import struct
+
+from qtxds.crc import crc16
+from qtxds.files import assemble, copy_range, copy_ranges, safe_join
+
+HEADER_SIZE = 0x200
+HEADER_CRC_OFFSET = 0x15E
+LOGO_OFFSET = 0xC0
+LOGO_CRC_OFFSET = 0x15C
+SECURE_AREA_OFFSET = 0x4000
+SECURE_AREA_SIZE = 0x4000
+SECURE_AREA_DECRYPTED = b'\xff\xde\xff\xe7\xff\xde\xff\xe7'
+TWL_USED_ROM_SIZE_OFFSET = 0x210
+RSA_SIGNATURE_SIZE = 0x88
+NITROCODE = 0xDEC00621
+NITROCODE_FOOTER_SIZE = 12
+OVERLAY_ENTRY_SIZE = 0x20
+ROOT_DIRECTORY = 0xF000
+ALIGNMENT = 0x200
+DEVICE_CAPACITY_OFFSET = 0x14
+MIN_DEVICE_CAPACITY = 0x20000
+BANNER_SIZES = {
+    0x0001: 0x840,
+    0x0002: 0x940,
+    0x0003: 0xA40,
+    0x0103: 0x23C0,
+}
+# (minimum banner version, CRC offset, start, end of the area it covers), relative to the banner
+BANNER_CRCS = (
+    (0x0001, 0x02, 0x0020, 0x0840),
+    (0x0002, 0x04, 0x0020, 0x0940),
+    (0x0003, 0x06, 0x0020, 0x0A40),
+    (0x0103, 0x08, 0x1240, 0x23C0),
+)
+
+REGIONS = {
+    'J': 'JPN',
+    'E': 'USA',
+    'P': 'EUR',
+    'D': 'NOE',
+    'F': 'NOE',
+    'I': 'ITA',
+    'S': 'SPA',
+    'H': 'HOL',
+    'K': 'KOR',
+    'X': 'EUU',
+}
+
+
+class NdsHeader:
+    def __init__(self, data):
+        if len(data) < HEADER_SIZE:
+            raise ValueError('Truncated NDS header')
+
+        self.raw = bytes(data[:HEADER_SIZE])
+
+        self.title = self._string(0x00, 12)
+        self.game_code = self._string(0x0C, 4)
+        self.maker_code = self._string(0x10, 2)
+        self.unit_code = self.raw[0x12]
+        (self.arm9_rom_offset, self.arm9_entry_address, self.arm9_ram_address, self.arm9_size,
+         self.arm7_rom_offset, self.arm7_entry_address, self.arm7_ram_address, self.arm7_size,
+         self.fnt_offset, self.fnt_size, self.fat_offset, self.fat_size,
+         self.overlay9_offset, self.overlay9_size, self.overlay7_offset, self.overlay7_size) = \
+            struct.unpack_from('<16I', self.raw, 0x20)
+        self.banner_offset, self.secure_area_crc = struct.unpack_from('<IH', self.raw, 0x68)
+        self.used_rom_size, self.header_size = struct.unpack_from('<II', self.raw, 0x80)
+        self.logo_crc, self.header_crc = struct.unpack_from('<HH', self.raw, 0x15C)
+
+    def _string(self, offset, length):
+        return self.raw[offset:offset + length].split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+
+    @property
+    def region(self):
+        return REGIONS.get(self.game_code[3:4], '???')
+
+    @property
+    def product_code(self):
+        return f'NTR-{self.game_code}-{self.region}'
+
+    @property
+    def is_header_crc_ok(self):
+        return crc16(self.raw[:HEADER_CRC_OFFSET]) == self.header_crc
+
+    @property
+    def is_logo_crc_ok(self):
+        return crc16(self.raw[LOGO_OFFSET:LOGO_CRC_OFFSET]) == self.logo_crc
+
+    @property
+    def is_dsi(self):
+        return bool(self.unit_code & 0x02)
+
+
+class NdsImage:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError(f'Empty NDS ROM: {path}')
+        try:
+            self.header = NdsHeader(self.data[:HEADER_SIZE])
+        except ValueError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+    def _check(self, offset, size):
+        """Refuse a table or entry that ends past the ROM, corrupt ROMs must not read out of bounds."""
+        if offset + size > len(self.data):
+            raise ValueError('Invalid NDS image')
+
+    @property
+    def has_secure_area(self):
+        return self.header.arm9_rom_offset >= SECURE_AREA_OFFSET + SECURE_AREA_SIZE
+
+    @property
+    def is_secure_area_decrypted(self):
+        return self.data[SECURE_AREA_OFFSET:SECURE_AREA_OFFSET + 8] == SECURE_AREA_DECRYPTED
+
+    @property
+    def is_secure_area_crc_ok(self):
+        # Only meaningful for an encrypted secure area: the stored CRC covers the encrypted bytes.
+        secure_area = self.data[SECURE_AREA_OFFSET:SECURE_AREA_OFFSET + SECURE_AREA_SIZE]
+        return crc16(secure_area) == self.header.secure_area_crc
+
+    @property
+    def is_banner_crc_ok(self):
+        """Check the CRC of every banner area its version has, None without a banner."""
+        offset = self.header.banner_offset
+        if not offset or offset + 0x20 > len(self.data):
+            return None
+        version = struct.unpack_from('<H', self.data, offset)[0]
+        if version not in BANNER_SIZES:
+            return False
+        for minimum, crc_offset, start, end in BANNER_CRCS:
+            if version >= minimum:
+                if offset + end > len(self.data):
+                    return False
+                if crc16(self.data[offset + start:offset + end]) != struct.unpack_from('<H', self.data,
+                                                                                        offset + crc_offset)[0]:
+                    return False
+        return True
+
+    def check_crcs(self):
+        """Check every CRC of the ROM against the mapped data.
+
+        The secure area CRC is None when the secure area is decrypted, the stored CRC covers the encrypted bytes.
+        """
+        return {
+            'header': self.header.is_header_crc_ok,
+            'logo': self.header.is_logo_crc_ok,
+            'secure_area': None if not self.has_secure_area or self.is_secure_area_decrypted
+            else self.is_secure_area_crc_ok,
+            'banner': self.is_banner_crc_ok,
+        }
+
+    @property
+    def banner_size(self):
+        offset = self.header.banner_offset
+        if not offset or offset + 2 > len(self.data):
+            return 0
+        version = struct.unpack_from('<H', self.data, offset)[0]
+        return BANNER_SIZES.get(version, BANNER_SIZES[0x0001])
+
+    def banner(self):
+        offset = self.header.banner_offset
+        return self.data[offset:offset + self.banner_size] if self.banner_size else b''
+
+    def sections(self):
+        """Map the sections ndstool extracts next to the data tree to their (offset, size)."""
+        header = self.header
+        arm9_size = header.arm9_size
+        # ndstool keeps the nitrocode footer that follows some ARM9 binaries
+        footer = header.arm9_rom_offset + arm9_size
+        if self.data[footer:footer + 4] == struct.pack('<I', NITROCODE):
+            arm9_size += NITROCODE_FOOTER_SIZE
+        return {
+            'arm9': (header.arm9_rom_offset, arm9_size),
+            'arm7': (header.arm7_rom_offset, header.arm7_size),
+            'overlay9': (header.overlay9_offset, header.overlay9_size),
+            'overlay7': (header.overlay7_offset, header.overlay7_size),
+            'banner': (header.banner_offset, self.banner_size),
+            'header': (0, header.header_size if header.is_dsi else HEADER_SIZE),
+        }
+
+    def overlays(self):
+        """Yield the FAT id of every ARM9 then ARM7 overlay file."""
+        for offset, size in ((self.header.overlay9_offset, self.header.overlay9_size),
+                             (self.header.overlay7_offset, self.header.overlay7_size)):
+            self._check(offset, size)
+            for entry in range(offset, offset + size - OVERLAY_ENTRY_SIZE + 1, OVERLAY_ENTRY_SIZE):
+                yield struct.unpack_from('<I', self.data, entry + 0x18)[0]
+
+    def fat(self):
+        offset = self.header.fat_offset
+        count = self.header.fat_size // 8
+        self._check(offset, count * 8)
+        return list(struct.iter_unpack('<II', self.data[offset:offset + count * 8]))
+
+    def file_location(self, file_id):
+        """(offset, size) of a file, checked against the FAT and the ROM size."""
+        count = self.header.fat_size // 8
+        if file_id >= count:
+            raise ValueError(f'Invalid FAT id: {file_id}')
+        self._check(self.header.fat_offset + file_id * 8, 8)
+        start, end = struct.unpack_from('<II', self.data, self.header.fat_offset + file_id * 8)
+        if not start <= end <= len(self.data):
+            raise ValueError(f'Invalid FAT entry {file_id}: {start:#x}-{end:#x}')
+        return start, end - start
+
+    def listdir(self, directory_id=ROOT_DIRECTORY):
+        """List one FNT directory as (name, is directory, directory or file id), reading only its subtable."""
+        base = self.header.fnt_offset
+        if not self.header.fnt_size:
+            return []
+        self._check(base, self.header.fnt_size)
+        end = base + self.header.fnt_size
+        if self.header.fnt_size < 8:
+            raise ValueError('Invalid NDS image')
+        directory_count = struct.unpack_from('<H', self.data, base + 6)[0]
+        index = directory_id & 0xFFF
+        if index >= directory_count or base + index * 8 + 8 > end:
+            raise ValueError(f'Invalid FNT directory id: {directory_id:#x}')
+        entry_offset, file_id = struct.unpack_from('<IH', self.data, base + index * 8)
+
+        entries = []
+        position = base + entry_offset
+        while True:
+            if position >= end:
+                raise ValueError('Invalid NDS image')
+            kind = self.data[position]
+            position += 1
+            if not kind:
+                break
+            length = kind & 0x7F
+            if position + length + (2 if kind & 0x80 else 0) > end:
+                raise ValueError('Invalid NDS image')
+            name = self.data[position:position + length].decode('ascii', 'replace')
+            position += length
+            if kind & 0x80:
+                entries.append((name, True, struct.unpack_from('<H', self.data, position)[0]))
+                position += 2
+            else:
+                entries.append((name, False, file_id))
+                file_id += 1
+        return entries
+
+    def files(self):
+        """Yield (file id, path) for every file in the FNT, in FNT order."""
+        stack = [(ROOT_DIRECTORY, '')]
+        seen = set()
+        while stack:
+            directory_id, prefix = stack.pop()
+            # A directory listed twice would make corrupt ROMs loop forever
+            if directory_id in seen:
+                raise ValueError('Invalid NDS image')
+            seen.add(directory_id)
+            subdirectories = []
+            for name, is_directory, entry_id in self.listdir(directory_id):
+                if is_directory:
+                    subdirectories.append((entry_id, prefix + name + '/'))
+                else:
+                    yield entry_id, prefix + name
+            stack.extend(reversed(subdirectories))
+
+    def read(self, file_id, size=None):
+        """Read a file, or only its first size bytes."""
+        offset, file_size = self.file_location(file_id)
+        return self.data[offset:offset + (file_size if size is None else min(size, file_size))]
+
+    def export(self, file_id, dst):
+        """Copy a single file out of the ROM without extracting anything else."""
+        offset, size = self.file_location(file_id)
+        return copy_range(self._file.fileno(), offset, size, dst)
+
+    @property
+    def content_size(self):
+        fat = self.fat()
+        size = 0
+        for file_id, _ in self.files():
+            if file_id >= len(fat):
+                raise ValueError('Invalid NDS image')
+            size += fat[file_id][1] - fat[file_id][0]
+        return size
+
+    @property
+    def trimmed_size(self):
+        """Size of the ROM without its padding, checked against the header and FAT."""
+        header = self.header
+        if not header.is_header_crc_ok:
+            raise ValueError('Invalid header CRC, refusing to trim')
+
+        size = header.used_rom_size
+        if header.is_dsi:
+            self._check(TWL_USED_ROM_SIZE_OFFSET, 4)
+            size = struct.unpack_from('<I', self.data, TWL_USED_ROM_SIZE_OFFSET)[0]
+        elif self.data[size:size + 2] == b'ac':
+            # Download play RSA signature, appended right after the used area
+            size += RSA_SIGNATURE_SIZE
+
+        fat_end = max((end for start, end in self.fat() if end > start), default=0)
+        if not HEADER_SIZE <= size <= len(self.data) or fat_end > size:
+            raise ValueError(f'Inconsistent used ROM size: {size:#x}')
+        return size
+
+
+def fix_header_crc(path):
+    """Rewrite the 2 bytes of the header CRC in place, return whether they needed fixing."""
+    with open(path, 'r+b', buffering=0) as f:
+        header = f.read(HEADER_CRC_OFFSET + 2)
+        if len(header) < HEADER_CRC_OFFSET + 2:
+            raise ValueError('Truncated NDS header')
+        crc = struct.pack('<H', crc16(header[:HEADER_CRC_OFFSET]))
+        if header[HEADER_CRC_OFFSET:] == crc:
+            return False
+        os.pwrite(f.fileno(), crc, HEADER_CRC_OFFSET)
+    return True
+
+
+def trim(path):
+    """Truncate an NDS ROM in place to its used size, return the number of bytes removed."""
+    with open(path, 'r+b') as f:
+        with NdsImage(path) as image:
+            size = image.trimmed_size
+            removed = len(image.data) - size
+        if removed:
+            f.truncate(size)
+    return removed
+
+
+def extract(path, targets, data_dir, overlay_dir, select=None, progress=None, cancelled=None, workers=None):
+    """Extract an NDS ROM the way ndstool -x lays it out, copying every file straight from the ROM.
+
+    targets maps the names returned by NdsImage.sections to their output paths, sections left out are skipped.
+    When select is given, only the data files whose path it accepts are extracted, along with no overlays.
+    Return the number of bytes extracted.
+    """
+    with NdsImage(path) as image:
+        # Group the copies by directory, each group is one task for the pool
+        groups = {}
+        sections = image.sections()
+        for name, target in targets.items():
+            offset, size = sections[name]
+            groups.setdefault(os.path.dirname(str(target)), []).append((str(target), offset, size))
+        if select is None:
+            for file_id in image.overlays():
+                groups.setdefault(str(overlay_dir), []).append(
+                    (os.path.join(str(overlay_dir), f'overlay_{file_id:04d}.bin'),) + image.file_location(file_id))
+        for file_id, name in image.files():
+            if select is not None and not select(name):
+                continue
+            target = safe_join(data_dir, name)
+            groups.setdefault(os.path.dirname(target), []).append((target,) + image.file_location(file_id))
+        os.makedirs(str(data_dir), exist_ok=True)
+
+    return copy_ranges(path, groups, progress, cancelled, workers)
+
+
+def _align(offset, alignment=ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def build_fnt(data_dir, first_file_id=0):
+    """Build the FNT of a data tree, return it with the paths of the files in FAT order.
+
+    Entries are sorted by name regardless of case, directories and files together. Directories are numbered
+    depth first, and the files of a directory come before those of its subdirectories. The files are numbered
+    from first_file_id, the FAT ids before it being the overlays'.
+    """
+    directories = []
+    stack = [(str(data_dir), None)]
+    while stack:
+        directory, parent = stack.pop()
+        number = len(directories)
+        entries = []
+        if os.path.isdir(directory):
+            with os.scandir(directory) as scan:
+                entries = sorted(((entry.name, entry.is_dir()) for entry in scan), key=lambda entry: entry[0].lower())
+        for name, _ in entries:
+            if not 0 < len(name) <= 0x7F or not name.isascii():
+                raise ValueError(f'Invalid file name for the FNT: {name!r}')
+        directories.append((directory, parent, entries, []))
+        if parent is not None:
+            directories[parent][3].append(number)
+        stack.extend(reversed([(os.path.join(directory, name), number) for name, is_directory in entries
+                               if is_directory]))
+    if len(directories) > 0x1000:
+        raise ValueError('Too many directories for the FNT')
+
+    files = []
+    tables = []
+    for directory, parent, entries, subdirectories in directories:
+        first_file = first_file_id + len(files)
+        children = iter(subdirectories)
+        table = b''
+        for name, is_directory in entries:
+            if is_directory:
+                table += bytes([0x80 | len(name)]) + name.encode() + struct.pack('<H', ROOT_DIRECTORY | next(children))
+            else:
+                table += bytes([len(name)]) + name.encode()
+                files.append(os.path.join(directory, name))
+        tables.append((first_file, parent, table + b'\0'))
+
+    main_table = b''
+    offset = len(tables) * 8
+    for first_file, parent, table in tables:
+        # The parent of the root is the number of directories
+        parent = len(tables) if parent is None else ROOT_DIRECTORY | parent
+        main_table += struct.pack('<IHH', offset, first_file, parent)
+        offset += len(table)
+    return main_table + b''.join(table for _, _, table in tables), files
+
+
+def build(path, sources, data_dir, overlay_dir, progress=None, cancelled=None, workers=None):
+    """Build an NDS ROM out of an ndstool -x layout, the way ndstool -c lays it out.
+
+    sources maps the names returned by NdsImage.sections to the extracted files. Every section and file is
+    aligned to 0x200 bytes and copied straight into the preallocated ROM, the header is patched with the new
+    offsets, sizes and device capacity and its CRCs recomputed. Return the size of the ROM.
+    """
+    with open(sources['header'], 'rb') as f:
+        header = bytearray(f.read(HEADER_SIZE))
+    if NdsHeader(header).is_dsi:
+        raise ValueError('DSi headers are not supported')
+
+    regions = []
+    writes = []
+    position = SECURE_AREA_OFFSET if NdsHeader(header).arm9_rom_offset >= SECURE_AREA_OFFSET else HEADER_SIZE
+
+    def place(src, size):
+        nonlocal position
+        offset = _align(position)
+        # The FNT and FAT only reserve their space, they are written along with the header
+        if src is not None and size:
+            regions.append((src, offset, size))
+        position = offset + size
+        return offset
+
+    def place_overlays(table_path, overlays):
+        table = b''
+        if os.path.isfile(table_path):
+            with open(table_path, 'rb') as f:
+                table = f.read()
+        offset = place(table_path, len(table)) if table else 0
+        for entry in range(0, len(table) - OVERLAY_ENTRY_SIZE + 1, OVERLAY_ENTRY_SIZE):
+            file_id = struct.unpack_from('<I', table, entry + 0x18)[0]
+            overlay = os.path.join(str(overlay_dir), f'overlay_{file_id:04d}.bin')
+            size = os.path.getsize(overlay)
+            overlays[file_id] = (place(overlay, size), size)
+        return offset, len(table)
+
+    overlays = {}
+    arm9_size = os.path.getsize(sources['arm9'])
+    arm9_offset = place(sources['arm9'], arm9_size)
+    # The nitrocode footer ndstool extracts along with the ARM9 binary is not part of its size
+    with open(sources['arm9'], 'rb') as f:
+        f.seek(max(0, arm9_size - NITROCODE_FOOTER_SIZE))
+        if arm9_size >= NITROCODE_FOOTER_SIZE and f.read(4) == struct.pack('<I', NITROCODE):
+            arm9_size -= NITROCODE_FOOTER_SIZE
+    overlay9 = place_overlays(sources['overlay9'], overlays)
+    arm7_size = os.path.getsize(sources['arm7'])
+    arm7_offset = place(sources['arm7'], arm7_size)
+    overlay7 = place_overlays(sources['overlay7'], overlays)
+    if sorted(overlays) != list(range(len(overlays))):
+        raise ValueError('The overlay ids are not the first FAT ids')
+
+    fnt, files = build_fnt(data_dir, len(overlays))
+    fnt_offset = place(None, len(fnt))
+    writes.append((fnt, fnt_offset))
+    fat_size = (len(overlays) + len(files)) * 8
+    fat_offset = place(None, fat_size)
+    banner_size = _file_size(sources['banner'])
+    banner_offset = place(sources['banner'], banner_size) if banner_size else 0
+
+    fat = bytearray(fat_size)
+    for file_id, (offset, size) in overlays.items():
+        struct.pack_into('<II', fat, file_id * 8, offset, offset + size)
+    for file_id, name in enumerate(files, len(overlays)):
+        size = os.path.getsize(name)
+        offset = place(name, size)
+        struct.pack_into('<II', fat, file_id * 8, offset, offset + size)
+    writes.append((bytes(fat), fat_offset))
+
+    size = position
+    capacity = 0
+    while MIN_DEVICE_CAPACITY << capacity < size:
+        capacity += 1
+    header[DEVICE_CAPACITY_OFFSET] = capacity
+    struct.pack_into('<I', header, 0x20, arm9_offset)
+    struct.pack_into('<I', header, 0x2C, arm9_size)
+    struct.pack_into('<I', header, 0x30, arm7_offset)
+    struct.pack_into('<I', header, 0x3C, arm7_size)
+    struct.pack_into('<8I', header, 0x40, fnt_offset, len(fnt), fat_offset, fat_size, *overlay9, *overlay7)
+    struct.pack_into('<I', header, 0x68, banner_offset)
+    struct.pack_into('<I', header, 0x80, size)
+    struct.pack_into('<H', header, LOGO_CRC_OFFSET, crc16(header[LOGO_OFFSET:LOGO_CRC_OFFSET]))
+    struct.pack_into('<H', header, HEADER_CRC_OFFSET, crc16(header[:HEADER_CRC_OFFSET]))
+    writes.append((bytes(header), 0))
+
+    assemble(path, size, regions, writes, progress, cancelled, workers)
+    return size
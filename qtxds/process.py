@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import contextvars
+import os
+import shutil
+import signal
+import subprocess
+import sys
+
+from qtxds import telemetry
+
+# ionice scheduling classes
+IO_REALTIME = 1
+IO_BEST_EFFORT = 2
+IO_IDLE = 3
+
+KILL_GRACE_PERIOD = 5
+STDERR_LINES = 20
+
+
+class ToolError(OSError):
+    def __init__(self, message, returncode=None, stderr=''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+class Priority:
+    """CPU and I/O scheduling settings applied to a child process."""
+
+    def __init__(self, nice=0, io_class=None, io_level=None, cpus=None):
+        self.nice = nice
+        self.io_class = io_class
+        self.io_level = io_level
+        self.cpus = cpus
+
+    def wrap(self, cmd):
+        # There is no ioprio_set binding in the standard library, go through ionice instead
+        if self.io_class is None or not sys.platform.startswith('linux'):
+            return cmd
+        ionice = shutil.which('ionice')
+        if not ionice:
+            return cmd
+        wrapper = [ionice, '-c', str(self.io_class)]
+        if self.io_level is not None and self.io_class != IO_IDLE:
+            wrapper += ['-n', str(self.io_level)]
+        return wrapper + cmd
+
+    def apply(self, pid):
+        try:
+            if self.nice and hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, pid, os.getpriority(os.PRIO_PROCESS, pid) + self.nice)
+            if self.cpus and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(pid, self.cpus)
+        except (OSError, ValueError):
+            # Scheduling is best effort, the child may even have exited already
+            pass
+
+
+INTERACTIVE = Priority()
+BACKGROUND = Priority(nice=10, io_class=IO_IDLE)
+
+_priority = contextvars.ContextVar('qtxds_process_priority', default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def prioritized(priority):
+    """Run the children spawned in this context, e.g. by a batch job, with the given priority."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _new_process_group():
+    if sys.platform == 'win32':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+def _signal_group(proc, sig):
+    try:
+        if sys.platform == 'win32':
+            proc.kill()
+        else:
+            os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+def _read(pipe):
+    with pipe:
+        return pipe.read()
+
+
+def _wait(proc):
+    """Reap the child and return the CPU time it and the children it waited for used.
+
+    asyncio's child watchers throw the resource usage of the children they reap away, which leaves only the
+    process-wide RUSAGE_CHILDREN, shared by every tool running at the same time.
+    """
+    if not hasattr(os, 'wait4'):
+        proc.wait()
+        return 0.0
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def _kill(proc, done):
+    """Terminate the whole process group, then kill it if it doesn't exit in time."""
+    if done.done():
+        return
+    _signal_group(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(asyncio.shield(done), KILL_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        _signal_group(proc, getattr(signal, 'SIGKILL', signal.SIGTERM))
+        await done
+
+
+async def run(cmd, timeout=None, priority=None, capture_output=False, encoding='utf8'):
+    """Run cmd in its own process group and return its standard output when captured.
+
+    The child and everything it spawned are killed when the call times out or is cancelled, and a ToolError
+    carrying the end of its standard error is raised when it fails. The CPU time of the child is charged to the
+    operation being recorded.
+    """
+    name = os.path.basename(str(cmd[0]))
+    priority = priority or _priority.get()
+    cmd = priority.wrap([str(arg) for arg in cmd])
+
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, **_new_process_group())
+    priority.apply(proc.pid)
+
+    # The pipes are drained and the child reaped on worker threads, to get its own resource usage
+    loop = asyncio.get_event_loop()
+    done = asyncio.gather(loop.run_in_executor(None, _wait, proc),
+                          loop.run_in_executor(None, _read, proc.stderr),
+                          loop.run_in_executor(None, _read, proc.stdout) if capture_output else asyncio.sleep(0))
+    try:
+        cpu, stderr, stdout = await asyncio.wait_for(asyncio.shield(done), timeout)
+    except asyncio.TimeoutError:
+        await _kill(proc, done)
+        raise ToolError(f'{name} timed out after {timeout} s')
+    except BaseException:
+        await asyncio.shield(_kill(proc, done))
+        raise
+    finally:
+        if done.done() and not done.cancelled() and done.exception() is None:
+            telemetry.count(subprocess_cpu_seconds=done.result()[0])
+
+    stderr = stderr.decode(encoding, 'replace')
+    if proc.returncode:
+        tail = '\n'.join(stderr.strip().splitlines()[-STDERR_LINES:])
+        raise ToolError(f'{name} exited with status {proc.returncode}: {tail}',
+                        proc.returncode, stderr)
+    return stdout.decode(encoding, 'replace') if capture_output else None
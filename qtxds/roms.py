@@ -1,11 +1,28 @@
-import os
+import asyncio
+import contextlib
+import contextvars
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from tools import NdsTool, CtrTool, ThreedsTool, ThreedsConv
+from qtxds.backups import BackupStore
+from qtxds.banner import Banner, ThumbnailCache
+from qtxds.cache import MetadataCache
+from qtxds.files import directory_sizer
+from qtxds.hashing import ALGORITHMS, hash_file
+from qtxds.nds import ROOT_DIRECTORY, NdsImage
+from qtxds.telemetry import COPIED, count, measure_cpu, telemetry
+from qtxds.threeds import ROMFS_ROOT_DIRECTORY, ThreedsImage
+from qtxds.tools import NdsTool, CtrTool, ThreedsTool, ThreedsConv
 
 
 class Rom:
+    cache = MetadataCache()
+    backup_store = BackupStore()
+    thumbnails = ThumbnailCache()
+    metadata_fields = ('title', 'maker_code', 'product_code', 'content_size', 'banner_title', 'icon_digest')
+
     def __init__(self, path):
         self.path = Path(path)
         self.working_dir = self.path.parent
@@ -13,18 +30,127 @@ class Rom:
         self.maker_code = ''
         self.product_code = ''
         self.content_size = 0
+        self.banner_title = ''
+        self.icon_digest = None
+        self.hashes = {}
+        self.dat_status = ''
+        self.dat_entry = None
 
     @property
     def extract_dir(self):
         return self.working_dir / self.path.stem
 
-    def backup(self, status_bar):
+    def resources(self, operation):
+        """Paths an operation reads and writes, so that conflicting jobs are never run together."""
+        if operation in ('info', 'verify', 'convert_cia', 'export_file'):
+            return {self.path}, set()
+        if operation in ('extract_all', 'extract_selected'):
+            return {self.path}, {self.extract_dir}
+        if operation == 'rebuild_all':
+            return {self.extract_dir}, {self.extract_dir, self.path}
+        return {self.path}, {self.path}
+
+    async def info(self, status_bar):
+        if not Rom.cache.load(self):
+            self.hashes, self.dat_status, self.dat_entry = {}, '', None
+            await self.analyze(status_bar)
+            Rom.cache.store(self)
+
+    async def analyze(self, status_bar):
+        raise NotImplementedError
+
+    @property
+    def thumbnail(self):
+        # Known from the metadata cache, showing it doesn't need the ROM at all
+        if self.icon_digest is None:
+            return None
+        return Rom.thumbnails.path(self.icon_digest)
+
+    def icon_frames(self):
+        return []
+
+    def file_system(self):
+        raise NotImplementedError
+
+    def listdir(self, directory_id):
+        # Reading one directory and a few of its entries is cheap enough for the UI thread
+        with self.file_system() as file_system:
+            return [(name, is_directory, entry_id) +
+                    ((None, None) if is_directory else file_system.file_location(entry_id))
+                    for name, is_directory, entry_id in file_system.listdir(directory_id)]
+
+    def read_file(self, file_id, size=None):
+        with self.file_system() as file_system:
+            return file_system.read(file_id, size)
+
+    async def export_file(self, status_bar, file_id, dst):
+        status_bar.showMessage('Exporting...')
+
+        def export():
+            with self.file_system() as file_system:
+                return file_system.export(file_id, dst)
+
+        loop = asyncio.get_event_loop()
+        with telemetry.record('Rom.export_file', self):
+            await loop.run_in_executor(None, export)
+
+    async def verify(self, dat, status_bar):
+        status_bar.showMessage('Verifying...')
+
+        loop = asyncio.get_event_loop()
+        with telemetry.record('Rom.verify', self), ThreadPoolExecutor(max_workers=len(ALGORITHMS)) as executor:
+            self.hashes = await loop.run_in_executor(None, contextvars.copy_context().run, measure_cpu,
+                                                     hash_file, self.path, ALGORITHMS, executor)
+            count(bytes_read=self.hashes['size'])
+        self.dat_status, self.dat_entry = dat.verify(self.path.name, self.hashes)
+
+    @staticmethod
+    async def run_with_progress(status_bar, message, function, *args, counters=()):
+        """Run function(*args, progress, cancelled) on the default executor, reporting its progress.
+
+        The bytes it reports as done are charged to the telemetry counters named in counters.
+        """
+        loop = asyncio.get_event_loop()
+        cancelled = threading.Event()
+        processed = 0
+
+        def progress(done, total):
+            nonlocal processed
+            processed = done
+            loop.call_soon_threadsafe(status_bar.showMessage, f'{message} {done * 100 // max(total, 1)}%')
+
+        try:
+            return await loop.run_in_executor(None, contextvars.copy_context().run, measure_cpu, function,
+                                              *args, progress, cancelled)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        finally:
+            count(**dict.fromkeys(counters, processed))
+
+    async def backup(self, status_bar):
         status_bar.showMessage('Backing up...')
 
-        src = self.path
-        dst = self.path.with_suffix(self.path.suffix + '.old')
-        if not dst.exists():
-            shutil.copyfile(src, dst)
+        # Only the snapshot is waited for, its chunks are stored in the background while the ROM is being changed
+        with telemetry.record('Rom.backup', self):
+            return await self.run_with_progress(status_bar, 'Backing up...', Rom.backup_store.snapshot, self.path,
+                                                counters=COPIED)
+
+    async def restore(self, status_bar, version=None):
+        if version is None:
+            # Keep the current state, then go back to the version before it
+            current = await asyncio.wrap_future(await self.backup(status_bar))
+            versions = [manifest['version'] for manifest in Rom.backup_store.versions(self.path)
+                        if manifest['version'] < current['version']]
+            if not versions:
+                raise FileNotFoundError(f'No earlier backup of {self.path}')
+            version = versions[-1]
+
+        status_bar.showMessage('Restoring...')
+
+        with telemetry.record('Rom.restore', self):
+            await self.run_with_progress(status_bar, 'Restoring...', Rom.backup_store.restore, self.path, version,
+                                         None, counters=('bytes_written',))
 
     def clean(self, status_bar):
         status_bar.showMessage('Cleaning...')
@@ -34,11 +160,16 @@ class Rom:
 
 class NdsRom(Rom):
     ndstool = NdsTool()
+    root_directory = ROOT_DIRECTORY
+    metadata_fields = Rom.metadata_fields + ('is_header_crc_ok', 'is_logo_crc_ok', 'is_banner_crc_ok',
+                                             'is_secure_area_crc_ok', 'is_decrypted')
 
     def __init__(self, path):
         super().__init__(path)
 
         self.is_header_crc_ok = True
+        self.is_logo_crc_ok = True
+        self.is_banner_crc_ok = None
         self.is_secure_area_crc_ok = True
         self.is_decrypted = True
 
@@ -51,38 +182,47 @@ class NdsRom(Rom):
         self.overlay_dir = self.extract_dir / 'overlay'
         self.header_bin = self.extract_dir / 'header.bin'
 
-    @staticmethod
-    def _directory_size(path):
-        size = 0
-        for root, dirnames, filenames in os.walk(path):
-            for filename in filenames:
-                size += Path(root, filename).stat().st_size
-        return size
-
     @property
     def size(self):
         return self.path.stat().st_size
 
     @property
     def data_size(self):
-        return self._directory_size(self.data_dir)
+        return directory_sizer.size(self.data_dir)
 
     @property
     def overlay_size(self):
-        return self._directory_size(self.overlay_dir)
+        return directory_sizer.size(self.overlay_dir)
 
-    async def info(self, status_bar):
+    async def directory_sizes(self):
+        loop = asyncio.get_event_loop()
+        return await asyncio.gather(loop.run_in_executor(None, directory_sizer.size, self.data_dir),
+                                    loop.run_in_executor(None, directory_sizer.size, self.overlay_dir))
+
+    async def analyze(self, status_bar):
         await NdsRom.ndstool.info(self, status_bar)
 
+    def file_system(self):
+        return NdsImage(self.path)
+
+    def icon_frames(self):
+        with NdsImage(self.path) as image:
+            data = image.banner()
+        return Banner(data).frames() if data else []
+
     async def extract_all(self, status_bar):
         await NdsRom.ndstool.extract_all(self, status_bar)
+        directory_sizer.invalidate(self.extract_dir)
+
+    async def extract_selected(self, status_bar, select):
+        await NdsRom.ndstool.extract_selected(self, status_bar, select)
+        directory_sizer.invalidate(self.extract_dir)
 
     async def rebuild_all(self, status_bar):
         await NdsRom.ndstool.rebuild_all(self, status_bar)
 
     async def trim(self, status_bar):
-        await NdsRom.ndstool.extract_all(self, status_bar)
-        await NdsRom.ndstool.rebuild_all(self, status_bar)
+        await NdsRom.ndstool.trim(self, status_bar)
 
     async def decrypt(self, status_bar):
         await NdsRom.ndstool.decrypt(self, status_bar)
@@ -101,6 +241,9 @@ class ThreedsRom(Rom):
     ctrtool = CtrTool()
     threedstool = ThreedsTool()
     threedsconv = ThreedsConv()
+    root_directory = ROMFS_ROOT_DIRECTORY
+    metadata_fields = Rom.metadata_fields + ('media_size', 'media_unit_size', 'extended_header_size', 'plain_size',
+                                             'logo_size', 'exefs_size', 'romfs_size')
 
     def __init__(self, path):
         super().__init__(path)
@@ -126,17 +269,48 @@ class ThreedsRom(Rom):
         self.romfs_bin = self.extract_dir / 'romfs.bin'
         self.exefs_dir = self.extract_dir / 'exefs'
         self.romfs_dir = self.extract_dir / 'romfs'
+        self.build_manifest_json = self.extract_dir / 'manifest.json'
+
+    @property
+    def layers(self):
+        # Inputs of each rebuild step, from the innermost layer to the outermost
+        return {
+            'romfs': [self.romfs_dir],
+            'exefs': [self.exefs_header_bin, self.exefs_dir],
+            'cxi': [self.ncch_header_bin, self.extended_header_bin, self.plain_bin, self.logo_bin, self.exefs_bin,
+                    self.romfs_bin],
+            'cci': [self.ncsd_header_bin, self.game_cxi, self.manual_cfa, self.download_play_cfa],
+        }
+
+    def resources(self, operation):
+        layers = self.layers
+        # Each layer is extracted from, and rebuilt into, a single image
+        images = {'romfs': self.romfs_bin, 'exefs': self.exefs_bin, 'cxi': self.game_cxi, 'cci': self.path}
+        kind, _, layer = operation.partition('_')
+        if layer in layers and kind == 'extract':
+            return {images[layer]}, set(layers[layer])
+        if layer in layers and kind == 'rebuild':
+            return set(layers[layer]), {images[layer]}
+        return super().resources(operation)
 
     @property
     def size(self):
         return self.media_size * self.media_unit_size
 
-    async def info(self, status_bar):
+    async def analyze(self, status_bar):
         await ThreedsRom.ctrtool.info(self, status_bar)
 
+    @contextlib.contextmanager
+    def file_system(self):
+        with ThreedsImage(self.path) as image:
+            yield image.romfs()
+
     async def extract_all(self, status_bar):
         await ThreedsRom.threedstool.extract_all(self, status_bar)
 
+    async def extract_selected(self, status_bar, select):
+        await ThreedsRom.threedstool.extract_selected(self, status_bar, select)
+
     async def extract_cci(self, status_bar):
         await ThreedsRom.threedstool.extract_cci(self, status_bar)
 
@@ -172,3 +346,16 @@ class ThreedsRom(Rom):
 
     async def pad(self, status_bar):
         await ThreedsRom.threedstool.pad(self, status_bar)
+
+
+ROMS = {
+    '.nds': NdsRom,
+    '.3ds': ThreedsRom,
+}
+
+
+def open_rom(path):
+    path = Path(path)
+    if path.suffix.lower() not in ROMS:
+        raise ValueError(f'Unsupported ROM: {path}')
+    return ROMS[path.suffix.lower()](path)
@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from qtxds.cache import cache_dir
+
+COUNTERS = ('cpu_seconds', 'subprocess_cpu_seconds', 'bytes_read', 'bytes_written')
+# The counters of operations whose progress is in bytes read from one file and written to another
+COPIED = ('bytes_read', 'bytes_written')
+
+_current = contextvars.ContextVar('qtxds_telemetry_current', default=None)
+_count_lock = threading.Lock()
+
+
+def count(**counts):
+    """Charge CPU time or bytes to the operation recorded in this context, and to the ones it is nested in.
+
+    Operations run concurrently, so they only get what their own code reports instead of process-wide deltas.
+    """
+    counters = _current.get()
+    with _count_lock:
+        while counters is not None:
+            for key, value in counts.items():
+                counters[key] += value
+            counters = counters['parent']
+
+
+def measure_cpu(function, *args):
+    """Run function(*args), charging the CPU time of the calling thread to the current operation."""
+    start = time.thread_time()
+    try:
+        return function(*args)
+    finally:
+        count(cpu_seconds=time.thread_time() - start)
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+class Telemetry:
+    """Record wall time, CPU time and I/O of ROM operations, and write them to JSON lines and Prometheus sinks.
+
+    The Prometheus textfile is only written when its path is given, or set in the QTXDS_PROMETHEUS environment
+    variable. The JSON lines file is moved to a .1 file, replacing the previous one, once it passes max_jsonl_size.
+    """
+
+    def __init__(self, jsonl_path=None, prometheus_path=None, history=1000, max_jsonl_size=10 * 1024 * 1024):
+        self.jsonl_path = jsonl_path if jsonl_path is not None else cache_dir() / 'telemetry.jsonl'
+        self.max_jsonl_size = max_jsonl_size
+        self.prometheus_path = prometheus_path or os.environ.get('QTXDS_PROMETHEUS') or None
+        self.records = deque(maxlen=history)
+        self.totals = {}
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def record(self, operation, rom=None):
+        path = getattr(rom, 'path', None)
+        parent = _current.get()
+        counters = {'operation': operation, 'parent': parent, **dict.fromkeys(COUNTERS, 0)}
+        token = _current.set(counters)
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield
+        except BaseException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            wall = time.perf_counter() - start
+            _current.reset(token)
+            with _count_lock:
+                counts = {key: counters[key] for key in COUNTERS}
+            self.add({
+                'operation': operation,
+                'parent': parent['operation'] if parent else None,
+                'rom': str(path) if path else None,
+                'status': status,
+                'time': time.time(),
+                'wall_seconds': wall,
+                **counts,
+                'rom_size': _file_size(path),
+            })
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+            totals = self.totals.setdefault(record['operation'], {
+                'count': 0, 'errors': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'subprocess_cpu_seconds': 0.0,
+                'bytes_read': 0, 'bytes_written': 0,
+            })
+            totals['count'] += 1
+            totals['errors'] += record['status'] != 'ok'
+            for key in ('wall_seconds',) + COUNTERS:
+                totals[key] += record[key]
+            self._write(record)
+        for listener in self.listeners:
+            listener(record)
+
+    def _write(self, record):
+        try:
+            if self.jsonl_path:
+                os.makedirs(os.path.dirname(str(self.jsonl_path)) or '.', exist_ok=True)
+                if _file_size(self.jsonl_path) > self.max_jsonl_size:
+                    os.replace(self.jsonl_path, f'{self.jsonl_path}.1')
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+            if self.prometheus_path:
+                self.write_prometheus(self.prometheus_path)
+        except OSError:
+            # Telemetry must never make an operation fail
+            pass
+
+    def write_prometheus(self, path):
+        """Write the running totals in the Prometheus textfile collector format."""
+        lines = []
+        for key, kind in (('count', 'total'), ('errors', 'total'), ('wall_seconds', 'total'),
+                          ('cpu_seconds', 'total'), ('subprocess_cpu_seconds', 'total'),
+                          ('bytes_read', 'total'), ('bytes_written', 'total')):
+            name = f'qtxds_operation_{key}_{kind}'
+            lines.append(f'# TYPE {name} counter')
+            for operation, totals in sorted(self.totals.items()):
+                lines.append(f'{name}{{operation="{operation}"}} {totals[key]}')
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+
+def threadsafe_listener(function, loop=None):
+    """Wrap a listener so that it is called on the thread of the event loop, whichever thread records.
+
+    Operations also finish in executor threads, and GUI listeners must only run on the GUI thread.
+    """
+    loop = loop or asyncio.get_event_loop()
+
+    def listener(record):
+        loop.call_soon_threadsafe(function, record)
+    return listener
+
+
+telemetry = Telemetry()
+
+
+def measured(function):
+    """Record a (self, rom, ...) coroutine method under Class.method."""
+    @functools.wraps(function)
+    async def wrapper(self, rom, *args, **kwargs):
+        with telemetry.record(f'{type(self).__name__}.{function.__name__}', rom):
+            return await function(self, rom, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,119 @@
+import io
+import os
+import random
+import shutil
+
+import pytest
+
+from qtxds import backups
+from qtxds.backups import MAX_CHUNK_SIZE, MIN_CHUNK_SIZE, BackupStore, chunks
+
+# Seeded, so that where the anchors fall does not change from one run to the next
+DATA = random.Random(0).getrandbits(2 * 1024 * 1024 * 8).to_bytes(2 * 1024 * 1024, 'little')
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BackupStore(tmp_path / 'backups', workers=2)
+
+
+@pytest.fixture
+def rom(tmp_path):
+    path = tmp_path / 'game.nds'
+    path.write_bytes(DATA)
+    return path
+
+
+def test_chunks():
+    """Check that chunks are bounded, add up to the input and survive an insertion."""
+    pieces = list(chunks(io.BytesIO(DATA), read_size=100000))
+    assert b''.join(pieces) == DATA
+    assert all(MIN_CHUNK_SIZE <= len(piece) <= MAX_CHUNK_SIZE for piece in pieces[:-1])
+
+    shifted = list(chunks(io.BytesIO(b'inserted' + DATA)))
+    assert len(set(pieces) - set(shifted)) <= 1
+
+
+def test_backup_restore(store, rom):
+    """Check that every version can be restored byte for byte."""
+    first = store.backup(rom)
+    rom.write_bytes(DATA[:1000] + b'patched' + DATA[1007:])
+    second = store.backup(rom)
+    assert [version['version'] for version in store.versions(rom)] == [1, 2]
+
+    store.restore(rom, first['version'])
+    assert rom.read_bytes() == DATA
+    store.restore(rom, second['version'], dst=rom.with_name('patched.nds'))
+    assert rom.with_name('patched.nds').read_bytes() == DATA[:1000] + b'patched' + DATA[1007:]
+
+
+def test_deduplication(store, rom):
+    """Check that a small edit only costs the chunks it touched."""
+    store.backup(rom)
+    usage = store.usage()
+    rom.write_bytes(DATA[:1000] + b'patched' + DATA[1007:])
+    store.backup(rom)
+    assert store.usage() - usage <= 2 * MAX_CHUNK_SIZE
+
+
+def test_unchanged(store, rom):
+    """Check that backing up an unchanged file does not add a version."""
+    store.backup(rom)
+    store.backup(rom)
+    os.utime(rom)
+    store.backup(rom)
+    assert len(store.versions(rom)) == 1
+
+
+def test_prune(store, rom):
+    """Check that pruned versions release their chunks."""
+    store.backup(rom)
+    rom.write_bytes(os.urandom(100000))
+    store.backup(rom)
+    store.prune(rom, keep=1)
+    assert [version['version'] for version in store.versions(rom)] == [2]
+    assert store.collect_garbage() > 0
+    store.restore(rom)
+
+
+def test_snapshot(store, rom):
+    """Check that a snapshot keeps the content it was taken with while the ROM is changed under it."""
+    future = store.snapshot(rom)
+    rom.write_bytes(b'changed')
+    first = future.result()
+    assert store.snapshot(rom).result()['version'] == 2
+    assert sorted(path.name for path in rom.parent.iterdir()) == ['backups', 'game.nds']
+
+    store.restore(rom, first['version'])
+    assert rom.read_bytes() == DATA
+    # Unchanged since the latest version
+    store.backup(rom)
+    assert store.snapshot(rom).result()['version'] == 3
+    assert len(store.versions(rom)) == 3
+
+
+def test_snapshot_clone(monkeypatch, store, rom):
+    """Check that a cloned snapshot is taken inside the store, and removed once stored or left by a dead process."""
+    monkeypatch.setattr(backups, 'reflink', shutil.copyfile)
+    store.snapshots_dir.mkdir(parents=True)
+    # No process has this pid
+    (store.snapshots_dir / f'{2 ** 22 + 1}-0').write_bytes(b'stale')
+    (store.snapshots_dir / f'{os.getpid()}-9').write_bytes(b'ours')
+    future = store.snapshot(rom)
+    rom.write_bytes(b'changed')
+    store.restore(rom, future.result()['version'])
+    assert rom.read_bytes() == DATA
+    assert [path.name for path in store.snapshots_dir.iterdir()] == [f'{os.getpid()}-9']
+    assert sorted(path.name for path in rom.parent.iterdir()) == ['backups', 'game.nds']
+
+
+def test_retention(tmp_path, rom):
+    """Check that only the last versions are kept, along with the chunks they need."""
+    store = BackupStore(tmp_path / 'backups', workers=2, keep=2)
+    for index in range(4):
+        rom.write_bytes(random.Random(index).randbytes(300000))
+        store.backup(rom)
+    assert [version['version'] for version in store.versions(rom)] == [3, 4]
+    assert store.collect_garbage() == 0
+    store.restore(rom, 3)
+    assert rom.read_bytes() == random.Random(2).randbytes(300000)
@@ -0,0 +1,137 @@
+import random
+import struct
+import zlib
+
+import pytest
+
+from qtxds import banner
+from qtxds.banner import (ANIMATED_BITMAPS_OFFSET, ANIMATED_PALETTES_OFFSET, ANIMATION_SEQUENCE_OFFSET, BITMAP_OFFSET,
+                          LARGE_ICON_SIZE, PALETTE_OFFSET, SMALL_ICON_SIZE, TITLES_OFFSET, TITLE_SIZE, Banner,
+                          ThumbnailCache, decode_icon, decode_rgb565, png)
+
+
+def make_banner(version=0x0001, size=0x840, english='Test Game\nDeveloper'):
+    data = bytearray(size)
+    struct.pack_into('<H', data, 0, version)
+    # Color i of the palette is (i, i, i), pixel (x, y) of the bitmap uses color (x + y) % 16
+    struct.pack_into('<16H', data, PALETTE_OFFSET, *(i | i << 5 | i << 10 for i in range(16)))
+    for y in range(32):
+        for x in range(32):
+            position = ((y // 8 * 4 + x // 8) * 8 + y % 8) * 8 + x % 8
+            data[BITMAP_OFFSET + position // 2] |= ((x + y) % 16) << (4 * (position & 1))
+    title = english.encode('utf-16-le')
+    data[TITLES_OFFSET + TITLE_SIZE:TITLES_OFFSET + TITLE_SIZE + len(title)] = title
+    return data
+
+
+def pixel(rgba, x, y, size=32):
+    return tuple(rgba[(y * size + x) * 4:(y * size + x + 1) * 4])
+
+
+def test_decode_icon(monkeypatch):
+    """Check that the tiles of an icon are put in place, color 0 being transparent."""
+    monkeypatch.setattr(banner, '_numpy', lambda: None)
+    data = make_banner()
+    rgba = Banner(data).icon()
+    assert len(rgba) == 32 * 32 * 4
+    assert pixel(rgba, 0, 0)[3] == 0
+    assert pixel(rgba, 1, 0) == (8, 8, 8, 255)
+    assert pixel(rgba, 9, 2) == (11 << 3 | 11 >> 2,) * 3 + (255,)
+    assert pixel(rgba, 31, 31) == (14 << 3 | 14 >> 2,) * 3 + (255,)
+
+    flipped = decode_icon(data[BITMAP_OFFSET:PALETTE_OFFSET], data[PALETTE_OFFSET:PALETTE_OFFSET + 0x20], True, True)
+    assert pixel(flipped, 0, 0) == pixel(rgba, 31, 31)
+    assert pixel(flipped, 30, 31) == pixel(rgba, 1, 0)
+
+
+def test_decode_icon_numpy():
+    """Check that NumPy decodes random icons the same as the pure Python fallback."""
+    pytest.importorskip('numpy')
+    rng = random.Random(0)
+    for flips in ((False, False), (True, False), (False, True)):
+        bitmap = bytes(rng.getrandbits(8) for _ in range(0x200))
+        palette = bytes(rng.getrandbits(8) for _ in range(0x20))
+        assert decode_icon(bitmap, palette, *flips) == banner._decode_icon(bitmap, palette, *flips)
+
+
+def test_titles():
+    """Check that the titles are decoded, falling back to the first one when there is no English title."""
+    assert Banner(make_banner()).title == 'Test Game\nDeveloper'
+    data = make_banner(english='')
+    data[TITLES_OFFSET:TITLES_OFFSET + 6] = 'ゲーム'.encode('utf-16-le')
+    assert Banner(data).titles == {'japanese': 'ゲーム'}
+    assert Banner(data).title == 'ゲーム'
+    with pytest.raises(ValueError):
+        Banner(data[:0x100])
+
+
+def test_png():
+    """Check that the PNG encoder writes a valid signature, header and image data."""
+    rgba = bytes(range(256)) * 16
+    image = png(rgba)
+    assert image.startswith(b'\x89PNG\r\n\x1a\n')
+    assert struct.unpack_from('>4sII', image, 12) == (b'IHDR', 32, 32)
+    length, = struct.unpack_from('>I', image, 33)
+    scanlines = zlib.decompress(image[41:41 + length])
+    assert scanlines == b''.join(b'\0' + rgba[row * 128:(row + 1) * 128] for row in range(32))
+
+
+def test_thumbnail_cache(tmp_path, monkeypatch):
+    """Check that an icon is decoded only once, whichever banner it is seen in."""
+    cache = ThumbnailCache(tmp_path)
+    first = Banner(make_banner())
+    path = cache.get(first)
+    assert path == tmp_path / first.digest[:2] / f'{first.digest}.png'
+    assert path.read_bytes() == png(first.icon())
+
+    monkeypatch.setattr(Banner, 'icon', lambda self: pytest.fail('icon decoded again'))
+    assert cache.get(Banner(make_banner(english='Other Game'))) == path
+
+
+def test_animated_frames():
+    """Check that the animation sequence of a DSi banner picks and flips the right bitmaps and palettes."""
+    data = make_banner(version=0x0103, size=0x23C0)
+    assert Banner(data).frames() == [(Banner(data).icon(), 0)]
+
+    icon = data[BITMAP_OFFSET:PALETTE_OFFSET]
+    palette = data[PALETTE_OFFSET:PALETTE_OFFSET + 0x20]
+    data[ANIMATED_BITMAPS_OFFSET + 0x200:ANIMATED_BITMAPS_OFFSET + 0x400] = icon
+    data[ANIMATED_PALETTES_OFFSET + 0x40:ANIMATED_PALETTES_OFFSET + 0x60] = palette
+    # Bitmap 1 with palette 2 for 30 frames, then the same flipped horizontally for 6 frames
+    struct.pack_into('<3H', data, ANIMATION_SEQUENCE_OFFSET, 30 | 1 << 8 | 2 << 11, 6 | 1 << 8 | 2 << 11 | 0x4000, 0)
+
+    animated = Banner(data)
+    assert animated.is_animated
+    frames = animated.frames()
+    assert [seconds for _, seconds in frames] == [0.5, 0.1]
+    assert frames[0][0] == animated.icon()
+    assert frames[1][0] == decode_icon(icon, palette, flip_horizontal=True)
+
+
+def test_decode_rgb565(monkeypatch):
+    """Check that the Z-ordered 8x8 tiles of an SMDH icon are put in place."""
+    monkeypatch.setattr(banner, '_numpy', lambda: None)
+    # Pixel i of the data is blue i % 32, tile i // 64 green, and Z-order (x, y) inside the tile is in red
+    data = b''
+    for tile in range(9):
+        for index in range(64):
+            x = (index & 1) | (index >> 1 & 2) | (index >> 2 & 4)
+            y = (index >> 1 & 1) | (index >> 2 & 2) | (index >> 3 & 4)
+            data += struct.pack('<H', (x * 8 + y) % 32 << 11 | tile << 5 | index % 32)
+    rgba = decode_rgb565(data, 24)
+    for x, y in ((0, 0), (3, 5), (9, 2), (23, 23)):
+        r, g, b, a = pixel(rgba, x, y, 24)
+        assert (r >> 3, g >> 2, a) == ((x % 8 * 8 + y % 8) % 32, y // 8 * 3 + x // 8, 0xFF)
+
+
+def test_decode_rgb565_numpy():
+    """Check that NumPy untiles random SMDH icons the same as the pure Python fallback."""
+    pytest.importorskip('numpy')
+    rng = random.Random(0)
+    for size in (SMALL_ICON_SIZE, LARGE_ICON_SIZE):
+        data = bytes(rng.getrandbits(8) for _ in range(size * size * 2))
+        expected = decode_rgb565(data, size)
+        with pytest.MonkeyPatch.context() as monkeypatch:
+            monkeypatch.setattr(banner, '_numpy', lambda: None)
+            assert decode_rgb565(data, size) == expected
+        assert len(expected) == size * size * 4
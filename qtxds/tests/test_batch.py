@@ -0,0 +1,96 @@
+import hashlib
+import struct
+import zlib
+
+from qtxds import telemetry
+from qtxds.batch import main
+from qtxds.crc import crc16
+from qtxds.tests.test_hashing import DAT
+from qtxds.tests.test_nds import FILES, make_nds_rom
+from qtxds.tests.test_threeds import ROMFS_FILES, make_ncch, make_romfs, make_threeds_rom
+
+
+def test_extract_selected_nds(tmp_path):
+    """Check that only the data files matching the patterns are extracted."""
+    rom = make_nds_rom(tmp_path / 'game.nds')
+    assert main(['extract', '--include', 'dir/*', '--exclude', '*.dat', str(rom)]) == 0
+
+    data_dir = tmp_path / 'game' / 'data'
+    assert sorted(str(path.relative_to(data_dir)) for path in data_dir.rglob('*') if path.is_file()) == ['dir/b.bin']
+    assert (data_dir / 'dir' / 'b.bin').read_bytes() == FILES['dir/b.bin']
+    assert not (tmp_path / 'game' / 'arm9.bin').exists()
+
+
+def test_extract_file_list_threeds(tmp_path):
+    """Check that a file list picks RomFS files straight out of a 3DS image."""
+    rom = make_threeds_rom(tmp_path / 'game.3ds', make_ncch(romfs=make_romfs()))
+    file_list = tmp_path / 'files.txt'
+    file_list.write_text('a.txt\nsound/bgm/c.bcstm\n')
+    assert main(['--jobs', '2', 'extract', '--files', str(file_list), str(rom)]) == 0
+
+    romfs_dir = tmp_path / 'game' / 'romfs'
+    assert (romfs_dir / 'a.txt').read_bytes() == ROMFS_FILES['a.txt']
+    assert (romfs_dir / 'sound' / 'bgm' / 'c.bcstm').read_bytes() == ROMFS_FILES['sound/bgm/c.bcstm']
+    assert not (romfs_dir / 'sound' / 'b.bcstm').exists()
+    assert not (tmp_path / 'game' / 'romfs.bin').exists()
+
+
+def test_extract_failure(tmp_path):
+    """Check that a ROM that can't be read makes the batch fail."""
+    assert main(['extract', '--include', '*', str(tmp_path / 'missing.nds')]) == 1
+
+
+def test_check_fix(tmp_path):
+    """Check that invalid header CRCs fail the check, and pass once fixed."""
+    rom = make_nds_rom(tmp_path / 'game.nds')
+    data = bytearray(rom.read_bytes())
+    struct.pack_into('<HH', data, 0x15C, crc16(data[0xC0:0x15C]), 0)
+    rom.write_bytes(bytes(data))
+    assert main(['check', str(rom)]) == 1
+    assert main(['check', '--fix', str(rom)]) == 0
+    assert main(['check', str(rom)]) == 0
+
+
+def test_verify(tmp_path, capsys):
+    """Check that every ROM is reported against the DAT, any that isn't good failing the batch."""
+    good = make_nds_rom(tmp_path / 'good.nds')
+    data = good.read_bytes()
+    dat = tmp_path / 'nds.dat'
+    dat.write_text(DAT.format(size=len(data), crc=f'{zlib.crc32(data):08X}', md5=hashlib.md5(data).hexdigest(),
+                              sha1=hashlib.sha1(data).hexdigest()))
+    assert main(['--jobs', '2', 'verify', '--dat', str(dat), str(good)]) == 0
+    assert 'good.nds: good (Good Game)' in capsys.readouterr().err
+
+    other = make_nds_rom(tmp_path / 'other.nds', title=b'OTHER')
+    assert main(['verify', '--dat', str(dat), str(good), str(other), str(tmp_path / 'missing.nds')]) == 1
+    err = capsys.readouterr().err
+    assert 'other.nds: unknown' in err and 'missing.nds: Error: not a file' in err
+
+
+def test_dedup(tmp_path, monkeypatch, capsys):
+    """Check that duplicate ROMs are reported in a dry run, then hardlinked to a single copy."""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    roms = tmp_path / 'roms'
+    roms.mkdir()
+    make_nds_rom(roms / 'a.nds')
+    make_nds_rom(roms / 'b.nds')
+    make_nds_rom(roms / 'c.nds', title=b'OTHER')
+    size = (roms / 'a.nds').stat().st_size
+
+    assert main(['dedup', '--dry-run', str(roms)]) == 0
+    assert f'Would reclaim {size} bytes in 1 duplicate groups' in capsys.readouterr().out
+    assert (roms / 'b.nds').stat().st_nlink == 1
+
+    assert main(['dedup', '--hardlink', str(roms)]) == 0
+    assert f'Reclaimed {size} bytes' in capsys.readouterr().out
+    assert (roms / 'a.nds').stat().st_ino == (roms / 'b.nds').stat().st_ino
+    assert (roms / 'c.nds').stat().st_nlink == 1
+
+
+def test_prometheus(tmp_path, monkeypatch):
+    """Check that --prometheus writes the totals of the batch's operations."""
+    monkeypatch.setattr(telemetry.telemetry, 'jsonl_path', None)
+    monkeypatch.setattr(telemetry.telemetry, 'prometheus_path', None)
+    rom = make_nds_rom(tmp_path / 'game.nds')
+    assert main(['--prometheus', str(tmp_path / 'qtxds.prom'), 'extract', '--include', '*', str(rom)]) == 0
+    assert 'operation="NdsTool.extract_selected"' in (tmp_path / 'qtxds.prom').read_text()
@@ -0,0 +1,94 @@
+import os
+
+import pytest
+
+from qtxds.cache import MetadataCache
+
+
+class FakeRom:
+    metadata_fields = ('title', 'content_size')
+
+    def __init__(self, path):
+        self.path = path
+        self.title = ''
+        self.content_size = 0
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite', max_entries=2)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def rom(tmp_path):
+    path = tmp_path / 'game.nds'
+    path.write_bytes(b'\0' * 0x200)
+    rom = FakeRom(path)
+    rom.title = 'GAME'
+    rom.content_size = 42
+    return rom
+
+
+def test_round_trip(cache, rom):
+    """Check that stored metadata is loaded back into a fresh ROM."""
+    assert not cache.load(FakeRom(rom.path))
+    cache.store(rom)
+    loaded = FakeRom(rom.path)
+    assert cache.load(loaded)
+    assert (loaded.title, loaded.content_size) == ('GAME', 42)
+
+
+def test_persistence(cache, rom):
+    """Check that entries survive reopening the database."""
+    cache.store(rom)
+    cache.close()
+    reopened = MetadataCache(cache.path)
+    assert reopened.load(FakeRom(rom.path))
+    reopened.close()
+
+
+def test_invalidation_on_change(cache, rom):
+    """Check that a modified file is not served from the cache."""
+    cache.store(rom)
+    rom.path.write_bytes(b'\0' * 0x400)
+    assert not cache.load(FakeRom(rom.path))
+    assert len(cache) == 0
+
+
+def test_invalidation_on_mtime(cache, rom):
+    """Check that touching a file invalidates its entry."""
+    cache.store(rom)
+    stat = rom.path.stat()
+    os.utime(rom.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert not cache.load(FakeRom(rom.path))
+
+
+def test_eviction(tmp_path, cache):
+    """Check that the least recently used entries are evicted past the bound."""
+    roms = []
+    for index in range(3):
+        path = tmp_path / f'{index}.nds'
+        path.write_bytes(bytes([index]))
+        roms.append(FakeRom(path))
+        cache.store(roms[-1])
+    assert len(cache) == 2
+    assert not cache.load(FakeRom(roms[0].path))
+    assert cache.load(FakeRom(roms[2].path))
+
+
+def test_eviction_amortized(tmp_path):
+    """Check that entries are only counted and evicted once the bound may have been passed."""
+    cache = MetadataCache(tmp_path / 'metadata.sqlite', max_entries=20)
+    statements = []
+    cache.connection.set_trace_callback(statements.append)
+    for index in range(30):
+        path = tmp_path / f'{index}.nds'
+        path.write_bytes(bytes([index]))
+        cache.store(FakeRom(path))
+    # Counted on the first store, then each time 3 more entries may have passed the bound, down to 18
+    assert len([statement for statement in statements if statement.startswith('DELETE')]) == 4
+    assert len([statement for statement in statements if 'COUNT' in statement]) == 5
+    assert len(cache) == 18
+    cache.close()
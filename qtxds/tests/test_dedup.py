@@ -0,0 +1,62 @@
+import pytest
+
+from qtxds.dedup import BLOCK_SIZE, HashIndex, deduplicate, find_duplicates
+
+BIG = b'\1' * BLOCK_SIZE + b'\2' * BLOCK_SIZE + b'\3' * BLOCK_SIZE
+
+
+@pytest.fixture
+def library(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'a' / 'game.nds').write_bytes(BIG)
+    (tmp_path / 'b' / 'copy.nds').write_bytes(BIG)
+    (tmp_path / 'a' / 'game.nds.old').write_bytes(BIG)
+    # Same size, same first and last blocks, different middle
+    (tmp_path / 'b' / 'other.nds').write_bytes(b'\1' * BLOCK_SIZE + b'\4' * BLOCK_SIZE + b'\3' * BLOCK_SIZE)
+    (tmp_path / 'b' / 'small.3ds').write_bytes(b'small')
+    (tmp_path / 'b' / 'small copy.3ds').write_bytes(b'small')
+    (tmp_path / 'b' / 'notes.txt').write_bytes(BIG)
+    return tmp_path
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = HashIndex(tmp_path / 'dedup.sqlite')
+    yield index
+    index.close()
+
+
+def test_find_duplicates(library):
+    """Check that only byte-identical ROMs are grouped."""
+    report = find_duplicates([library])
+    groups = sorted(sorted(path.name for path, _ in group) for group in report.groups)
+    assert groups == [['copy.nds', 'game.nds', 'game.nds.old'], ['small copy.3ds', 'small.3ds']]
+    # Small files are settled by the partial hash, the four big ones need a full read
+    assert report.hashed == 4
+
+
+def test_deduplicate_hardlink(library):
+    """Check that duplicates are replaced by links to the live ROM."""
+    report = deduplicate([library], hardlink=True)
+    keeper = library / 'a' / 'game.nds'
+    assert (library / 'b' / 'copy.nds').stat().st_ino == keeper.stat().st_ino
+    assert (library / 'a' / 'game.nds.old').stat().st_ino == keeper.stat().st_ino
+    assert (library / 'b' / 'copy.nds').read_bytes() == BIG
+    assert report.reclaimed == 2 * len(BIG) + len(b'small')
+    assert not report.errors
+
+
+def test_dry_run(library):
+    """Check that a dry run reports without touching files."""
+    report = deduplicate([library], dry_run=True)
+    assert report.reclaimed == 2 * len(BIG) + len(b'small')
+    assert (library / 'b' / 'copy.nds').stat().st_nlink == 1
+
+
+def test_incremental(library, index):
+    """Check that a second pass reuses the hashes and links nothing again."""
+    deduplicate([library], hardlink=True, index=index)
+    report = deduplicate([library], hardlink=True, index=index)
+    assert report.hashed == 0
+    assert report.reclaimed == 0
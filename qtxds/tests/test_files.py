@@ -0,0 +1,145 @@
+import os
+import threading
+
+import pytest
+
+from qtxds import files
+from qtxds.files import CopyCancelled, DirectorySizer, assemble, copy_file, copy_range, path_filter, safe_join
+
+
+def test_directory_size(tmp_path):
+    """Check that nested trees are sized and that changes to a directory are picked up."""
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'c').mkdir()
+    (tmp_path / 'root.bin').write_bytes(b'\0' * 10)
+    (tmp_path / 'a' / 'one.bin').write_bytes(b'\0' * 100)
+    (tmp_path / 'a' / 'b' / 'two.bin').write_bytes(b'\0' * 1000)
+
+    sizer = DirectorySizer(workers=2)
+    assert sizer.size(tmp_path) == 1110
+    assert sizer.size(tmp_path / 'missing') == 0
+
+    (tmp_path / 'c' / 'three.bin').write_bytes(b'\0' * 5)
+    stat = (tmp_path / 'c').stat()
+    os.utime(tmp_path / 'c', ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert sizer.size(tmp_path) == 1115
+
+
+def test_rewritten_in_place(tmp_path):
+    """Check that a file rewritten in place is sized again, even though its directory didn't change."""
+    (tmp_path / 'one.bin').write_bytes(b'\0' * 100)
+    sizer = DirectorySizer(workers=1)
+    assert sizer.size(tmp_path) == 100
+
+    stat = tmp_path.stat()
+    (tmp_path / 'one.bin').write_bytes(b'\0' * 200)
+    os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert sizer.size(tmp_path) == 200
+
+
+def test_invalidate(tmp_path, monkeypatch):
+    """Check that invalidation forces a directory to be listed again."""
+    (tmp_path / 'one.bin').write_bytes(b'\0' * 100)
+    sizer = DirectorySizer(workers=1)
+    assert sizer.size(tmp_path) == 100
+
+    scandir = os.scandir
+    listed = []
+    monkeypatch.setattr(files.os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    assert sizer.size(tmp_path) == 100
+    assert listed == []
+    sizer.invalidate(tmp_path)
+    assert sizer.size(tmp_path) == 100
+    assert listed == [str(tmp_path)]
+
+
+def test_copy_file(tmp_path):
+    """Check that a copy is complete and reports its progress up to the total size."""
+    src = tmp_path / 'game.3ds'
+    src.write_bytes(os.urandom(10000))
+    calls = []
+    copy_file(src, tmp_path / 'game.3ds.old', lambda done, total: calls.append((done, total)), chunk_size=4096)
+    assert (tmp_path / 'game.3ds.old').read_bytes() == src.read_bytes()
+    assert calls[-1] == (10000, 10000)
+
+
+def test_copy_file_cancelled(tmp_path, monkeypatch):
+    """Check that a cancelled copy leaves neither the destination nor its temporary file behind."""
+    def reflink(src, dst):
+        raise OSError()
+
+    monkeypatch.setattr('qtxds.files.reflink', reflink)
+    src = tmp_path / 'game.3ds'
+    src.write_bytes(os.urandom(10000))
+    cancelled = threading.Event()
+    with pytest.raises(CopyCancelled):
+        copy_file(src, tmp_path / 'game.3ds.old', lambda done, total: cancelled.set(), cancelled, chunk_size=4096)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['game.3ds']
+
+
+@pytest.mark.parametrize('method', ['copy_file_range', 'sendfile', None])
+def test_copy_range(tmp_path, monkeypatch, method):
+    """Check that a range is copied out of a file whichever kernel copy is available."""
+    for name in ('copy_file_range', 'sendfile'):
+        if name != method:
+            monkeypatch.delattr(files.os, name, raising=False)
+    if method and not hasattr(os, method):
+        pytest.skip(f'no {method} on this platform')
+    src = tmp_path / 'src.bin'
+    src.write_bytes(bytes(range(256)) * 64)
+    with open(src, 'rb') as f:
+        assert copy_range(f.fileno(), 1000, 5000, tmp_path / 'dst.bin') == 5000
+    assert (tmp_path / 'dst.bin').read_bytes() == src.read_bytes()[1000:6000]
+
+
+def test_path_filter():
+    """Check that listed paths and include globs select files, and exclude globs win over both."""
+    select = path_filter(['text/*.msg'], ['*/credits.msg'], ['sound/title.bcstm', ''])
+    assert select('text/en/intro.msg')
+    assert select('sound/title.bcstm')
+    assert not select('text/credits.msg')
+    assert not select('sound/other.bcstm')
+    assert path_filter()('anything')
+    assert not path_filter(exclude=['*.bin'])('arm9.bin')
+
+
+def test_safe_join(tmp_path):
+    """Check that ROM paths can't escape their output directory."""
+    assert safe_join(tmp_path, 'a/b.txt') == os.path.join(str(tmp_path), 'a', 'b.txt')
+    for path in ('../a', 'a//b', '/a', 'a\\..\\b'):
+        with pytest.raises(ValueError):
+            safe_join(tmp_path, path)
+
+
+@pytest.mark.parametrize('method', ['copy_file_range', None])
+def test_assemble(tmp_path, monkeypatch, method):
+    """Check that regions and writes land at their offsets, the gaps being zeros."""
+    if method is None:
+        monkeypatch.delattr(files.os, 'copy_file_range', raising=False)
+    elif not hasattr(os, method):
+        pytest.skip(f'no {method} on this platform')
+    sources = []
+    for index in range(20):
+        src = tmp_path / f'{index}.bin'
+        src.write_bytes(bytes([index]) * (index * 100 + 1))
+        sources.append(src)
+    regions = [(src, index * 0x1000, index * 100 + 1) for index, src in enumerate(sources)]
+
+    assert assemble(tmp_path / 'out.bin', 0x14000, regions, [(b'head', 0x10)], workers=3) == sum(
+        size for _, _, size in regions)
+    data = (tmp_path / 'out.bin').read_bytes()
+    assert len(data) == 0x14000 and data[0x10:0x14] == b'head' and data[:0x10] == bytes(0x10)
+    for index in range(1, 20):
+        start = index * 0x1000
+        assert data[start:start + 0x1000] == bytes([index]) * (index * 100 + 1) + bytes(0x1000 - index * 100 - 1)
+
+
+def test_assemble_cancelled(tmp_path):
+    """Check that a cancelled assembly leaves neither the target nor its temporary file behind."""
+    src = tmp_path / 'src.bin'
+    src.write_bytes(b'x' * 100)
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(CopyCancelled):
+        assemble(tmp_path / 'out.bin', 0x1000, [(src, 0, 100)], cancelled=cancelled)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['src.bin']
@@ -0,0 +1,94 @@
+import hashlib
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from qtxds.hashing import BAD, GOOD, UNKNOWN, DatIndex, hash_file, hash_files, verify_files
+
+DATA = bytes(range(256)) * 1000
+
+DAT = """<?xml version="1.0"?>
+<datafile>
+    <header>
+        <name>Nintendo - Nintendo DS</name>
+    </header>
+    <game name="Good Game">
+        <rom name="good.nds" size="{size}" crc="{crc}" md5="{md5}" sha1="{sha1}"/>
+    </game>
+    <game name="Bad Game">
+        <rom name="bad.nds" size="4" crc="00000000" md5="00" sha1="00"/>
+    </game>
+</datafile>
+"""
+
+
+@pytest.fixture
+def files(tmp_path):
+    good = tmp_path / 'good.nds'
+    good.write_bytes(DATA)
+    bad = tmp_path / 'bad.nds'
+    bad.write_bytes(b'oops')
+    unknown = tmp_path / 'unknown.nds'
+    unknown.write_bytes(b'something else')
+    return good, bad, unknown
+
+
+@pytest.fixture
+def dat(tmp_path):
+    path = tmp_path / 'nds.dat'
+    path.write_text(DAT.format(size=len(DATA), crc=f'{zlib.crc32(DATA):08X}',
+                               md5=hashlib.md5(DATA).hexdigest(), sha1=hashlib.sha1(DATA).hexdigest()))
+    return DatIndex.load(path)
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_hash_file(files, concurrent):
+    """Check that every digest matches hashlib/zlib, whether digests are updated inline or concurrently."""
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        hashes = hash_file(files[0], executor=executor if concurrent else None, buffer_size=4096)
+    assert hashes == {
+        'crc32': f'{zlib.crc32(DATA):08x}',
+        'md5': hashlib.md5(DATA).hexdigest(),
+        'sha1': hashlib.sha1(DATA).hexdigest(),
+        'size': len(DATA),
+    }
+
+
+def test_hash_files(files):
+    """Check that results are yielded in input order."""
+    assert [path for path, _ in hash_files(files, workers=2)] == list(files)
+
+
+def test_dat_load(dat):
+    """Check that the DAT header and entries are indexed."""
+    assert dat.name == 'Nintendo - Nintendo DS'
+    assert len(dat.entries) == 2
+    assert dat.by_name['good.nds']['game'] == 'Good Game'
+
+
+def test_verify(files, dat):
+    """Check the good/bad/unknown classification."""
+    statuses = {path.name: status for path, status, _ in verify_files(files, dat)}
+    assert statuses == {'good.nds': GOOD, 'bad.nds': BAD, 'unknown.nds': UNKNOWN}
+
+
+def test_verify_crc_only(files, tmp_path):
+    """Check that DATs listing only CRCs, with or without sizes, are matched on them."""
+    good, bad, unknown = files
+    path = tmp_path / 'crc.dat'
+    path.write_text(f"""<?xml version="1.0"?>
+<datafile>
+    <game name="Good Game"><rom name="renamed.nds" size="{len(DATA)}" crc="{zlib.crc32(DATA):08X}"/></game>
+    <game name="Sizeless Game"><rom name="sizeless.nds" crc="{zlib.crc32(b'something else'):08X}"/></game>
+    <game name="Bad Game"><rom name="bad.nds" size="4" crc="DEADBEEF"/></game>
+</datafile>
+""")
+    dat = DatIndex.load(path)
+    assert dat.by_name['renamed.nds']['crc32'] == f'{zlib.crc32(DATA):08x}'
+    results = {path.name: (status, entry and entry['game']) for path, status, entry in verify_files(files, dat)}
+    assert results == {
+        'good.nds': (GOOD, 'Good Game'),
+        'bad.nds': (BAD, 'Bad Game'),
+        'unknown.nds': (GOOD, 'Sizeless Game'),
+    }
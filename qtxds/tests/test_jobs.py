@@ -0,0 +1,78 @@
+import asyncio
+
+from qtxds.jobs import CANCELLED, DONE, FAILED, Job, JobQueue
+
+
+def recorder(events, name, delay=0.01, error=None):
+    async def function():
+        events.append(('start', name))
+        await asyncio.sleep(delay)
+        events.append(('end', name))
+        if error:
+            raise error
+    return function
+
+
+def test_conflicts(tmp_path):
+    """Check that jobs conflict when one writes what the other touches, but not when both only read."""
+    rom = tmp_path / 'game.3ds'
+    extract_dir = tmp_path / 'game'
+    reader = Job('info', None, reads=[rom])
+    writer = Job('trim', None, reads=[rom], writes=[rom])
+    extractor = Job('extract', None, reads=[rom], writes=[extract_dir])
+    layer = Job('rebuild romfs', None, reads=[extract_dir / 'romfs'], writes=[extract_dir / 'romfs.bin'])
+
+    assert not reader.conflicts(Job('verify', None, reads=[rom]))
+    assert reader.conflicts(writer) and writer.conflicts(reader)
+    assert extractor.conflicts(layer)
+    assert not layer.conflicts(Job('rebuild exefs', None, reads=[extract_dir / 'exefs'],
+                                   writes=[extract_dir / 'exefs.bin']))
+
+
+def test_serialized_and_concurrent(tmp_path):
+    """Check that conflicting jobs run in submission order while independent ones overlap."""
+    events = []
+    rom = tmp_path / 'game.nds'
+    other = tmp_path / 'other.nds'
+
+    async def run():
+        queue = JobQueue()
+        jobs = [
+            queue.submit('trim', recorder(events, 'trim'), [rom], [rom]),
+            queue.submit('info', recorder(events, 'info'), [rom]),
+            queue.submit('other', recorder(events, 'other'), [other], [other]),
+        ]
+        while queue.active:
+            await asyncio.sleep(0.01)
+        return jobs
+
+    jobs = asyncio.run(run())
+    assert [job.state for job in jobs] == [DONE, DONE, DONE]
+    assert events.index(('end', 'trim')) < events.index(('start', 'info'))
+    assert events.index(('start', 'other')) < events.index(('end', 'trim'))
+
+
+def test_failure_cancels_dependents(tmp_path):
+    """Check that jobs waiting on a failed or cancelled job are cancelled, and callbacks see every task that ran."""
+    events = []
+    rom = tmp_path / 'game.nds'
+    callbacks = []
+
+    async def run():
+        queue = JobQueue()
+        failing = queue.submit('trim', recorder(events, 'trim', error=OSError('full')), [rom], [rom],
+                               callbacks.append)
+        waiting = queue.submit('info', recorder(events, 'info'), [rom], callback=callbacks.append)
+        slow = queue.submit('pad', recorder(events, 'pad', delay=10), [rom.with_suffix('.3ds')],
+                            [rom.with_suffix('.3ds')], callbacks.append)
+        await asyncio.sleep(0.05)
+        queue.cancel_all()
+        while queue.active:
+            await asyncio.sleep(0.01)
+        return failing, waiting, slow
+
+    failing, waiting, slow = asyncio.run(run())
+    assert (failing.state, waiting.state, slow.state) == (FAILED, CANCELLED, CANCELLED)
+    assert ('start', 'info') not in events
+    assert callbacks[0].exception().args == ('full',)
+    assert len(callbacks) == 2 and callbacks[1].cancelled()
@@ -0,0 +1,145 @@
+import json
+import time
+
+import pytest
+
+from qtxds.banner import ThumbnailCache
+from qtxds.cache import MetadataCache
+from qtxds.library import Library, find_roms
+from qtxds.roms import Rom
+from qtxds.tests.test_nds import make_nds_rom
+from qtxds.tests.test_threeds import make_ncch, make_threeds_rom
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite')
+    monkeypatch.setattr(Rom, 'cache', cache)
+    monkeypatch.setattr(Rom, 'thumbnails', ThumbnailCache(tmp_path / 'thumbnails'))
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def roms(tmp_path):
+    root = tmp_path / 'roms'
+    (root / 'nested').mkdir(parents=True)
+    (root / 'readme.txt').write_text('not a ROM')
+    make_nds_rom(root / 'b.nds', title=b'BRAVO', game_code=b'BBBE', maker_code=b'02')
+    make_nds_rom(root / 'nested' / 'a.NDS', title=b'ALPHA', game_code=b'AAAE')
+    make_nds_rom(root / 'c.nds', title=b'charlie', game_code=b'CCCE', files={'big.bin': b'\0' * 0x10000})
+    make_threeds_rom(root / 'd.3ds', make_ncch(product_code=b'CTR-P-DDDE'))
+    return root
+
+
+def test_find_roms(roms):
+    """Check that every ROM is found whatever the case of its extension, and nothing else."""
+    assert sorted(path.name for path in find_roms(roms)) == ['a.NDS', 'b.nds', 'c.nds', 'd.3ds']
+
+
+def test_populate_sort_filter(tmp_path, cache, roms):
+    """Check that a scanned library is sorted and filtered in the cache, across pages."""
+    library = Library([roms], roots_path=tmp_path / 'library.json', page_size=2)
+    assert len(library) == 0
+    assert library.populate(workers=2) == 0
+    assert len(library) == 4
+
+    assert [entry.title for entry in library] == ['', 'ALPHA', 'BRAVO', 'charlie']
+    library.sort('size', descending=True)
+    assert [entry.path.name for entry in library][:2] == ['c.nds', 'd.3ds']
+    library.sort('maker_code')
+    assert [entry.maker_code for entry in library][-1] == '02'
+
+    library.filter('aae')
+    assert [entry.title for entry in library] == ['ALPHA']
+    library.filter('ctr-p')
+    assert [entry.product_code for entry in library] == ['CTR-P-DDDE']
+    library.filter('', min_size=0x1000, max_size=0x8000)
+    assert [entry.path.name for entry in library] == ['d.3ds']
+    library.filter('a', max_size=0x1000)
+    assert [entry.title for entry in library] == ['ALPHA', 'BRAVO']
+    library.filter('%')
+    assert len(library) == 0
+
+    with pytest.raises(IndexError):
+        library[0]
+    with pytest.raises(ValueError):
+        library.sort('data')
+
+
+def test_populate_cached(tmp_path, cache, roms, monkeypatch):
+    """Check that a second scan only analyzes new ROMs and forgets deleted ones."""
+    library = Library([roms], roots_path=tmp_path / 'library.json')
+    library.populate()
+
+    analyzed = []
+    analyze = Rom.info
+
+    async def info(rom, status_bar):
+        analyzed.append(rom.path.name)
+        await analyze(rom, status_bar)
+
+    monkeypatch.setattr(Rom, 'info', info)
+    (roms / 'b.nds').unlink()
+    make_nds_rom(roms / 'e.nds', title=b'ECHO')
+    library.populate()
+    assert sorted(analyzed) == ['a.NDS', 'c.nds', 'd.3ds', 'e.nds']
+    assert [entry.title for entry in library] == ['', 'ALPHA', 'charlie', 'ECHO']
+    assert len(cache) == 4
+
+
+def test_populate_corrupt(tmp_path, cache, roms):
+    """Check that a corrupt ROM is counted as unreadable without stopping the scan."""
+    data = bytearray((roms / 'b.nds').read_bytes())
+    data[0x40:0x44] = b'\xff' * 4
+    (roms / 'b.nds').write_bytes(bytes(data))
+    library = Library([roms], roots_path=tmp_path / 'library.json')
+    assert library.populate(workers=2) == 1
+    assert [entry.title for entry in library] == ['', 'ALPHA', 'charlie']
+
+
+def test_roots(tmp_path, cache, roms):
+    """Check that only the ROMs under the roots are listed, and that the roots are saved."""
+    other = tmp_path / 'roms2'
+    other.mkdir()
+    make_nds_rom(other / 'f.nds', title=b'FOXTROT')
+    roots_path = tmp_path / 'config' / 'library.json'
+    library = Library(roots_path=roots_path)
+    library.add_root(other)
+    library.populate()
+    assert [entry.title for entry in library] == ['FOXTROT']
+    assert json.loads(roots_path.read_text()) == [str(other.resolve())]
+
+    library.add_root(roms)
+    library.populate()
+    assert len(library) == 5
+    library.remove_root(other)
+
+    reloaded = Library(roots_path=roots_path)
+    reloaded.load_roots()
+    assert reloaded.roots == [roms.resolve()]
+    assert len(reloaded) == 4
+
+
+def test_pages(tmp_path, cache):
+    """Check that a large library is read one page at a time, keeping only the latest pages."""
+    root = tmp_path / 'roms'
+    now = time.time()
+    with cache._lock:
+        cache.connection.executemany(
+            'INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(str(root / f'{index:05d}.nds'), index, 0, index, 'NdsRom', json.dumps({'banner_title': f'{index}'}),
+              now, f'GAME {index % 100:02d}', f'NTR-{index:05d}', '01') for index in range(10000)])
+    library = Library([root], roots_path=tmp_path / 'library.json', page_size=100, max_pages=4)
+
+    assert len(library) == 10000
+    assert library[9999].title == 'GAME 99'
+    assert library[9999].banner_title == '9999'
+    assert library[0].product_code == 'NTR-00000'
+    assert library[150].product_code == 'NTR-05001'
+    for index in range(0, 10000, 1000):
+        library[index]
+    assert len(library._pages) == 4
+
+    library.filter('NTR-0999')
+    assert [entry.size for entry in library] == list(range(9990, 10000))
@@ -0,0 +1,36 @@
+import os
+
+from qtxds.manifest import BuildManifest
+
+
+def touch(path, data=b'data'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    stat = path.stat()
+    # Make sure the change is visible even on filesystems with coarse timestamps
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+
+def test_layers(tmp_path):
+    """Check that only the layers whose inputs changed are dirty."""
+    touch(tmp_path / 'exefs' / 'code.bin')
+    touch(tmp_path / 'romfs' / 'a' / 'b.txt')
+    layers = {'romfs': [tmp_path / 'romfs'], 'exefs': [tmp_path / 'exefs_header.bin', tmp_path / 'exefs']}
+
+    manifest = BuildManifest(tmp_path / 'manifest.json')
+    assert manifest.is_dirty('romfs', layers['romfs'])
+    for layer, paths in layers.items():
+        manifest.record(layer, paths)
+
+    manifest = BuildManifest(tmp_path / 'manifest.json')
+    assert not manifest.is_dirty('romfs', layers['romfs'])
+    assert not manifest.is_dirty('exefs', layers['exefs'])
+
+    touch(tmp_path / 'exefs' / 'code.bin', b'patched')
+    assert manifest.is_dirty('exefs', layers['exefs'])
+    assert not manifest.is_dirty('romfs', layers['romfs'])
+
+    touch(tmp_path / 'exefs_header.bin')
+    manifest.record('exefs', layers['exefs'])
+    (tmp_path / 'exefs_header.bin').unlink()
+    assert manifest.is_dirty('exefs', layers['exefs'])
@@ -0,0 +1,376 @@
+import os
+import struct
+import threading
+
+import pytest
+
+from qtxds.files import CopyCancelled
+from qtxds.nds import (NITROCODE, ROOT_DIRECTORY, RSA_SIGNATURE_SIZE, NdsHeader, NdsImage, build, build_fnt, crc16,
+                       extract, fix_header_crc, trim)
+
+FILES = {
+    'a.txt': b'hello',
+    'dir/b.bin': b'\x01' * 300,
+    'dir/sub/c.dat': b'\x02' * 17,
+}
+
+
+def make_nds_rom(path, files=FILES, title=b'TESTGAME', game_code=b'ATSE', maker_code=b'01'):
+    """Build a minimal, well-formed NDS ROM holding the given data files."""
+    directories = {'': []}
+    for name in sorted(files):
+        parts = name.split('/')
+        for depth in range(1, len(parts)):
+            parent, child = '/'.join(parts[:depth - 1]), '/'.join(parts[:depth])
+            if child not in directories:
+                directories[child] = []
+                directories[parent].append(('dir', parts[depth - 1], child))
+        directories['/'.join(parts[:-1])].append(('file', parts[-1], name))
+
+    order = list(directories)
+    file_ids = {}
+    subtables = []
+    for directory in order:
+        first = len(file_ids)
+        table = b''
+        for kind, name, full in directories[directory]:
+            if kind == 'file':
+                file_ids[full] = len(file_ids)
+                table += bytes([len(name)]) + name.encode()
+        for kind, name, full in directories[directory]:
+            if kind == 'dir':
+                table += bytes([0x80 | len(name)]) + name.encode()
+                table += struct.pack('<H', 0xF000 | order.index(full))
+        subtables.append((first, table + b'\0'))
+
+    main_table = b''
+    offset = len(order) * 8
+    for index, (first, table) in enumerate(subtables):
+        parent = len(order) if index == 0 else 0xF000 | order.index(order[index].rpartition('/')[0])
+        main_table += struct.pack('<IHH', offset, first, parent)
+        offset += len(table)
+    fnt = main_table + b''.join(table for _, table in subtables)
+
+    header = bytearray(0x200)
+    header[0x00:0x0C] = title.ljust(12, b'\0')
+    header[0x0C:0x10] = game_code
+    header[0x10:0x12] = maker_code
+
+    position = 0x200
+    fnt_offset = position
+    position += len(fnt)
+    fat_offset = position
+    position += len(file_ids) * 8
+    layout = []
+    for name in file_ids:
+        layout.append((position, position + len(files[name])))
+        position += len(files[name])
+
+    struct.pack_into('<IIII', header, 0x40, fnt_offset, len(fnt), fat_offset, len(file_ids) * 8)
+    struct.pack_into('<I', header, 0x80, position)
+    struct.pack_into('<H', header, 0x15E, crc16(header[:0x15E]))
+
+    rom = bytearray(position)
+    rom[:0x200] = header
+    rom[fnt_offset:fnt_offset + len(fnt)] = fnt
+    for index, (start, end) in enumerate(layout):
+        struct.pack_into('<II', rom, fat_offset + index * 8, start, end)
+    for name, (start, end) in zip(file_ids, layout):
+        rom[start:end] = files[name]
+    path.write_bytes(bytes(rom))
+    return path
+
+
+@pytest.fixture
+def rom(tmp_path):
+    return make_nds_rom(tmp_path / 'game.nds')
+
+
+def test_crc16():
+    """Check the CRC16 against the standard CRC-16/MODBUS check value, byte by byte and word by word."""
+    assert crc16(b'123456789') == 0x4B37
+    data = bytes(range(256)) * 20 + b'odd'
+    expected = 0xFFFF
+    for byte in data:
+        expected = crc16(bytes([byte]), expected)
+    assert crc16(data) == expected
+
+
+def test_check_crcs(rom):
+    """Check that the header, logo and banner CRCs are verified, and the secure area skipped when absent."""
+    add_sections(rom)
+    with NdsImage(rom) as image:
+        assert image.check_crcs() == {'header': True, 'logo': False, 'secure_area': None, 'banner': False}
+
+    data = bytearray(rom.read_bytes())
+    banner = struct.unpack_from('<I', data, 0x68)[0]
+    struct.pack_into('<H', data, banner + 2, crc16(data[banner + 0x20:banner + 0x840]))
+    struct.pack_into('<H', data, 0x15C, crc16(data[0xC0:0x15C]))
+    struct.pack_into('<H', data, 0x15E, crc16(data[:0x15E]))
+    rom.write_bytes(bytes(data))
+    with NdsImage(rom) as image:
+        assert image.check_crcs() == {'header': True, 'logo': True, 'secure_area': None, 'banner': True}
+
+
+def test_fix_header_crc(rom):
+    """Check that only the 2 bytes of the header CRC are rewritten, and only when they are wrong."""
+    data = bytearray(rom.read_bytes())
+    data[0] ^= 0xFF
+    rom.write_bytes(bytes(data))
+    assert fix_header_crc(rom)
+    fixed = rom.read_bytes()
+    assert fixed[:0x15E] == data[:0x15E] and fixed[0x160:] == data[0x160:]
+    with NdsImage(rom) as image:
+        assert image.header.is_header_crc_ok
+    assert not fix_header_crc(rom)
+
+
+def test_header(rom):
+    """Check that the header fields are parsed the way ndstool reports them."""
+    with NdsImage(rom) as image:
+        assert image.header.title == 'TESTGAME'
+        assert image.header.maker_code == '01'
+        assert image.header.product_code == 'NTR-ATSE-USA'
+        assert image.header.is_header_crc_ok
+
+
+def test_header_crc_invalid(rom):
+    """Check that a corrupted header is reported as such."""
+    data = bytearray(rom.read_bytes())
+    data[0] ^= 0xFF
+    rom.write_bytes(bytes(data))
+    with NdsImage(rom) as image:
+        assert not image.header.is_header_crc_ok
+
+
+def test_truncated_header(tmp_path):
+    """Check that a file too small to hold a header is rejected."""
+    path = tmp_path / 'short.nds'
+    path.write_bytes(b'\0' * 0x100)
+    with pytest.raises(ValueError):
+        NdsImage(path)
+    with pytest.raises(ValueError):
+        NdsHeader(b'\0' * 0x100)
+
+
+def test_files(rom):
+    """Check that the FNT is walked into full paths with their FAT ids."""
+    with NdsImage(rom) as image:
+        assert sorted(path for _, path in image.files()) == sorted(FILES)
+        fat = image.fat()
+        for file_id, path in image.files():
+            start, end = fat[file_id]
+            assert image.data[start:end] == FILES[path]
+
+
+def test_listdir_read_export(rom, tmp_path):
+    """Check that single directories are listed and single files read or exported from the ROM."""
+    with NdsImage(rom) as image:
+        root = image.listdir(ROOT_DIRECTORY)
+        assert [(name, is_directory) for name, is_directory, _ in root] == [('a.txt', False), ('dir', True)]
+        directory_id = root[1][2]
+        entries = {name: entry_id for name, _, entry_id in image.listdir(directory_id)}
+        assert image.read(entries['b.bin']) == FILES['dir/b.bin']
+        assert image.read(entries['b.bin'], 10) == FILES['dir/b.bin'][:10]
+        assert image.export(entries['b.bin'], tmp_path / 'b.bin') == 300
+        with pytest.raises(ValueError):
+            image.read(100)
+    assert (tmp_path / 'b.bin').read_bytes() == FILES['dir/b.bin']
+
+
+def test_content_size(rom):
+    """Check that the content size adds up every file in the FNT."""
+    with NdsImage(rom) as image:
+        assert image.content_size == sum(len(data) for data in FILES.values())
+
+
+@pytest.mark.parametrize('offset, value', [
+    (0x40, 0xFFFFFF00),  # FNT offset
+    (0x44, 0xFFFF),  # FNT size
+    (0x48, 0xFFFFFF00),  # FAT offset
+    (0x4C, 8),  # FAT size, too small for the FNT
+])
+def test_corrupt_tables(rom, offset, value):
+    """Check that FNT and FAT tables pointing out of the ROM are refused instead of read out of bounds."""
+    data = bytearray(rom.read_bytes())
+    struct.pack_into('<I', data, offset, value)
+    rom.write_bytes(bytes(data))
+    with NdsImage(rom) as image:
+        with pytest.raises(ValueError, match='Invalid'):
+            image.content_size
+
+
+def test_trim(rom):
+    """Check that padding is truncated away in place."""
+    data = rom.read_bytes()
+    rom.write_bytes(data + b'\xff' * 0x10000)
+    assert trim(rom) == 0x10000
+    assert rom.read_bytes() == data
+    assert trim(rom) == 0
+
+
+def test_trim_keeps_rsa_signature(rom):
+    """Check that a download play signature right after the used area is kept."""
+    data = rom.read_bytes() + b'ac' + b'\x01' * (RSA_SIGNATURE_SIZE - 2)
+    rom.write_bytes(data + b'\xff' * 0x1000)
+    trim(rom)
+    assert rom.read_bytes() == data
+
+
+def test_trim_invalid_header(rom):
+    """Check that a ROM with a broken header is left alone."""
+    data = bytearray(rom.read_bytes() + b'\xff' * 0x1000)
+    data[0] ^= 0xFF
+    rom.write_bytes(bytes(data))
+    with pytest.raises(ValueError):
+        trim(rom)
+    assert rom.read_bytes() == bytes(data)
+
+
+def add_sections(rom):
+    """Append an ARM9 binary with its nitrocode footer, an overlay table using file 0 and a banner."""
+    data = bytearray(rom.read_bytes())
+    arm9 = b'\x09' * 0x100
+    footer = struct.pack('<III', NITROCODE, 0, 0)
+    arm9_offset = len(data)
+    data += arm9 + footer
+    overlay9_offset = len(data)
+    data += struct.pack('<8I', 0, 0, 0, 0, 0, 0, 0, 0)
+    banner_offset = len(data)
+    data += struct.pack('<H', 1) + b'\x0b' * (0x840 - 2)
+    struct.pack_into('<I', data, 0x20, arm9_offset)
+    struct.pack_into('<I', data, 0x2C, len(arm9))
+    struct.pack_into('<II', data, 0x50, overlay9_offset, 0x20)
+    struct.pack_into('<I', data, 0x68, banner_offset)
+    struct.pack_into('<I', data, 0x80, len(data))
+    struct.pack_into('<H', data, 0x15E, crc16(data[:0x15E]))
+    rom.write_bytes(bytes(data))
+    return arm9 + footer, data[banner_offset:]
+
+
+def test_extract(rom, tmp_path):
+    """Check that the data tree, overlays and sections are extracted where ndstool -x puts them."""
+    arm9, banner = add_sections(rom)
+    out = tmp_path / 'game'
+    targets = {name: out / f'{name}.bin' for name in ('arm9', 'arm7', 'overlay9', 'banner', 'header')}
+    calls = []
+
+    total = extract(rom, targets, out / 'data', out / 'overlay', progress=lambda done, total: calls.append(done),
+                    workers=2)
+
+    for name, data in FILES.items():
+        assert (out / 'data' / name).read_bytes() == data
+    assert (out / 'overlay' / 'overlay_0000.bin').read_bytes() == FILES['a.txt']
+    assert (out / 'arm9.bin').read_bytes() == arm9
+    assert (out / 'arm7.bin').read_bytes() == b''
+    assert (out / 'banner.bin').read_bytes() == banner
+    assert (out / 'header.bin').read_bytes() == rom.read_bytes()[:0x200]
+    assert not (out / 'overlay7.bin').exists()
+    assert calls[-1] == total
+
+
+def test_extract_cancelled(rom, tmp_path):
+    """Check that a cancelled extraction stops with CopyCancelled."""
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(CopyCancelled):
+        extract(rom, {}, tmp_path / 'data', tmp_path / 'overlay', cancelled=cancelled)
+
+
+def test_extract_unsafe_name(tmp_path):
+    """Check that file names escaping the data directory are refused."""
+    rom = make_nds_rom(tmp_path / 'evil.nds', {'../escape.txt': b'x'})
+    with pytest.raises(ValueError):
+        extract(rom, {}, tmp_path / 'out' / 'data', tmp_path / 'out' / 'overlay')
+    assert not os.path.exists(tmp_path / 'out' / 'escape.txt')
+
+
+def extract_all(rom, out):
+    sources = {name: out / f'{name}.bin' for name in ('arm9', 'arm7', 'overlay9', 'overlay7', 'banner', 'header')}
+    extract(rom, sources, out / 'data', out / 'overlay')
+    return sources
+
+
+def test_build_fnt(tmp_path):
+    """Check that the FNT sorts names regardless of case and numbers files after the overlays, depth first."""
+    for name in ('b/z.bin', 'b/c/y.bin', 'B.txt', 'a.bin', 'd/x.bin'):
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_bytes(b'')
+    fnt, files = build_fnt(tmp_path, 2)
+    assert [os.path.relpath(name, tmp_path) for name in files] == ['a.bin', 'B.txt', 'b/z.bin', 'b/c/y.bin',
+                                                                   'd/x.bin']
+    # Root, b, b/c then d, the root's parent being the number of directories
+    assert [struct.unpack_from('<IHH', fnt, index * 8)[1:] for index in range(4)] == [
+        (2, 4), (4, 0xF000), (5, 0xF001), (6, 0xF000)]
+
+    (tmp_path / 'caf\xe9.bin').write_bytes(b'')
+    with pytest.raises(ValueError):
+        build_fnt(tmp_path)
+
+
+def test_build(rom, tmp_path):
+    """Check that an extracted ROM is rebuilt aligned, with its files, overlays, sections and CRCs."""
+    arm9, banner = add_sections(rom)
+    sources = extract_all(rom, tmp_path / 'game')
+    rebuilt = tmp_path / 'rebuilt.nds'
+    calls = []
+
+    size = build(rebuilt, sources, tmp_path / 'game' / 'data', tmp_path / 'game' / 'overlay',
+                 progress=lambda done, total: calls.append(done), workers=2)
+
+    assert rebuilt.stat().st_size == size
+    assert not (tmp_path / '.rebuilt.nds.qtxds').exists()
+    with NdsImage(rebuilt) as image:
+        header = image.header
+        assert image.check_crcs()['header'] and image.check_crcs()['logo']
+        assert header.arm9_size == len(arm9) - 12
+        assert image.data[header.arm9_rom_offset:header.arm9_rom_offset + len(arm9)] == arm9
+        assert image.banner() == banner
+        assert header.title == 'TESTGAME' and struct.unpack_from('<I', image.data, 0x80)[0] == size
+        for offset in (header.arm9_rom_offset, header.overlay9_offset, header.fnt_offset, header.fat_offset,
+                       header.banner_offset):
+            assert offset % 0x200 == 0
+        assert list(image.overlays()) == [0]
+        assert image.read(0) == FILES['a.txt']
+        assert dict((path, image.read(file_id)) for file_id, path in image.files()) == FILES
+        assert min(file_id for file_id, _ in image.files()) == 1
+    assert calls[-1] == len(arm9) + 0x20 + len(banner) + len(FILES['a.txt']) + sum(map(len, FILES.values()))
+
+    # Rebuilding what was extracted from a rebuilt ROM gives the same ROM
+    sources = extract_all(rebuilt, tmp_path / 'again')
+    build(tmp_path / 'again.nds', sources, tmp_path / 'again' / 'data', tmp_path / 'again' / 'overlay')
+    assert (tmp_path / 'again.nds').read_bytes() == rebuilt.read_bytes()
+
+
+def test_build_parity(rom, tmp_path):
+    """Check that a rebuilt ROM only differs from the original in its layout: offsets, sizes and CRCs."""
+    sources = extract_all(rom, tmp_path / 'game')
+    rebuilt = tmp_path / 'rebuilt.nds'
+    build(rebuilt, sources, tmp_path / 'game' / 'data', tmp_path / 'game' / 'overlay')
+
+    with NdsImage(rom) as original, NdsImage(rebuilt) as image:
+        # Device capacity, section offsets and sizes, FNT and FAT, banner offset, used size and CRCs
+        layout = [0x14, *range(0x20, 0x50), *range(0x68, 0x6C), *range(0x80, 0x84), *range(0x15C, 0x160)]
+        before, after = bytearray(original.header.raw), bytearray(image.header.raw)
+        for offset in layout:
+            before[offset] = after[offset] = 0
+        assert after == before
+
+        fnt = original.data[original.header.fnt_offset:original.header.fnt_offset + original.header.fnt_size]
+        assert image.data[image.header.fnt_offset:image.header.fnt_offset + image.header.fnt_size] == fnt
+        assert list(image.files()) == list(original.files())
+        assert len(image.fat()) == len(original.fat())
+        for file_id, _ in original.files():
+            assert image.read(file_id) == original.read(file_id)
+            assert image.fat()[file_id][0] % 0x200 == 0
+
+
+def test_build_dsi(rom, tmp_path):
+    """Check that DSi ROMs are left to ndstool."""
+    sources = extract_all(rom, tmp_path / 'game')
+    header = bytearray(sources['header'].read_bytes())
+    header[0x12] = 0x02
+    sources['header'].write_bytes(bytes(header))
+    with pytest.raises(ValueError):
+        build(tmp_path / 'rebuilt.nds', sources, tmp_path / 'game' / 'data', tmp_path / 'game' / 'overlay')
+    assert not (tmp_path / 'rebuilt.nds').exists()
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+from qtxds.process import ToolError, run
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='uses POSIX process groups')
+
+
+def python(code):
+    return [sys.executable, '-c', code]
+
+
+def test_capture_output():
+    """Check that standard output is returned when captured."""
+    assert asyncio.run(run(python('print("0x6C (OK)")'), capture_output=True)) == '0x6C (OK)\n'
+    assert asyncio.run(run(python('print("ignored")'))) is None
+
+
+def test_exit_status():
+    """Check that a failing tool raises a ToolError with its standard error."""
+    with pytest.raises(ToolError) as e:
+        asyncio.run(run(python('import sys; sys.exit("Cannot open file")')))
+    assert e.value.returncode == 1
+    assert 'Cannot open file' in str(e.value)
+
+
+def test_timeout_kills_process_group(tmp_path):
+    """Check that a timed out tool is killed along with the processes it spawned."""
+    pid_file = tmp_path / 'pid'
+    code = ('import subprocess, sys, time; '
+            'child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"]); '
+            f'open({str(pid_file)!r}, "w").write(str(child.pid)); time.sleep(60)')
+
+    with pytest.raises(ToolError):
+        asyncio.run(run(python(code), timeout=1))
+
+    pid = int(pid_file.read_text())
+    for _ in range(50):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            break
+        asyncio.run(asyncio.sleep(0.1))
+    else:
+        pytest.fail('grandchild survived the timeout')
+
+
+def test_cancel():
+    """Check that cancelling the caller kills the tool instead of leaving it running."""
+    async def cancel():
+        task = asyncio.ensure_future(run(python('import time; time.sleep(60)')))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(cancel(), 10))
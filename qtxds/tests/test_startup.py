@@ -0,0 +1,44 @@
+import json
+import subprocess
+import sys
+
+from qtxds import tools
+
+IMPORT_BUDGET = 0.5
+
+SCRIPT = '''
+import json, shutil, sys, time
+calls = []
+which = shutil.which
+shutil.which = lambda *args, **kwargs: calls.append(args) or which(*args, **kwargs)
+start = time.perf_counter()
+import qtxds.roms
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "elapsed": elapsed,
+    "which": len(calls),
+    "qt": sorted(name for name in sys.modules if name.split(".")[0] in ("PyQt5", "quamash")),
+}))
+'''
+
+
+def test_import_budget():
+    """Check that the ROM core imports quickly, without Qt and without looking up the tools."""
+    output = subprocess.run([sys.executable, '-c', SCRIPT], check=True, stdout=subprocess.PIPE).stdout
+    result = json.loads(output)
+    assert result['qt'] == []
+    assert result['which'] == 0
+    assert result['elapsed'] < IMPORT_BUDGET
+
+
+def test_tool_resolution_cached(monkeypatch):
+    """Check that a tool is looked up on first use only, once for every instance."""
+    calls = []
+    monkeypatch.setattr(tools.shutil, 'which', lambda tool: calls.append(tool) or f'/usr/bin/{tool}')
+    tools.which.cache_clear()
+
+    first, second = tools.NdsTool(), tools.NdsTool()
+    assert calls == []
+    assert first.path == second.path == '/usr/bin/ndstool'
+    assert calls == ['ndstool']
+    tools.which.cache_clear()
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import sys
+import threading
+
+import pytest
+
+from qtxds import telemetry as telemetry_module
+from qtxds.process import run
+from qtxds.telemetry import Telemetry, count, measured, threadsafe_listener
+
+
+class FakeRom:
+    def __init__(self, path):
+        self.path = path
+
+
+class FakeTool:
+    @measured
+    async def extract_all(self, rom, status_bar):
+        with telemetry_module.telemetry.record('FakeTool.step', rom):
+            pass
+
+    @measured
+    async def broken(self, rom, status_bar):
+        raise RuntimeError()
+
+
+@pytest.fixture
+def telemetry(tmp_path, monkeypatch):
+    telemetry = Telemetry(tmp_path / 'telemetry.jsonl', tmp_path / 'qtxds.prom')
+    monkeypatch.setattr(telemetry_module, 'telemetry', telemetry)
+    return telemetry
+
+
+def test_measured(tmp_path, telemetry):
+    """Check that nested operations are recorded with their parent, and errors with their type."""
+    rom = tmp_path / 'game.nds'
+    rom.write_bytes(b'\0' * 100)
+    asyncio.run(FakeTool().extract_all(FakeRom(rom), None))
+    with pytest.raises(RuntimeError):
+        asyncio.run(FakeTool().broken(FakeRom(rom), None))
+
+    step, extract_all, broken = telemetry.records
+    assert step['operation'] == 'FakeTool.step' and step['parent'] == 'FakeTool.extract_all'
+    assert extract_all['parent'] is None and extract_all['status'] == 'ok'
+    assert extract_all['rom_size'] == 100 and extract_all['wall_seconds'] >= 0
+    assert broken['status'] == 'RuntimeError'
+
+
+def test_sinks(tmp_path, telemetry):
+    """Check the JSON lines and Prometheus textfile outputs."""
+    with telemetry.record('Rom.backup'):
+        pass
+    with telemetry.record('Rom.backup'):
+        pass
+
+    lines = (tmp_path / 'telemetry.jsonl').read_text().splitlines()
+    assert [json.loads(line)['operation'] for line in lines] == ['Rom.backup', 'Rom.backup']
+    assert 'qtxds_operation_count_total{operation="Rom.backup"} 2' in (tmp_path / 'qtxds.prom').read_text()
+
+
+def test_concurrent(telemetry):
+    """Check that operations running at the same time are only charged for their own work."""
+    async def operation(name, size):
+        with telemetry.record(name):
+            await asyncio.sleep(0.1)
+            count(bytes_read=size)
+            if name == 'tool':
+                await run([sys.executable, '-c', 'sum(range(10 ** 7))'])
+            await asyncio.sleep(0.1)
+
+    async def main():
+        await asyncio.gather(operation('copy', 100), operation('tool', 5))
+
+    asyncio.run(main())
+    records = {record['operation']: record for record in telemetry.records}
+    assert records['copy']['bytes_read'] == 100 and records['tool']['bytes_read'] == 5
+    assert records['copy']['subprocess_cpu_seconds'] == 0 and records['tool']['subprocess_cpu_seconds'] > 0
+
+
+def test_prometheus_environment(tmp_path, monkeypatch):
+    """Check that the Prometheus sink can be turned on from the environment."""
+    assert Telemetry(tmp_path / 'telemetry.jsonl').prometheus_path is None
+    monkeypatch.setenv('QTXDS_PROMETHEUS', str(tmp_path / 'qtxds.prom'))
+    assert Telemetry(tmp_path / 'telemetry.jsonl').prometheus_path == str(tmp_path / 'qtxds.prom')
+
+
+def test_jsonl_rotation(tmp_path):
+    """Check that the JSON lines file is moved aside once it passes its size, keeping a single old file."""
+    telemetry = Telemetry(tmp_path / 'telemetry.jsonl', max_jsonl_size=1000)
+    for index in range(20):
+        with telemetry.record(f'Rom.operation{index}'):
+            pass
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['telemetry.jsonl', 'telemetry.jsonl.1']
+    line = max(len(line) + 1 for line in (tmp_path / 'telemetry.jsonl.1').read_text().splitlines())
+    assert 1000 < (tmp_path / 'telemetry.jsonl.1').stat().st_size <= 1000 + line
+    lines = (tmp_path / 'telemetry.jsonl').read_text().splitlines()
+    assert json.loads(lines[-1])['operation'] == 'Rom.operation19'
+
+
+def test_threadsafe_listener(telemetry):
+    """Check that records made on another thread are handed to the listener on the thread of the event loop."""
+    calls = []
+
+    def worker():
+        with telemetry.record('worker'):
+            pass
+
+    async def main():
+        telemetry.listeners.append(threadsafe_listener(
+            lambda record: calls.append((record['operation'], threading.current_thread()))))
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+        assert calls == []
+        await asyncio.sleep(0.1)
+
+    asyncio.run(main())
+    assert calls == [('worker', threading.main_thread())]
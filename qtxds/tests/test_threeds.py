@@ -0,0 +1,285 @@
+import struct
+import threading
+
+import pytest
+
+from qtxds.banner import LARGE_ICON_OFFSET, SMDH_SIZE, SMDH_TITLE_SIZE, SMDH_TITLES_OFFSET
+from qtxds.files import CopyCancelled
+from qtxds.threeds import ROMFS_NONE, NcchHeader, NcsdHeader, ThreedsImage, pad, trim
+
+UNIT = 0x200
+ROMFS_FILES = {
+    'a.txt': b'hello',
+    'sound/b.bcstm': b'\x01' * 300,
+    'sound/bgm/c.bcstm': b'\x02' * 17,
+}
+
+
+def align(size, alignment=UNIT):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def make_ncch(exefs=b'', romfs=b'', maker_code=b'01', product_code=b'CTR-P-ATSE'):
+    """Build a decrypted NCCH partition with the given ExeFS and RomFS images."""
+    header = bytearray(0x200)
+    header[0x100:0x104] = b'NCCH'
+    header[0x110:0x112] = maker_code
+    header[0x150:0x150 + len(product_code)] = product_code
+    struct.pack_into('<I', header, 0x180, 0x400)
+    header[0x18F] = 0x04
+
+    body = bytearray(0xA00)
+    exefs_offset = len(header) + len(body)
+    body += exefs.ljust(align(len(exefs)), b'\0')
+    romfs_offset = len(header) + len(body)
+    body += romfs.ljust(align(len(romfs)), b'\0')
+
+    struct.pack_into('<I', header, 0x104, (len(header) + len(body)) // UNIT)
+    struct.pack_into('<II', header, 0x198, 2, 1)
+    if exefs:
+        struct.pack_into('<II', header, 0x1A0, exefs_offset // UNIT, align(len(exefs)) // UNIT)
+    if romfs:
+        struct.pack_into('<II', header, 0x1B0, romfs_offset // UNIT, align(len(romfs)) // UNIT)
+    return bytes(header + body)
+
+
+def make_exefs(files):
+    """Build an ExeFS image, without the hashes of its files."""
+    header = bytearray(0x200)
+    data = b''
+    for index, (name, content) in enumerate(files.items()):
+        struct.pack_into('<8sII', header, index * 0x10, name.encode(), len(data), len(content))
+        data += content.ljust(align(len(content)), b'\0')
+    return bytes(header) + data
+
+
+def make_smdh(short_title='Test Game', publisher='Test Publisher'):
+    smdh = bytearray(SMDH_SIZE)
+    smdh[:4] = b'SMDH'
+    english = SMDH_TITLES_OFFSET + SMDH_TITLE_SIZE
+    title = short_title.encode('utf-16-le')
+    smdh[english:english + len(title)] = title
+    publisher = publisher.encode('utf-16-le')
+    smdh[english + 0x180:english + 0x180 + len(publisher)] = publisher
+    # Pure red large icon
+    smdh[LARGE_ICON_OFFSET:] = b'\x00\xf8' * (48 * 48)
+    return bytes(smdh)
+
+
+def make_romfs(files=ROMFS_FILES):
+    """Build a RomFS image with an IVFC header and level 3 tables, without any hashes."""
+    directories = {'': {'directories': [], 'files': []}}
+    for name in sorted(files):
+        parts = name.split('/')
+        for depth in range(1, len(parts)):
+            parent, child = '/'.join(parts[:depth - 1]), '/'.join(parts[:depth])
+            if child not in directories:
+                directories[child] = {'directories': [], 'files': []}
+                directories[parent]['directories'].append(child)
+        directories['/'.join(parts[:-1])]['files'].append(name)
+
+    def encode(name):
+        name = name.rpartition('/')[2].encode('utf-16-le')
+        return name, name.ljust(align(len(name), 4), b'\0')
+
+    directory_offsets, position = {}, 0
+    for directory in directories:
+        directory_offsets[directory] = position
+        position += 0x18 + len(encode(directory)[1])
+    file_offsets, position = {}, 0
+    for directory in directories:
+        for name in directories[directory]['files']:
+            file_offsets[name] = position
+            position += 0x20 + len(encode(name)[1])
+
+    def first(entries, offsets):
+        return offsets[entries[0]] if entries else ROMFS_NONE
+
+    def sibling(entries, entry, offsets):
+        index = entries.index(entry)
+        return offsets[entries[index + 1]] if index + 1 < len(entries) else ROMFS_NONE
+
+    directory_table = b''
+    for directory, children in directories.items():
+        parent = directory.rpartition('/')[0]
+        siblings = directories[parent]['directories'] if directory else [directory]
+        name, padded = encode(directory)
+        directory_table += struct.pack('<6I', directory_offsets[parent], sibling(siblings, directory, directory_offsets),
+                                       first(children['directories'], directory_offsets),
+                                       first(children['files'], file_offsets), ROMFS_NONE, len(name)) + padded
+    file_table, data = b'', b''
+    for directory, children in directories.items():
+        for path in children['files']:
+            name, padded = encode(path)
+            file_table += struct.pack('<IIQQII', directory_offsets[directory],
+                                      sibling(children['files'], path, file_offsets), len(data), len(files[path]),
+                                      ROMFS_NONE, len(name)) + padded
+            data += files[path].ljust(align(len(files[path]), 0x10), b'\0')
+
+    directory_table_offset = 0x28
+    file_table_offset = directory_table_offset + len(directory_table)
+    data_offset = align(file_table_offset + len(file_table), 0x10)
+    level3 = struct.pack('<10I', 0x28, directory_table_offset, 0, directory_table_offset, len(directory_table),
+                         file_table_offset, 0, file_table_offset, len(file_table), data_offset)
+    level3 += directory_table + file_table
+    level3 = level3.ljust(data_offset, b'\0') + data
+
+    ivfc = bytearray(0x1000)
+    ivfc[0:4] = b'IVFC'
+    struct.pack_into('<II', ivfc, 0x04, 0x10000, 0x20)
+    struct.pack_into('<QQI', ivfc, 0x3C, 0, len(level3), 12)
+    return bytes(ivfc) + level3
+
+
+def make_threeds_rom(path, ncch=None, media_size=0x10000, padded=False):
+    """Build an NCSD image holding a single NCCH partition."""
+    ncch = make_ncch() if ncch is None else ncch
+    header = bytearray(0x4000)
+    header[0x100:0x104] = b'NCSD'
+    struct.pack_into('<I', header, 0x104, media_size)
+    struct.pack_into('<II', header, 0x120, len(header) // UNIT, len(ncch) // UNIT)
+    data = bytes(header) + ncch
+    if padded:
+        data = data.ljust(media_size * UNIT, b'\xff')
+    path.write_bytes(data)
+    return path
+
+
+@pytest.fixture
+def rom(tmp_path):
+    return make_threeds_rom(tmp_path / 'game.3ds', make_ncch(exefs=b'\1' * 0x300, romfs=b'\2' * 0x1000))
+
+
+def test_image(rom):
+    """Check that the NCSD and NCCH fields are read the way ctrtool reports them."""
+    with ThreedsImage(rom) as image:
+        assert image.ncsd_header.media_size == 0x10000
+        assert image.ncsd_header.media_unit_size == UNIT
+        assert image.partition_offset == 0x4000
+        assert image.ncch_header.maker_code == '01'
+        assert image.ncch_header.product_code == 'CTR-P-ATSE'
+        assert image.ncch_header.extended_header_size == 0x400
+        assert image.ncch_header.logo_size == UNIT
+        assert image.ncch_header.exefs_size == 0x400
+        assert image.ncch_header.romfs_size == 0x1000
+        assert image.ncch_header.content_size == 0xC00 + 0x400 + 0x1000
+        assert not image.ncch_header.is_encrypted
+
+
+def test_used_size(rom):
+    """Check that the used size ends with the last partition."""
+    with ThreedsImage(rom) as image:
+        assert image.ncsd_header.used_size == rom.stat().st_size
+
+
+def test_invalid_magic():
+    """Check that headers without their magic are rejected."""
+    with pytest.raises(ValueError):
+        NcsdHeader(b'\0' * 0x200)
+    with pytest.raises(ValueError):
+        NcchHeader(b'\0' * 0x200)
+
+
+def test_trim_pad(tmp_path):
+    """Check that padding fills up to the media size with 0xFF and that trimming undoes it."""
+    rom = make_threeds_rom(tmp_path / 'game.3ds', media_size=0x40)
+    data = rom.read_bytes()
+    calls = []
+    assert pad(rom, lambda done, total: calls.append(done), chunk_size=0x1000) == 0x40 * UNIT - len(data)
+    assert rom.read_bytes() == data.ljust(0x40 * UNIT, b'\xff')
+    assert calls[-1] == 0x40 * UNIT - len(data)
+    assert pad(rom) == 0
+
+    assert trim(rom) == 0x40 * UNIT - len(data)
+    assert rom.read_bytes() == data
+
+
+def test_trim_refuses_data(tmp_path):
+    """Check that trimming refuses to cut anything but 0xFF padding past the last partition."""
+    rom = make_threeds_rom(tmp_path / 'game.3ds', media_size=0x40, padded=True)
+    padded = bytearray(rom.read_bytes())
+    padded[-0x1800] = 0x00
+    rom.write_bytes(bytes(padded))
+    with pytest.raises(ValueError, match=hex(len(padded) - 0x1800)):
+        trim(rom, chunk_size=0x1000)
+    assert rom.read_bytes() == padded
+
+
+def test_pad_cancelled(tmp_path):
+    """Check that a cancelled pad leaves the ROM as it was."""
+    rom = make_threeds_rom(tmp_path / 'game.3ds', media_size=0x40)
+    data = rom.read_bytes()
+    cancelled = threading.Event()
+    with pytest.raises(CopyCancelled):
+        pad(rom, lambda done, total: cancelled.set(), cancelled, chunk_size=0x1000)
+    assert rom.read_bytes() == data
+
+
+def test_romfs(tmp_path):
+    """Check that RomFS directories are listed and single files read or exported in place."""
+    rom = make_threeds_rom(tmp_path / 'game.3ds', make_ncch(romfs=make_romfs()))
+    with ThreedsImage(rom) as image:
+        romfs = image.romfs()
+        root = romfs.listdir()
+        assert [(name, is_directory) for name, is_directory, _ in root] == [('sound', True), ('a.txt', False)]
+        assert sorted(path for _, path in romfs.files()) == sorted(ROMFS_FILES)
+        for file_offset, path in romfs.files():
+            assert romfs.read(file_offset) == ROMFS_FILES[path]
+            assert romfs.file_location(file_offset)[1] == len(ROMFS_FILES[path])
+        files = dict((path, file_offset) for file_offset, path in romfs.files())
+        assert romfs.read(files['sound/b.bcstm'], 10) == ROMFS_FILES['sound/b.bcstm'][:10]
+        assert romfs.export(files['sound/bgm/c.bcstm'], tmp_path / 'c.bcstm') == 17
+    assert (tmp_path / 'c.bcstm').read_bytes() == ROMFS_FILES['sound/bgm/c.bcstm']
+
+
+def test_romfs_encrypted(tmp_path):
+    """Check that an encrypted RomFS is refused."""
+    ncch = bytearray(make_ncch(romfs=make_romfs()))
+    ncch[0x18F] = 0
+    rom = make_threeds_rom(tmp_path / 'game.3ds', bytes(ncch))
+    with ThreedsImage(rom) as image:
+        with pytest.raises(ValueError):
+            image.romfs()
+
+
+def test_smdh(tmp_path):
+    """Check that the SMDH is read straight from the ExeFS of a decrypted ROM."""
+    exefs = make_exefs({'code': b'\1' * 0x300, 'icon': make_smdh()})
+    rom = make_threeds_rom(tmp_path / 'game.3ds', make_ncch(exefs=exefs))
+    with ThreedsImage(rom) as image:
+        assert set(image.exefs_files()) == {'code', 'icon'}
+        assert image.read_exefs('code') == b'\1' * 0x300
+        smdh = image.smdh()
+    assert smdh.titles == {'english': 'Test Game\nTest Publisher'}
+    assert smdh.title == 'Test Game\nTest Publisher'
+    assert smdh.icon()[:8] == b'\xff\x00\x00\xff' * 2
+
+    with ThreedsImage(make_threeds_rom(tmp_path / 'other.3ds', make_ncch(exefs=make_exefs({'code': b'\1'})))) as image:
+        assert image.smdh() is None
+
+
+def test_exefs_encrypted(tmp_path):
+    """Check that an encrypted ExeFS is refused."""
+    ncch = bytearray(make_ncch(exefs=make_exefs({'icon': make_smdh()})))
+    ncch[0x18F] = 0
+    rom = make_threeds_rom(tmp_path / 'game.3ds', bytes(ncch))
+    with ThreedsImage(rom) as image:
+        with pytest.raises(ValueError):
+            image.smdh()
+
+
+def test_trim_cancelled(tmp_path):
+    """Check that trimming reports its progress and that a cancelled trim leaves the ROM as it was."""
+    rom = make_threeds_rom(tmp_path / 'game.3ds', media_size=0x40, padded=True)
+    padded = rom.read_bytes()
+    cancelled = threading.Event()
+    calls = []
+
+    def progress(done, total):
+        calls.append((done, total))
+        cancelled.set()
+
+    with pytest.raises(CopyCancelled):
+        trim(rom, progress, cancelled, chunk_size=0x1000)
+    assert calls == [(0x1000, calls[0][1])]
+    assert rom.read_bytes() == padded
@@ -0,0 +1,137 @@
+import os
+
+import pytest
+
+from qtxds.banner import ThumbnailCache
+from qtxds.cache import MetadataCache
+from qtxds.library import Library
+from qtxds.roms import Rom
+from qtxds.tests.test_nds import make_nds_rom
+from qtxds.watcher import Changes, Inotify, LibraryWatcher, directories
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    root = tmp_path / 'roms'
+    root.mkdir()
+    try:
+        watcher = LibraryWatcher([root], Changes(delay=0))
+    except OSError:
+        pytest.skip('inotify is not available')
+    yield watcher
+    watcher.close()
+
+
+def pending(watcher):
+    watcher.process()
+    changed, deleted = watcher.changes.ready()
+    return sorted(path.name for path in changed), sorted(path.name for path in deleted)
+
+
+def test_changes_debounce():
+    """Check that a path is only ready once it has been quiet, keeping its latest state."""
+    clock = Clock()
+    changes = Changes(delay=2, clock=clock)
+    assert changes.next_deadline() is None
+    changes.add('/roms/a.nds')
+    changes.add('/roms/b.nds')
+    clock.now = 1
+    changes.add('/roms/a.nds', deleted=True)
+    assert changes.next_deadline() == 1
+    assert changes.ready() == ([], [])
+
+    clock.now = 2
+    changed, deleted = changes.ready()
+    assert [path.name for path in changed] == ['b.nds'] and deleted == []
+    assert changes.next_deadline() == 1
+    clock.now = 3
+    changed, deleted = changes.ready()
+    assert changed == [] and [path.name for path in deleted] == ['a.nds']
+    assert len(changes) == 0
+
+
+def test_watch_files(watcher, tmp_path):
+    """Check that created, modified, moved and deleted ROMs are reported, and nothing else."""
+    root = tmp_path / 'roms'
+    make_nds_rom(root / 'a.nds')
+    (root / 'notes.txt').write_text('not a ROM')
+    assert pending(watcher) == (['a.nds'], [])
+
+    os.truncate(root / 'a.nds', 0x200)
+    assert pending(watcher) == (['a.nds'], [])
+
+    (root / 'a.nds').rename(root / 'b.nds')
+    assert pending(watcher) == (['b.nds'], ['a.nds'])
+
+    (root / 'b.nds').unlink()
+    assert pending(watcher) == ([], ['b.nds'])
+
+
+def test_watch_directories(watcher, tmp_path):
+    """Check that directories moved in are watched along with their ROMs, and that moved out ones are forgotten."""
+    root = tmp_path / 'roms'
+    outside = tmp_path / 'outside' / 'nested'
+    outside.mkdir(parents=True)
+    make_nds_rom(outside / 'c.nds')
+    (tmp_path / 'outside').rename(root / 'moved')
+    assert pending(watcher) == (['c.nds'], [])
+
+    make_nds_rom(root / 'moved' / 'nested' / 'd.nds')
+    assert pending(watcher) == (['d.nds'], [])
+
+    (root / 'moved').rename(tmp_path / 'gone')
+    assert pending(watcher) == ([], ['moved'])
+    assert sorted(watcher.inotify.directories.values()) == [str(root)]
+    make_nds_rom(tmp_path / 'gone' / 'nested' / 'e.nds')
+    assert pending(watcher) == ([], [])
+
+
+def test_inotify_close(tmp_path):
+    """Check that closing inotify forgets every watch."""
+    try:
+        inotify = Inotify()
+    except OSError:
+        pytest.skip('inotify is not available')
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    (tmp_path / 'c').mkdir()
+    assert sorted(directories([tmp_path])) == [str(tmp_path), str(tmp_path / 'a'), str(tmp_path / 'a' / 'b'),
+                                               str(tmp_path / 'c')]
+    inotify.watch(tmp_path)
+    assert len(inotify.directories) == 4
+    inotify.close()
+    assert inotify.directories == {} and inotify.fileno() == -1
+
+
+def test_apply(tmp_path, monkeypatch):
+    """Check that applying changes analyzes the changed ROMs and forgets the deleted ones and directories."""
+    cache = MetadataCache(tmp_path / 'metadata.sqlite')
+    monkeypatch.setattr(Rom, 'cache', cache)
+    monkeypatch.setattr(Rom, 'thumbnails', ThumbnailCache(tmp_path / 'thumbnails'))
+    roms = tmp_path / 'roms'
+    (roms / 'nested').mkdir(parents=True)
+    for path in ('b.nds', 'c.nds', 'nested/a.nds', 'nested/f.nds'):
+        make_nds_rom(roms / path)
+    library = Library([roms], roots_path=tmp_path / 'library.json')
+    library.populate()
+    assert len(library) == 4
+
+    make_nds_rom(roms / 'e.nds', title=b'ECHO')
+    (roms / 'b.nds').unlink()
+    assert library.apply([roms / 'e.nds', roms / 'missing.nds'], [roms / 'b.nds', roms / 'nested']) == 0
+    assert sorted(entry.path.name for entry in library) == ['c.nds', 'e.nds']
+
+    (roms / 'c.nds').unlink()
+    make_nds_rom(roms / 'g.nds')
+    present, vanished = library.directory_changes(roms)
+    assert sorted(path.name for path in present) == ['e.nds', 'g.nds']
+    assert [path.name for path in vanished] == ['c.nds']
+    assert library.directory_changes(tmp_path / 'missing') == ([], [tmp_path / 'missing'])
+    cache.close()
@@ -0,0 +1,321 @@
+import mmap
+import os
+import struct
+
+from qtxds.banner import Smdh
+from qtxds.files import CopyCancelled, copy_range, copy_ranges, safe_join
+
+HEADER_SIZE = 0x200
+MEDIA_UNIT_SIZE = 0x200
+PARTITION_COUNT = 8
+PAD_CHUNK_SIZE = 16 * 1024 * 1024
+EXEFS_HEADER_SIZE = 0x200
+EXEFS_FILE_COUNT = 10
+IVFC_HEADER_SIZE = 0x60
+ROMFS_ROOT_DIRECTORY = 0
+ROMFS_NONE = 0xFFFFFFFF
+
+
+def _media_unit_size(flags):
+    return MEDIA_UNIT_SIZE << flags[6]
+
+
+def _string(data, offset, length):
+    return data[offset:offset + length].split(b'\0', 1)[0].decode('ascii', 'replace').strip()
+
+
+class NcsdHeader:
+    def __init__(self, data):
+        if len(data) < HEADER_SIZE or data[0x100:0x104] != b'NCSD':
+            raise ValueError('Not an NCSD image')
+
+        self.raw = bytes(data[:HEADER_SIZE])
+
+        self.media_size, = struct.unpack_from('<I', self.raw, 0x104)
+        self.media_id, = struct.unpack_from('<Q', self.raw, 0x108)
+        self.flags = self.raw[0x188:0x190]
+        self.media_unit_size = _media_unit_size(self.flags)
+        self.partitions = [
+            (offset * self.media_unit_size, size * self.media_unit_size)
+            for offset, size in struct.iter_unpack('<II', self.raw[0x120:0x120 + PARTITION_COUNT * 8])
+        ]
+
+    @property
+    def used_size(self):
+        return max((offset + size for offset, size in self.partitions if size), default=HEADER_SIZE)
+
+
+class NcchHeader:
+    def __init__(self, data):
+        if len(data) < HEADER_SIZE or data[0x100:0x104] != b'NCCH':
+            raise ValueError('Not an NCCH partition')
+
+        self.raw = bytes(data[:HEADER_SIZE])
+
+        self.flags = self.raw[0x188:0x190]
+        self.media_unit_size = _media_unit_size(self.flags)
+        unit = self.media_unit_size
+
+        content_size, = struct.unpack_from('<I', self.raw, 0x104)
+        self.content_size = content_size * unit
+        self.maker_code = _string(self.raw, 0x110, 2)
+        self.program_id, = struct.unpack_from('<Q', self.raw, 0x118)
+        self.product_code = _string(self.raw, 0x150, 16)
+        self.extended_header_size, = struct.unpack_from('<I', self.raw, 0x180)
+        (plain_offset, plain_size, logo_offset, logo_size,
+         exefs_offset, exefs_size, _, _,
+         romfs_offset, romfs_size) = struct.unpack_from('<10I', self.raw, 0x190)
+        self.plain_offset, self.plain_size = plain_offset * unit, plain_size * unit
+        self.logo_offset, self.logo_size = logo_offset * unit, logo_size * unit
+        self.exefs_offset, self.exefs_size = exefs_offset * unit, exefs_size * unit
+        self.romfs_offset, self.romfs_size = romfs_offset * unit, romfs_size * unit
+
+    @property
+    def is_encrypted(self):
+        # NoCrypto bit of the crypto method flags
+        return not self.flags[7] & 0x04
+
+
+class RomFs:
+    """Read the level 3 file system of a decrypted RomFS in place, entries are identified by their metadata offset."""
+
+    def __init__(self, data, offset, size, fileno=None):
+        if data[offset:offset + 4] != b'IVFC':
+            raise ValueError('Not a decrypted RomFS')
+        self.data = data
+        self._fileno = fileno
+        self.end = offset + size
+
+        master_hash_size, = struct.unpack_from('<I', data, offset + 0x08)
+        level3_block_size, = struct.unpack_from('<I', data, offset + 0x4C)
+        block = 1 << level3_block_size
+        self.level3_offset = offset + (IVFC_HEADER_SIZE + master_hash_size + block - 1) // block * block
+
+        (header_size, _, _, self.directory_table_offset, self.directory_table_size, _, _,
+         self.file_table_offset, self.file_table_size, self.file_data_offset) = \
+            struct.unpack_from('<10I', data, self.level3_offset)
+        if header_size != 0x28:
+            raise ValueError(f'Invalid RomFS level 3 header size: {header_size:#x}')
+
+    def _name(self, position, length):
+        return bytes(self.data[position:position + length]).decode('utf-16-le', 'replace')
+
+    def _directory(self, directory_offset):
+        if directory_offset + 0x18 > self.directory_table_size:
+            raise ValueError(f'Invalid RomFS directory: {directory_offset:#x}')
+        position = self.level3_offset + self.directory_table_offset + directory_offset
+        _, sibling, child, first_file, _, name_length = struct.unpack_from('<6I', self.data, position)
+        return sibling, child, first_file, self._name(position + 0x18, name_length)
+
+    def _file(self, file_offset):
+        if file_offset + 0x20 > self.file_table_size:
+            raise ValueError(f'Invalid RomFS file: {file_offset:#x}')
+        position = self.level3_offset + self.file_table_offset + file_offset
+        _, sibling, data_offset, data_size, _, name_length = struct.unpack_from('<IIQQII', self.data, position)
+        return sibling, data_offset, data_size, self._name(position + 0x20, name_length)
+
+    def listdir(self, directory_offset=ROMFS_ROOT_DIRECTORY):
+        """List one directory as (name, is directory, metadata offset), subdirectories first."""
+        _, child, file_offset, _ = self._directory(directory_offset)
+        entries = []
+        seen = set()
+        while child != ROMFS_NONE and child not in seen:
+            seen.add(child)
+            sibling, _, _, name = self._directory(child)
+            entries.append((name, True, child))
+            child = sibling
+        while file_offset != ROMFS_NONE and file_offset not in seen:
+            seen.add(file_offset)
+            sibling, _, _, name = self._file(file_offset)
+            entries.append((name, False, file_offset))
+            file_offset = sibling
+        return entries
+
+    def files(self):
+        """Yield (metadata offset, path) for every file."""
+        stack = [(ROMFS_ROOT_DIRECTORY, '')]
+        while stack:
+            directory_offset, prefix = stack.pop()
+            subdirectories = []
+            for name, is_directory, entry_offset in self.listdir(directory_offset):
+                if is_directory:
+                    subdirectories.append((entry_offset, prefix + name + '/'))
+                else:
+                    yield entry_offset, prefix + name
+            stack.extend(reversed(subdirectories))
+
+    def file_location(self, file_offset):
+        """(offset, size) of a file in the image, checked against the RomFS size."""
+        _, data_offset, data_size, _ = self._file(file_offset)
+        offset = self.level3_offset + self.file_data_offset + data_offset
+        if offset + data_size > self.end:
+            raise ValueError(f'Invalid RomFS file data: {offset:#x}+{data_size:#x}')
+        return offset, data_size
+
+    def read(self, file_offset, size=None):
+        """Read a file, or only its first size bytes."""
+        offset, file_size = self.file_location(file_offset)
+        return self.data[offset:offset + (file_size if size is None else min(size, file_size))]
+
+    def export(self, file_offset, dst):
+        """Copy a single file out of the image without extracting anything else."""
+        offset, size = self.file_location(file_offset)
+        return copy_range(self._fileno, offset, size, dst)
+
+
+class ThreedsImage:
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._data = None
+        try:
+            self.ncsd_header = NcsdHeader(self.read(0, HEADER_SIZE))
+            self.partition_offset = self.ncsd_header.partitions[0][0]
+            self.ncch_header = NcchHeader(self.read(self.partition_offset, HEADER_SIZE))
+        except ValueError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+        self._file.close()
+
+    def read(self, offset, size):
+        self._file.seek(offset)
+        return self._file.read(size)
+
+    def exefs_files(self):
+        """Map the names of the files in the ExeFS of the game partition to their (offset, size) in the image."""
+        header = self.ncch_header
+        if header.is_encrypted:
+            raise ValueError('The ExeFS is encrypted, decrypt the ROM first')
+        if not header.exefs_size:
+            return {}
+        offset = self.partition_offset + header.exefs_offset
+        data = self.read(offset, EXEFS_HEADER_SIZE)
+        if len(data) < EXEFS_HEADER_SIZE:
+            raise ValueError(f'Truncated ExeFS: {offset:#x}')
+        files = {}
+        for name, file_offset, size in struct.iter_unpack('<8sII', data[:EXEFS_FILE_COUNT * 0x10]):
+            name = name.split(b'\0', 1)[0].decode('ascii', 'replace')
+            if name and size:
+                files[name] = (offset + EXEFS_HEADER_SIZE + file_offset, size)
+        return files
+
+    def read_exefs(self, name):
+        """Read a single file of the ExeFS, seeking straight to it."""
+        offset, size = self.exefs_files()[name]
+        data = self.read(offset, size)
+        if len(data) < size:
+            raise ValueError(f'Truncated ExeFS file {name}: {offset:#x}+{size:#x}')
+        return data
+
+    def smdh(self):
+        """The icon and titles of a decrypted ROM, None if it has no icon."""
+        if 'icon' not in self.exefs_files():
+            return None
+        return Smdh(self.read_exefs('icon'))
+
+    def romfs(self):
+        """Map the image and open the RomFS of its game partition, which must be decrypted."""
+        header = self.ncch_header
+        if header.is_encrypted:
+            raise ValueError('The RomFS is encrypted, decrypt the ROM first')
+        if not header.romfs_size:
+            raise ValueError('The ROM has no RomFS')
+        if self._data is None:
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = self.partition_offset + header.romfs_offset
+        if offset + header.romfs_size > len(self._data):
+            raise ValueError(f'Truncated RomFS: {offset:#x}+{header.romfs_size:#x}')
+        return RomFs(self._data, offset, header.romfs_size, self._file.fileno())
+
+
+def trim(path, progress=None, cancelled=None, chunk_size=PAD_CHUNK_SIZE):
+    """Truncate a 3DS ROM in place after its last partition, return the number of bytes removed.
+
+    Only 0xFF padding is removed, anything else past the last partition is refused, since trimming needs no backup.
+    """
+    with ThreedsImage(path) as image:
+        size = image.ncsd_header.used_size
+    current = os.path.getsize(path)
+    if size > current:
+        raise ValueError(f'Truncated 3DS ROM: {current:#x} < {size:#x}')
+    if size == current:
+        return 0
+
+    fill = b'\xff' * min(chunk_size, current - size)
+    with open(path, 'r+b', buffering=0) as f:
+        f.seek(size)
+        offset = size
+        while offset < current:
+            if cancelled is not None and cancelled.is_set():
+                raise CopyCancelled(str(path))
+            data = f.read(min(chunk_size, current - offset))
+            if not data:
+                break
+            if data != fill[:len(data)]:
+                position = offset + len(data) - len(data.lstrip(b'\xff'))
+                raise ValueError(f'Data past the last partition at {position:#x}, not trimming')
+            offset += len(data)
+            if progress:
+                progress(offset - size, current - size)
+        f.truncate(size)
+    return current - size
+
+
+def pad(path, progress=None, cancelled=None, chunk_size=PAD_CHUNK_SIZE):
+    """Fill a 3DS ROM with 0xFF up to its media size, return the number of bytes added."""
+    with ThreedsImage(path) as image:
+        size = image.ncsd_header.media_size * image.ncsd_header.media_unit_size
+    current = os.path.getsize(path)
+    if size <= current:
+        return 0
+
+    total = size - current
+    with open(path, 'r+b', buffering=0) as f:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                # Reserve the space in one go, so the filesystem can lay the padding out contiguously
+                os.posix_fallocate(f.fileno(), current, total)
+            except OSError:
+                pass
+        f.seek(current)
+        fill = memoryview(b'\xff' * min(chunk_size, total))
+        done = 0
+        try:
+            while done < total:
+                if cancelled is not None and cancelled.is_set():
+                    raise CopyCancelled(str(path))
+                done += f.write(fill[:min(len(fill), total - done)])
+                if progress:
+                    progress(done, total)
+        except BaseException:
+            f.truncate(current)
+            raise
+    return total
+
+
+def extract_romfs(path, romfs_dir, select=None, progress=None, cancelled=None, workers=None):
+    """Extract the RomFS of a decrypted 3DS ROM straight from the image, without game.cxi or romfs.bin.
+
+    When select is given, only the files whose path it accepts are extracted. Return the number of bytes extracted.
+    """
+    with ThreedsImage(path) as image:
+        romfs = image.romfs()
+        groups = {}
+        for file_offset, name in romfs.files():
+            if select is not None and not select(name):
+                continue
+            target = safe_join(romfs_dir, name)
+            groups.setdefault(os.path.dirname(target), []).append((target,) + romfs.file_location(file_offset))
+        os.makedirs(str(romfs_dir), exist_ok=True)
+
+    return copy_ranges(path, groups, progress, cancelled, workers)
@@ -1,136 +1,174 @@
-import asyncio
+import functools
 import re
 import shutil
 import sys
 
+from qtxds import nds, process, threeds
+from qtxds.banner import Banner
+from qtxds.manifest import BuildManifest
+from qtxds.nds import NdsImage
+from qtxds.process import ToolError
+from qtxds.telemetry import COPIED, measured
+from qtxds.threeds import ThreedsImage
+
+
+INFO_TIMEOUT = 60
+
+
+@functools.lru_cache(maxsize=None)
+def which(tool):
+    return shutil.which(tool)
+
 
 class Tool:
-    def __init__(self, tool):
-        self.path = shutil.which(tool)
+    def __init__(self, tool, timeout=None, priority=None):
+        self.name = tool
+        self.timeout = timeout
+        self.priority = priority
 
         if sys.platform == 'win32':
             self.encoding = 'cp1252'
         else:
             self.encoding = 'utf8'
 
+    @property
+    def path(self):
+        # Looked up on first use and shared by every instance, scanning PATH is slow on some systems
+        return which(self.name)
+
+    async def run(self, args, timeout=None, priority=None, capture_output=False):
+        if not self.path:
+            raise ToolError(f'{self.name} was not found in PATH')
+
+        return await process.run([self.path] + args, timeout=timeout or self.timeout,
+                                 priority=priority or self.priority, capture_output=capture_output,
+                                 encoding=self.encoding)
+
 
 class NdsTool(Tool):
     def __init__(self):
         super().__init__('ndstool')
 
+    @measured
     async def info(self, rom, status_bar):
         status_bar.showMessage('Analyzing...')
 
-        cmd = [str(self.path), '-i', str(rom.path)]
-
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
-        proc = await create
-
-        while True:
-            data = await proc.stdout.readline()
-            line = data.decode(self.encoding).strip()
-            if line:
-                if line.startswith('0x00'):
-                    rom.title = line.split()[-1]
-                    continue
-                if line.startswith('0x10'):
-                    rom.maker_code = line.split()[3]
-                    continue
-                if line.startswith('0x0C'):
-                    rom.product_code = line.split()[-1][1:-1]
-                    continue
-                if line.startswith('0x6C'):
-                    secure_area_crc, decrypted = re.findall('\(.*\)', line)[-1][1:-1].split(', ')
-                    rom.is_secure_area_crc_ok = secure_area_crc == 'OK'
-                    rom.is_decrypted = decrypted == 'decrypted'
-                    continue
-                if line.startswith('0x15E'):
-                    header_crc = line.split()[-1][1:-1]
-                    rom.is_header_crc_ok = header_crc == 'OK'
-                    continue
-            else:
-                break
-
-        await proc.wait()
-
-        cmd = [str(self.path), '-l', str(rom.path)]
-
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
-        proc = await create
-
-        rom.content_size = 0
-        while True:
-            data = await proc.stdout.readline()
-            line = data.decode(self.encoding).strip()
-            if line:
-                if line[0].isdigit():
-                    rom.content_size += int(line.split()[3])
-            else:
-                break
-
-        await proc.wait()
+        with NdsImage(rom.path) as image:
+            crcs = image.check_crcs()
+            rom.title = image.header.title
+            rom.maker_code = image.header.maker_code
+            rom.product_code = image.header.product_code
+            rom.is_header_crc_ok = crcs['header']
+            rom.is_logo_crc_ok = crcs['logo']
+            rom.is_banner_crc_ok = crcs['banner']
+            rom.is_decrypted = image.is_secure_area_decrypted
+            rom.is_secure_area_crc_ok = crcs['secure_area'] is not False
+            rom.content_size = image.content_size
+            banner_data = image.banner()
+
+        if banner_data:
+            banner = Banner(banner_data)
+            rom.banner_title = banner.title
+            rom.icon_digest = banner.digest
+            rom.thumbnails.get(banner)
+
+        # The secure area CRC covers the encrypted bytes, checking a decrypted one needs ndstool's keys
+        if crcs['secure_area'] is None and rom.is_decrypted and self.path:
+            rom.is_secure_area_crc_ok = await self.secure_area_crc_ok(rom)
+
+    async def secure_area_crc_ok(self, rom):
+        output = await self.run(['-i', str(rom.path)], timeout=INFO_TIMEOUT, capture_output=True)
+
+        is_secure_area_crc_ok = True
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('0x6C'):
+                secure_area_crc = re.findall('\\(.*\\)', line)[-1][1:-1].split(', ')[0]
+                is_secure_area_crc_ok = secure_area_crc == 'OK'
+
+        return is_secure_area_crc_ok
+
+    @measured
+    async def trim(self, rom, status_bar):
+        await rom.backup(status_bar)
+
+        status_bar.showMessage('Trimming...')
+
+        nds.trim(rom.path)
 
+    @measured
     async def fix_header_crc(self, rom, status_bar):
         status_bar.showMessage('Fixing Header CRC...')
 
-        cmd = [str(self.path), '-f', str(rom.path)]
-
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        nds.fix_header_crc(rom.path)
 
+    @measured
     async def encrypt_nintendo(self, rom, status_bar):
         status_bar.showMessage('Encrypting (Nintendo)...')
 
-        cmd = [str(self.path), '-se', str(rom.path)]
+        cmd = ['-se', str(rom.path)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
+    @measured
     async def encrypt_others(self, rom, status_bar):
         status_bar.showMessage('Encrypting (others)...')
 
-        cmd = [str(self.path), '-sE', str(rom.path)]
+        cmd = ['-sE', str(rom.path)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
+    @measured
     async def decrypt(self, rom, status_bar):
         status_bar.showMessage('Decrypting...')
 
-        cmd = [str(self.path), '-sd', str(rom.path)]
+        cmd = ['-sd', str(rom.path)]
+
+        await self.run(cmd)
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+    def sections(self, rom):
+        return {
+            'arm9': rom.arm9_bin,
+            'arm7': rom.arm7_bin,
+            'overlay9': rom.overlay9_bin,
+            'overlay7': rom.overlay7_bin,
+            'banner': rom.banner_bin,
+            'header': rom.header_bin,
+        }
 
+    @measured
     async def extract_all(self, rom, status_bar):
         status_bar.showMessage('Extracting...')
 
         rom.extract_dir.mkdir(exist_ok=True)
 
-        cmd = [str(self.path), '-x', str(rom.path)]
-        cmd += ['-9', str(rom.arm9_bin)]
-        cmd += ['-7', str(rom.arm7_bin)]
-        cmd += ['-y9', str(rom.overlay9_bin)]
-        cmd += ['-y7', str(rom.overlay7_bin)]
-        cmd += ['-d', str(rom.data_dir)]
-        cmd += ['-y', str(rom.overlay_dir)]
-        cmd += ['-t', str(rom.banner_bin)]
-        cmd += ['-h', str(rom.header_bin)]
+        await rom.run_with_progress(status_bar, 'Extracting...', nds.extract, rom.path, self.sections(rom),
+                                    rom.data_dir, rom.overlay_dir, None, counters=COPIED)
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+    @measured
+    async def extract_selected(self, rom, status_bar, select):
+        status_bar.showMessage('Extracting...')
 
+        rom.extract_dir.mkdir(exist_ok=True)
+
+        await rom.run_with_progress(status_bar, 'Extracting...', nds.extract, rom.path, {}, rom.data_dir,
+                                    rom.overlay_dir, select, counters=COPIED)
+
+    @measured
     async def rebuild_all(self, rom, status_bar):
-        rom.backup(status_bar)
+        await rom.backup(status_bar)
 
         status_bar.showMessage('Rebuilding...')
 
-        cmd = [str(self.path), '-c', str(rom.path)]
+        with open(rom.header_bin, 'rb') as f:
+            header = nds.NdsHeader(f.read(nds.HEADER_SIZE))
+        # DSi ROMs have a second header and a digest table that only ndstool knows how to build
+        if not header.is_dsi:
+            await rom.run_with_progress(status_bar, 'Rebuilding...', nds.build, rom.path, self.sections(rom),
+                                        rom.data_dir, rom.overlay_dir, counters=COPIED)
+            return
+
+        cmd = ['-c', str(rom.path)]
         cmd += ['-9', str(rom.arm9_bin)]
         cmd += ['-7', str(rom.arm7_bin)]
         cmd += ['-y9', str(rom.overlay9_bin)]
@@ -140,21 +178,20 @@ class NdsTool(Tool):
         cmd += ['-t', str(rom.banner_bin)]
         cmd += ['-h', str(rom.header_bin)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
 
 class ThreedsTool(Tool):
     def __init__(self):
         Tool.__init__(self, '3dstool')
 
+    @measured
     async def extract_cci(self, rom, status_bar):
         status_bar.showMessage('Extracting CCI...')
 
         rom.extract_dir.mkdir(exist_ok=True)
 
-        cmd = [str(self.path), '-x']
+        cmd = ['-x']
         cmd += ['-f', str(rom.path)]
         cmd += ['-t', 'cci']
         cmd += ['--header', str(rom.ncsd_header_bin)]
@@ -162,14 +199,15 @@ class ThreedsTool(Tool):
         cmd += ['-1', str(rom.manual_cfa)]
         cmd += ['-2', str(rom.download_play_cfa)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
+        BuildManifest(rom.build_manifest_json).record('cci', rom.layers['cci'])
+
+    @measured
     async def extract_cxi(self, rom, status_bar):
         status_bar.showMessage('Extracting CXI...')
 
-        cmd = [str(self.path), '-x']
+        cmd = ['-x']
         cmd += ['-f', str(rom.game_cxi)]
         cmd += ['-t', 'cxi']
         cmd += ['--header', str(rom.ncch_header_bin)]
@@ -179,47 +217,61 @@ class ThreedsTool(Tool):
         cmd += ['--exefs', str(rom.exefs_bin)]
         cmd += ['--romfs', str(rom.romfs_bin)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
+
+        BuildManifest(rom.build_manifest_json).record('cxi', rom.layers['cxi'])
 
+    @measured
     async def extract_exefs(self, rom, status_bar):
         status_bar.showMessage('Extracting ExeFS...')
 
-        cmd = [str(self.path), '-x']
+        cmd = ['-x']
         cmd += ['-f', str(rom.exefs_bin)]
         cmd += ['-t', 'exefs']
         cmd += ['--header', str(rom.exefs_header_bin)]
         cmd += ['--exefs-dir', str(rom.exefs_dir)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
+
+        BuildManifest(rom.build_manifest_json).record('exefs', rom.layers['exefs'])
 
+    @measured
     async def extract_romfs(self, rom, status_bar):
         status_bar.showMessage('Extracting RomFS...')
 
-        cmd = [str(self.path), '-x']
+        cmd = ['-x']
         cmd += ['-f', str(rom.romfs_bin)]
         cmd += ['-t', 'romfs']
         cmd += ['--romfs-dir', str(rom.romfs_dir)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
+        BuildManifest(rom.build_manifest_json).record('romfs', rom.layers['romfs'])
+
+    @measured
     async def extract_all(self, rom, status_bar):
         await self.extract_cci(rom, status_bar)
         await self.extract_cxi(rom, status_bar)
         await self.extract_exefs(rom, status_bar)
         await self.extract_romfs(rom, status_bar)
 
+    @measured
+    async def extract_selected(self, rom, status_bar, select):
+        # Read straight from the decrypted image, a partial romfs/ is not recorded in the build manifest
+        status_bar.showMessage('Extracting RomFS...')
+
+        rom.extract_dir.mkdir(exist_ok=True)
+
+        await rom.run_with_progress(status_bar, 'Extracting RomFS...', threeds.extract_romfs, rom.path, rom.romfs_dir,
+                                    select, counters=COPIED)
+
+    @measured
     async def rebuild_cci(self, rom, status_bar):
-        rom.backup(status_bar)
+        await rom.backup(status_bar)
 
         status_bar.showMessage('Rebuilding CCI...')
 
-        cmd = [str(self.path), '-c']
+        cmd = ['-c']
         cmd += ['-f', str(rom.path)]
         cmd += ['-t', 'cci']
         cmd += ['--header', str(rom.ncsd_header_bin)]
@@ -227,14 +279,15 @@ class ThreedsTool(Tool):
         cmd += ['-1', str(rom.manual_cfa)]
         cmd += ['-2', str(rom.download_play_cfa)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
+        BuildManifest(rom.build_manifest_json).record('cci', rom.layers['cci'])
+
+    @measured
     async def rebuild_cxi(self, rom, status_bar):
         status_bar.showMessage('Rebuilding CXI...')
 
-        cmd = [str(self.path), '-c']
+        cmd = ['-c']
         cmd += ['-f', str(rom.game_cxi)]
         cmd += ['-t', 'cxi']
         cmd += ['--header', str(rom.ncch_header_bin)]
@@ -244,128 +297,100 @@ class ThreedsTool(Tool):
         cmd += ['--exefs', str(rom.exefs_bin)]
         cmd += ['--romfs', str(rom.romfs_bin)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
+
+        BuildManifest(rom.build_manifest_json).record('cxi', rom.layers['cxi'])
 
+    @measured
     async def rebuild_exefs(self, rom, status_bar):
         status_bar.showMessage('Rebuilding ExeFS...')
 
-        cmd = [str(self.path), '-c']
+        cmd = ['-c']
         cmd += ['-f', str(rom.exefs_bin)]
         cmd += ['-t', 'exefs']
         cmd += ['--header', str(rom.exefs_header_bin)]
         cmd += ['--exefs-dir', str(rom.exefs_dir)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
+
+        BuildManifest(rom.build_manifest_json).record('exefs', rom.layers['exefs'])
 
+    @measured
     async def rebuild_romfs(self, rom, status_bar):
         status_bar.showMessage('Rebuilding RomFS...')
 
-        cmd = [str(self.path), '-c']
+        cmd = ['-c']
         cmd += ['-f', str(rom.romfs_bin)]
         cmd += ['-t', 'romfs']
         cmd += ['--romfs-dir', str(rom.romfs_dir)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
-    async def rebuild_all(self, rom, status_bar):
-        await self.rebuild_romfs(rom, status_bar)
-        await self.rebuild_exefs(rom, status_bar)
-        await self.rebuild_cxi(rom, status_bar)
-        await self.rebuild_cci(rom, status_bar)
+        BuildManifest(rom.build_manifest_json).record('romfs', rom.layers['romfs'])
 
+    @measured
+    async def rebuild_all(self, rom, status_bar):
+        # Rebuilding a layer changes its output, which dirties every layer above it
+        for layer, rebuild in (('romfs', self.rebuild_romfs),
+                               ('exefs', self.rebuild_exefs),
+                               ('cxi', self.rebuild_cxi),
+                               ('cci', self.rebuild_cci)):
+            if BuildManifest(rom.build_manifest_json).is_dirty(layer, rom.layers[layer]):
+                await rebuild(rom, status_bar)
+
+    @measured
     async def trim(self, rom, status_bar):
-        rom.backup(status_bar)
-
+        # Only 0xFF padding is removed or added, so trimming and padding undo each other and need no backup
         status_bar.showMessage('Trimming...')
 
-        cmd = [str(self.path), '-r']
-        cmd += ['-f', str(rom.path)]
-
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await rom.run_with_progress(status_bar, 'Trimming...', threeds.trim, rom.path, counters=('bytes_read',))
 
+    @measured
     async def pad(self, rom, status_bar):
-        rom.backup(status_bar)
-
         status_bar.showMessage('Padding...')
 
-        cmd = [str(self.path), '-p']
-        cmd += ['-f', str(rom.path)]
-
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await rom.run_with_progress(status_bar, 'Padding...', threeds.pad, rom.path, counters=('bytes_written',))
 
 
 class CtrTool(Tool):
     def __init__(self):
         Tool.__init__(self, 'ctrtool')
 
+    @measured
     async def info(self, rom, status_bar):
         status_bar.showMessage('Analyzing...')
 
-        cmd = [str(self.path), '-i', str(rom.path)]
-
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
-        proc = await create
-
-        while not proc.stdout.at_eof():
-            data = await proc.stdout.readline()
-            line = data.decode(self.encoding).strip()
-            if line:
-                if line.startswith('Media size:'):
-                    rom.media_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('> Mediaunit size:'):
-                    rom.media_unit_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('Maker code:'):
-                    rom.maker_code = line.split(':')[-1].strip()
-                    continue
-                if line.startswith('Product code:'):
-                    rom.product_code = line.split(':')[-1].strip()
-                    continue
-                if line.startswith('Content size:'):
-                    rom.content_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('Exheader size:'):
-                    rom.extended_header_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('Plain region size:'):
-                    rom.plain_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('Logo size:'):
-                    rom.logo_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('ExeFS size:'):
-                    rom.exefs_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-                if line.startswith('RomFS size:'):
-                    rom.romfs_size = int(line.split(':')[-1].strip(), 16)
-                    continue
-
-        await proc.wait()
+        with ThreedsImage(rom.path) as image:
+            rom.media_size = image.ncsd_header.media_size
+            rom.media_unit_size = image.ncsd_header.media_unit_size
+            rom.maker_code = image.ncch_header.maker_code
+            rom.product_code = image.ncch_header.product_code
+            rom.content_size = image.ncch_header.content_size
+            rom.extended_header_size = image.ncch_header.extended_header_size
+            rom.plain_size = image.ncch_header.plain_size
+            rom.logo_size = image.ncch_header.logo_size
+            rom.exefs_size = image.ncch_header.exefs_size
+            rom.romfs_size = image.ncch_header.romfs_size
+            # Encrypted ExeFS are left to the full extraction chain
+            smdh = None if image.ncch_header.is_encrypted else image.smdh()
+
+        if smdh is not None:
+            rom.banner_title = smdh.title
+            rom.icon_digest = smdh.digest
+            rom.thumbnails.get(smdh)
 
 
 class ThreedsConv(Tool):
     def __init__(self):
         super().__init__('3dsconv')
 
+    @measured
     async def convert(self, rom, status_bar):
         status_bar.showMessage('Converting to CIA...')
 
-        cmd = [str(self.path), '--overwrite', '--output=' + str(rom.working_dir), str(rom.path)]
+        cmd = ['--overwrite', '--output=' + str(rom.working_dir), str(rom.path)]
 
-        create = asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.DEVNULL)
-        proc = await create
-        await proc.wait()
+        await self.run(cmd)
 
 
 
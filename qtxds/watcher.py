@@ -0,0 +1,204 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import time
+from pathlib import Path
+
+from qtxds.roms import ROMS
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0)
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+DEBOUNCE_DELAY = 2.0
+
+
+class Changes:
+    """Debounce file system events, a path is ready once no event was seen for it during delay seconds.
+
+    Only the latest state of a path is kept: a ROM written then deleted during a burst is only deleted.
+    """
+
+    def __init__(self, delay=DEBOUNCE_DELAY, clock=time.monotonic):
+        self.delay = delay
+        self.clock = clock
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, path, deleted=False):
+        self._pending[Path(path)] = (deleted, self.clock())
+
+    def next_deadline(self):
+        """Seconds until the next path is ready, None if there is none."""
+        if not self._pending:
+            return None
+        return max(0, min(seen for _, seen in self._pending.values()) + self.delay - self.clock())
+
+    def ready(self):
+        """Take the paths that have been quiet long enough, as (changed, deleted) lists."""
+        now = self.clock()
+        changed, deleted = [], []
+        for path, (is_deleted, seen) in list(self._pending.items()):
+            if now - seen >= self.delay:
+                del self._pending[path]
+                (deleted if is_deleted else changed).append(path)
+        return changed, deleted
+
+
+def is_rom(name):
+    return os.path.splitext(name)[1].lower() in ROMS
+
+
+class Inotify:
+    """Minimal inotify binding, watching whole directory trees."""
+
+    def __init__(self):
+        name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            init = libc.inotify_init1
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this platform')
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.directories = {}
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+            self.directories.clear()
+
+    def add_watch(self, directory):
+        wd = self._add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), str(directory))
+        self.directories[wd] = str(directory)
+
+    def unwatch(self, directory):
+        """Stop watching a directory and everything under it, once it has been moved away."""
+        prefix = os.path.join(str(directory), '')
+        for wd, watched in list(self.directories.items()):
+            if watched == str(directory) or watched.startswith(prefix):
+                self._rm_watch(self.fd, wd)
+                del self.directories[wd]
+
+    def watch(self, root):
+        """Watch root and every directory under it, return the ROMs found on the way."""
+        roms = []
+        stack = [str(root)]
+        while stack:
+            directory = stack.pop()
+            try:
+                self.add_watch(directory)
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif is_rom(entry.name):
+                            roms.append(Path(entry.path))
+            except FileNotFoundError:
+                # Removed while being walked, its parent reports it
+                continue
+        return roms
+
+    def read(self):
+        """Return the pending events as (path, mask) tuples, the path being None for a queue overflow."""
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                directory = self.directories.get(wd)
+                if mask & IN_IGNORED:
+                    self.directories.pop(wd, None)
+                elif directory is not None:
+                    events.append((os.path.join(directory, os.fsdecode(name)), mask))
+
+
+class LibraryWatcher:
+    """Feed the ROMs created, modified, moved and deleted under the library roots to a Changes queue."""
+
+    def __init__(self, roots, changes):
+        self.changes = changes
+        self.inotify = Inotify()
+        try:
+            for root in roots:
+                self.inotify.watch(root)
+        except OSError:
+            self.inotify.close()
+            raise
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def close(self):
+        self.inotify.close()
+
+    def process(self):
+        """Queue the pending events, return True if the kernel dropped some and the roots need a full scan."""
+        overflow = False
+        for path, mask in self.inotify.read():
+            if path is None:
+                overflow = True
+            elif mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # A directory moved in brings its ROMs along, without any event for them
+                    for rom in self.inotify.watch(path):
+                        self.changes.add(rom)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.inotify.unwatch(path)
+                    self.changes.add(path, deleted=True)
+            elif is_rom(path):
+                self.changes.add(path, deleted=bool(mask & (IN_DELETE | IN_MOVED_FROM)))
+        return overflow
+
+
+def directories(roots):
+    """List every directory under the roots, for watchers that only watch the directories they are given."""
+    found = []
+    stack = [str(root) for root in roots]
+    while stack:
+        directory = stack.pop()
+        found.append(directory)
+        try:
+            with os.scandir(directory) as entries:
+                stack.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+        except OSError:
+            continue
+    return found
@@ -6,6 +6,11 @@ requirements = [
     'Quamash',
 ]
 
+extra_requirements = {
+    # Faster icon and banner decoding
+    'fast': ['numpy'],
+}
+
 test_requirements = [
     'pytest',
     'pytest-cov',
@@ -27,10 +32,12 @@ setup(
     package_data={'qtxds.images': ['*.png']},
     entry_points={
         'console_scripts': [
-            'qtxds=qtxds.qtxds:main'
+            'qtxds=qtxds.main:main',
+            'qtxds-batch=qtxds.batch:main',
         ]
     },
     install_requires=requirements,
+    extras_require=extra_requirements,
     zip_safe=False,
     keywords='qtxds',
     classifiers=[